@@ -2,9 +2,24 @@
 
 source ../../env_email.sh
 envsubst "$(env | cut -d= -f1 | sed -e 's/^/$/')" < ./outline_iam_policy_file_sample.json  > "./outline_iam_policy_file.json"
+envsubst "$(env | cut -d= -f1 | sed -e 's/^/$/')" < ./outline_dedupe_dynamodb_table_sample.json  > "./outline_dedupe_dynamodb_table.json"
 
 ### Functions
 
+create_dynamo_tables () {
+echo "--------------------------"
+echo "Creating DynamoDB Tables  "
+echo "--------------------------"
+echo ""
+if [ -z "${AWS_DEDUPE_DYNAMODB_TABLE}" ]; then
+    echo "AWS_DEDUPE_DYNAMODB_TABLE is not set, skipping"
+    return
+fi
+aws dynamodb create-table --cli-input-json file://outline_dedupe_dynamodb_table.json --region ${AWS_REGION}
+aws dynamodb wait table-exists --table-name ${AWS_DEDUPE_DYNAMODB_TABLE} --region ${AWS_REGION}
+aws dynamodb update-time-to-live --table-name ${AWS_DEDUPE_DYNAMODB_TABLE} --time-to-live-specification "Enabled=true, AttributeName=expires_at" --region ${AWS_REGION}
+}
+
 create_lambda_role () {
 echo "--------------------------"
 echo "Creating Lambda Role      "
@@ -60,6 +75,9 @@ aws lambda create-function \
 }
 
 
+# Create Dynamodb Tables:
+create_dynamo_tables
+
 # Create IAM permission policy:
 create_permission_policy
 
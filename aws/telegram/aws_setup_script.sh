@@ -14,6 +14,10 @@ echo "--------------------------"
 echo ""
 aws dynamodb create-table --cli-input-json file://outline_dynamodb_table.json --region ${AWS_REGION}
 aws dynamodb create-table --cli-input-json file://outline_info_dynamodb_table.json --region ${AWS_REGION}
+aws dynamodb wait table-exists --table-name ${AWS_DYNAMODB_TABLE} --region ${AWS_REGION}
+aws dynamodb wait table-exists --table-name ${AWS_INFO_DYNAMODB_TABLE} --region ${AWS_REGION}
+aws dynamodb update-time-to-live --table-name ${AWS_DYNAMODB_TABLE} --time-to-live-specification "Enabled=true, AttributeName=expires_at" --region ${AWS_REGION}
+aws dynamodb update-time-to-live --table-name ${AWS_INFO_DYNAMODB_TABLE} --time-to-live-specification "Enabled=true, AttributeName=expires_at" --region ${AWS_REGION}
 }
 
 create_lambda_role () {
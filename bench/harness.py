@@ -0,0 +1,96 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark harness
+Lays out a bot the same way build.sh does so benchmarks import the real code
+"""
+
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENV_PATTERN = re.compile(r'\$([A-Z_][A-Z0-9_]*)')
+
+
+def render_settings(sample, overrides=None):
+    """
+    Renders settings-sample.py the way envsubst does in build.sh
+
+    Unset variables become empty strings, except ADMIN_LIST which is
+    a Python expression and becomes an empty list.
+
+    :param sample: Content of settings-sample.py
+    :param overrides: Dictionary of CONFIG values to override
+    :return: Content of settings.py
+    """
+    def substitute(match):
+        name = match.group(1)
+        if name in os.environ:
+            return os.environ[name]
+        return '[]' if name == 'ADMIN_LIST' else ''
+
+    settings = ENV_PATTERN.sub(substitute, sample)
+    if overrides:
+        settings += '\nCONFIG.update({!r})\n'.format(overrides)
+    return settings
+
+
+def make_sandbox(bot, overrides=None, path=None):
+    """
+    Copies common and bot files into one directory with a settings.py
+
+    :param bot: 'telegram' or 'email'
+    :param overrides: Dictionary of CONFIG values to override
+    :param path: Target directory, a new temporary directory if None
+    :return: Path of the sandbox
+    """
+    if path is None:
+        path = tempfile.mkdtemp(prefix='outline-{}-'.format(bot))
+    for source in ('common', bot):
+        source_dir = os.path.join(PROJECT_ROOT, 'src', source)
+        for name in os.listdir(source_dir):
+            if name == '__pycache__':
+                continue
+            source_path = os.path.join(source_dir, name)
+            if os.path.isdir(source_path):
+                shutil.copytree(source_path, os.path.join(path, name))
+            else:
+                shutil.copy(source_path, path)
+
+    with open(os.path.join(path, 'settings-sample.py')) as sample:
+        settings = render_settings(sample.read(), overrides)
+    with open(os.path.join(path, 'settings.py'), 'w') as settings_file:
+        settings_file.write(settings)
+    return path
+
+
+def load_bot(bot, overrides=None):
+    """
+    Makes a sandbox and puts it first on the import path
+
+    The working directory is changed to the sandbox because the bots
+    open their language files and templates with relative paths.
+
+    :param bot: 'telegram' or 'email'
+    :param overrides: Dictionary of CONFIG values to override
+    :return: Path of the sandbox
+    """
+    path = make_sandbox(bot, overrides)
+    sys.path.insert(0, path)
+    os.chdir(path)
+    return path
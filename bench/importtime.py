@@ -0,0 +1,121 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Cold-start import time benchmark
+
+Imports the handler module of each bot in a fresh interpreter with
+-X importtime, the way Lambda does during a cold start, and compares
+the median import time with a budget.
+
+Usage:
+    python bench/importtime.py --runs 5 --top 10
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import harness
+
+HANDLERS = {
+    'telegram': 'outlinebot',
+    'email': 'responder'
+}
+
+# Milliseconds on a development machine, the python3.8 Lambda runtime
+# with 512MB is roughly twice as slow. requests is imported eagerly by
+# both bots since nearly every update calls the Telegram or API server.
+BUDGETS = {
+    'telegram': 200,
+    'email': 400
+}
+
+# Modules worth knowing about when they show up in a cold start
+HEAVY_MODULES = ['boto3', 'botocore', 'requests', 'jinja2', 'sqlite3',
+                 'email.mime.multipart', 'logging.handlers', 'storage',
+                 'feedback', 'admin']
+
+
+def import_profile(sandbox, module):
+    """
+    Imports a module in a new interpreter with -X importtime
+
+    :param sandbox: Directory holding the bot files
+    :param module: Module to import
+    :return: Dictionary of module name to (cumulative microseconds, depth)
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [sandbox] + [path for path in [os.environ.get('PYTHONPATH')] if path])
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=sandbox, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+
+    profile = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        (_, cumulative, name) = line[len('import time:'):].split('|')
+        # Nested imports are indented by two spaces per level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        profile[name.strip()] = (int(cumulative), depth)
+    return profile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('bots', nargs='*', default=sorted(HANDLERS),
+                        help='bots to measure, default all')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of slowest imports to list')
+    parser.add_argument('--budget', type=float,
+                        help='budget in ms for every bot, overrides the defaults')
+    args = parser.parse_args()
+
+    failed = False
+    for bot in args.bots:
+        sandbox = harness.make_sandbox(bot, {'LOG_LEVEL': 'WARNING'})
+        handler = HANDLERS[bot]
+        profiles = [import_profile(sandbox, handler) for _ in range(args.runs)]
+        median = statistics.median(
+            profile[handler][0] for profile in profiles) / 1000
+        budget = args.budget or BUDGETS[bot]
+        loaded = [name for name in HEAVY_MODULES if name in profiles[-1]]
+
+        print('{}: import {} took {:.1f} ms (median of {}), budget {} ms'.format(
+            bot, handler, median, args.runs, budget))
+        print('  heavy modules loaded: {}'.format(', '.join(loaded) or 'none'))
+        # Direct imports of the handler module
+        direct = [(cumulative, name) for (name, (cumulative, depth))
+                  in profiles[-1].items() if depth == 1]
+        for (cumulative, name) in sorted(direct, reverse=True)[:args.top]:
+            print('  {:>9.1f} ms  {}'.format(cumulative / 1000, name))
+        if median > budget:
+            print('  over budget')
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,469 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+End-to-end load generator for the Telegram bot
+
+Replays synthetic update streams through outlinebot.bot_handler with the
+Telegram API and the distribution API replaced by local HTTP servers and
+the chat state kept in the memory or SQLite state store. Every synthetic
+user walks through onboarding (start, language, captcha, opt-in), gets a
+new key, checks the status and then clicks random home menu entries.
+
+Usage:
+    python bench/loadgen.py --users 200 --clicks 5 --backend sqlite
+
+With --inline the bot runs with inline keyboards and the language is
+picked with a button press.
+
+The run exits with status 1 when any update failed.
+
+The bot keeps per-update state in module globals, so updates are driven
+from a single thread; interleaving between users is random but each
+user's updates stay in order.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import harness
+
+TOKEN = '123456:BENCHMARK'
+ISSUES = [
+    {'id': 1, 'description_en': 'Cannot connect', 'description_fa': 'Cannot connect'},
+    {'id': 2, 'description_en': 'Slow connection', 'description_fa': 'Slow connection'},
+]
+# Steps that are button presses with --inline
+CALLBACK_STEPS = {'language'}
+HOME_CLICKS = [
+    'MENU_HOME_EXISTING_KEY',
+    'MENU_HOME_FAQ',
+    'MENU_HOME_PRIVACY_POLICY',
+    'MENU_HOME_SUPPORT',
+    'MENU_CHECK_STATUS',
+    'MENU_HOME_NEW_KEY',
+]
+
+
+class FakeServer(object):
+    """
+    Threaded local HTTP server counting the calls it receives
+    """
+    def __init__(self, responder):
+        self.calls = Counter()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                (name, status, payload) = responder(self.command, self.path, body)
+                server.calls[name] += 1
+                data = json.dumps(payload).encode('utf-8') if payload is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+        thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        thread.start()
+
+    def total(self):
+        return sum(self.calls.values())
+
+
+def telegram_responder(method, path, body):
+    """
+    Answers every Bot API method with a successful result
+    """
+    name = path.rsplit('/', 1)[-1]
+    result = {'message_id': 1}
+    if name == 'sendDocument':
+        result['document'] = {'file_id': 'BENCH_FILE'}
+    elif name == 'sendPhoto':
+        result['photo'] = [{'file_id': 'BENCH_PHOTO'}]
+    elif name == 'getFile':
+        result = {'file_id': 'BENCH_FILE', 'file_path': 'documents/bench'}
+    return ('telegram.' + name, 200, {'ok': True, 'result': result})
+
+
+def make_api_responder():
+    """
+    Distribution API stand-in keeping users and keys in memory
+    """
+    users = {}
+    lock = threading.Lock()
+
+    def respond(method, path, body):
+        data = json.loads(body) if body else {}
+        path = path.split('?', 1)[0]
+        with lock:
+            match = re.match(r'^/distribution/user/(.+)$', path)
+            if method == 'GET' and match:
+                user = users.get(match.group(1))
+                if user is None:
+                    return ('api.get_user', 404, {})
+                return ('api.get_user', 200, user)
+            if path == '/distribution/user' and method == 'PUT':
+                users[data['username']] = {
+                    'username': data['username'], 'banned': False, 'outline_key': None}
+                return ('api.create_user', 200, users[data['username']])
+            if path == '/distribution/user' and method == 'DELETE':
+                existed = users.pop(data['username'], None)
+                return ('api.delete_user', 204 if existed else 404, None)
+            if path == '/distribution/outline' and method == 'PUT':
+                key = 'ss://bench-{}@127.0.0.1:443'.format(data['user'])
+                if data['user'] in users:
+                    users[data['user']]['outline_key'] = key
+                return ('api.get_new_key', 200, {'outline_key': key})
+            match = re.match(r'^/distribution/outline/(.+)$', path)
+            if match:
+                return ('api.get_outline_user', 200, {'server': 1, 'outline_key': 'ss://bench'})
+            if path.startswith('/server/outlineserver/'):
+                return ('api.get_outline_server_info', 200, {'is_blocked': False})
+            if path == '/distribution/issues':
+                return ('api.get_issues', 200, {'results': ISSUES})
+        return ('api.unknown', 404, {})
+
+    return respond
+
+
+class CountingStore(object):
+    """
+    Wraps a state store and counts the calls made to it
+    """
+    def __init__(self, store):
+        self.store = store
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        method = getattr(self.store, name)
+
+        def counted(*args, **kwargs):
+            self.calls['state.' + name] += 1
+            return method(*args, **kwargs)
+        return counted
+
+    def total(self):
+        return sum(self.calls.values())
+
+
+def make_update(update_id, chat_id, text):
+    """
+    Builds the event API Gateway hands to the Lambda for a text message
+    """
+    return {
+        'lang': 'en',
+        'token': TOKEN,
+        'Input': {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {
+                    'id': chat_id,
+                    'is_bot': False,
+                    'first_name': 'Bench',
+                    'username': 'bench{}'.format(chat_id),
+                    'language_code': 'en'
+                },
+                'text': text
+            }
+        }
+    }
+
+
+def make_callback(update_id, chat_id, data):
+    """
+    Builds the event for a press of an inline keyboard button
+    """
+    sender = {
+        'id': chat_id,
+        'is_bot': False,
+        'first_name': 'Bench',
+        'username': 'bench{}'.format(chat_id),
+        'language_code': 'en'
+    }
+    return {
+        'lang': 'en',
+        'token': TOKEN,
+        'Input': {
+            'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id),
+                'from': sender,
+                'message': {
+                    'message_id': 1,
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'from': sender,
+                    'text': 'picker'
+                },
+                'chat_instance': str(chat_id),
+                'data': data
+            }
+        }
+    }
+
+
+def user_script(texts, dynamodb, config, chat_id, language, clicks, rng,
+                inline=False):
+    """
+    Yields (step, text) pairs for one synthetic user
+
+    Texts are produced lazily because the captcha answer is only known
+    after the bot has asked the question.
+    """
+    def text(name):
+        # Untranslated entries are empty in lang.json, users of those
+        # languages see (and type) the English text
+        return texts[name][language] or texts[name]['en']
+
+    language_index = config['SUPPORTED_LANGUAGES'].index(language)
+    yield ('start', '/start')
+    if inline:
+        yield ('language', 'l:{}'.format(language_index))
+    else:
+        yield ('language', texts['SUPPORTED_LANGUAGES']['en'][language_index])
+    choices = dynamodb.get_captcha(config['DYNAMO_TABLE'], chat_id) or ['0', '0']
+    yield ('captcha', str(int(choices[0]) + int(choices[1])))
+    yield ('opt_in', text('MENU_PRIVACY_POLICY_CONFIRM'))
+    yield ('new_key', text('MENU_HOME_NEW_KEY'))
+    yield ('status', text('MENU_CHECK_STATUS'))
+    for _ in range(clicks):
+        yield ('menu', text(rng.choice(HOME_CLICKS)))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def run(args):
+    telegram_server = FakeServer(telegram_responder)
+    api_server = FakeServer(make_api_responder())
+
+    overrides = {
+        'API_URL': api_server.url,
+        'API_KEY': 'bench',
+        'DYNAMO_TABLE': 'bench-chats',
+        'INFO_DYNAMO_TABLE': 'bench-info',
+        'STATE_BACKEND': args.backend,
+        'SUPPORTED_LANGUAGES': args.languages,
+        'SUPPORT_BOT': '@bench_support',
+        'LOG_LEVEL': 'WARNING',
+        'TRACE_ENABLED': args.trace,
+        'INLINE_KEYBOARDS': args.inline,
+        'INGESTION_MODE': 'queue' if args.queue else 'direct',
+        'QUEUE_BACKEND': 'memory',
+    }
+    if args.backend == 'sqlite':
+        overrides['STATE_SQLITE_FILE'] = os.path.join(tempfile.mkdtemp(), 'state.db')
+    sandbox = harness.load_bot('telegram', overrides)
+    from settings import CONFIG
+
+    # Texts a deployment fills in, a step sending an empty text fails
+    lang_path = os.path.join(sandbox, CONFIG['LANGUAGE_FILE'])
+    with open(lang_path) as lang_file:
+        texts = json.load(lang_file)
+    for language in args.languages:
+        texts['MSG_FAQ_URL'][language] = (
+            texts['MSG_FAQ_URL'].get(language) or 'https://example.com/faq')
+    with open(lang_path, 'w') as lang_file:
+        json.dump(texts, lang_file)
+
+    import outlinebot
+    import ingest
+    import telegram
+    import dynamodb
+    import statestore
+
+    telegram.TELEGRAM_HOSTNAME = telegram_server.url
+    store = CountingStore(statestore.get_store())
+    statestore._store = store
+    for language in args.languages:
+        for linktype in ('termsofservice', 'privacypolicy'):
+            dynamodb.save_info_link(
+                CONFIG['INFO_DYNAMO_TABLE'],
+                'https://example.com/{}/{}'.format(language, linktype),
+                language,
+                linktype)
+
+    rng = random.Random(args.seed)
+    scripts = []
+    for user in range(args.users):
+        chat_id = 100000 + user
+        language = rng.choice(args.languages)
+        scripts.append((chat_id, user_script(
+            texts, dynamodb, CONFIG, chat_id, language, args.clicks, rng,
+            args.inline)))
+
+    update_id = itertools.count(1)
+    latencies = []
+    webhook_latencies = []
+    per_step = {}
+    errors = Counter()
+
+    def handle_queued(update):
+        try:
+            return outlinebot.bot_handler(update, None)
+        except Exception as exc:
+            errors['{}: {}'.format(step, type(exc).__name__)] += 1
+            raise
+
+    started = time.perf_counter()
+    while scripts:
+        index = rng.randrange(len(scripts))
+        (chat_id, script) = scripts[index]
+        try:
+            (step, text) = next(script)
+        except StopIteration:
+            scripts.pop(index)
+            continue
+
+        if args.inline and step in CALLBACK_STEPS:
+            event = make_callback(next(update_id), chat_id, text)
+        else:
+            event = make_update(next(update_id), chat_id, text)
+        calls_before = (telegram_server.total(), api_server.total(), store.total())
+        tick = time.perf_counter()
+        try:
+            outlinebot.bot_handler(event, None)
+            if args.queue:
+                webhook_latencies.append(time.perf_counter() - tick)
+                # The next step of the script depends on this one, failed
+                # updates are retried until QUEUE_MAX_RECEIVES
+                while ingest.drain(handle_queued):
+                    pass
+        except Exception as exc:
+            errors['{}: {}'.format(step, type(exc).__name__)] += 1
+        latency = time.perf_counter() - tick
+        calls = (telegram_server.total() - calls_before[0],
+                 api_server.total() - calls_before[1],
+                 store.total() - calls_before[2])
+
+        latencies.append(latency)
+        stats = per_step.setdefault(step, {'count': 0, 'seconds': 0.0, 'calls': [0, 0, 0]})
+        stats['count'] += 1
+        stats['seconds'] += latency
+        for position, value in enumerate(calls):
+            stats['calls'][position] += value
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    count = len(latencies)
+    report = {
+        'updates': count,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(count / elapsed, 1) if elapsed else 0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'telegram_calls_per_update': round(telegram_server.total() / count, 3),
+        'api_calls_per_update': round(api_server.total() / count, 3),
+        'state_calls_per_update': round(store.total() / count, 3),
+        'calls': dict(telegram_server.calls + api_server.calls + store.calls),
+        'steps': {
+            step: {
+                'count': stats['count'],
+                'mean_ms': round(stats['seconds'] / stats['count'] * 1000, 3),
+                'telegram_calls': round(stats['calls'][0] / stats['count'], 3),
+                'api_calls': round(stats['calls'][1] / stats['count'], 3),
+                'state_calls': round(stats['calls'][2] / stats['count'], 3),
+            } for (step, stats) in per_step.items()
+        },
+        'errors': dict(errors),
+    }
+    if webhook_latencies:
+        webhook_latencies.sort()
+        report['webhook_p50_ms'] = round(percentile(webhook_latencies, 0.50) * 1000, 3)
+        report['webhook_p99_ms'] = round(percentile(webhook_latencies, 0.99) * 1000, 3)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--clicks', type=int, default=5,
+                        help='random home menu clicks per user after onboarding')
+    parser.add_argument('--backend', choices=['memory', 'sqlite'], default='memory')
+    parser.add_argument('--languages', nargs='+', default=['en'],
+                        help='e.g. en fa, languages need a name in SUPPORTED_LANGUAGES '
+                             'of lang.json and fail on empty translations')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    parser.add_argument('--trace', action='store_true',
+                        help='enable tracing, writes one summary line per update')
+    parser.add_argument('--inline', action='store_true',
+                        help='use inline keyboards, pick the language with a button')
+    parser.add_argument('--queue', action='store_true',
+                        help='enqueue updates in the webhook and handle them from '
+                             'an in-memory queue, reports the webhook latency too')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+        sys.exit(1 if report['errors'] else 0)
+
+    print('updates            {}'.format(report['updates']))
+    print('throughput         {} updates/s'.format(report['updates_per_second']))
+    print('latency p50/95/99  {} / {} / {} ms'.format(
+        report['p50_ms'], report['p95_ms'], report['p99_ms']))
+    if 'webhook_p50_ms' in report:
+        print('webhook p50/99     {} / {} ms'.format(
+            report['webhook_p50_ms'], report['webhook_p99_ms']))
+    print('calls per update   telegram {} api {} state {}'.format(
+        report['telegram_calls_per_update'],
+        report['api_calls_per_update'],
+        report['state_calls_per_update']))
+    print('')
+    print('{:<10} {:>7} {:>10} {:>9} {:>6} {:>6}'.format(
+        'step', 'count', 'mean ms', 'telegram', 'api', 'state'))
+    for (step, stats) in sorted(report['steps'].items()):
+        print('{:<10} {:>7} {:>10} {:>9} {:>6} {:>6}'.format(
+            step, stats['count'], stats['mean_ms'], stats['telegram_calls'],
+            stats['api_calls'], stats['state_calls']))
+    if report['errors']:
+        print('')
+        print('errors: {}'.format(report['errors']))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
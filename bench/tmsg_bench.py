@@ -0,0 +1,134 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Microbenchmark for TelegramMessage parsing and routing
+
+Measures, for every update type the bot accepts, how many updates per
+minute one core can parse, parse and split into command and argument,
+and parse and route to a handler the way bot_handler does (command
+first, then the localized menu text).
+
+Usage:
+    python bench/tmsg_bench.py --seconds 1 --min-rate 1000000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import harness
+
+SENDER = {
+    'id': 123456789,
+    'is_bot': False,
+    'first_name': 'Bench',
+    'username': 'bench_user',
+    'language_code': 'en'
+}
+CHAT = {'id': 123456789, 'type': 'private', 'first_name': 'Bench', 'username': 'bench_user'}
+
+
+def make_updates(menu_text):
+    """
+    One sample event for each update type
+    """
+    def event(update):
+        return {'lang': 'en', 'token': 'TOKEN', 'Input': update}
+
+    return {
+        'message_text': event({'update_id': 1, 'message': {
+            'message_id': 10, 'date': 1600000000, 'chat': CHAT, 'from': SENDER,
+            'text': menu_text}}),
+        'message_command': event({'update_id': 2, 'message': {
+            'message_id': 11, 'date': 1600000000, 'chat': CHAT, 'from': SENDER,
+            'text': '/start c3RhcnQ='}}),
+        'message_document': event({'update_id': 3, 'message': {
+            'message_id': 12, 'date': 1600000000, 'chat': CHAT, 'from': SENDER,
+            'document': {'file_id': 'BQACAgQAAxkBAAIB', 'file_name': 'users.csv',
+                         'mime_type': 'text/csv'}}}),
+        'edited_message': event({'update_id': 4, 'edited_message': {
+            'message_id': 13, 'date': 1600000000, 'edit_date': 1600000100,
+            'chat': CHAT, 'from': SENDER, 'text': menu_text}}),
+        'inline_query': event({'update_id': 5, 'inline_query': {
+            'id': '4711', 'from': SENDER, 'query': 'outline', 'offset': ''}}),
+        'callback_query': event({'update_id': 6, 'callback_query': {
+            'id': '4712', 'from': SENDER, 'data': 'l:en', 'chat_instance': '1',
+            'message': {'message_id': 14, 'date': 1600000000, 'chat': CHAT,
+                        'text': 'menu'}}}),
+    }
+
+
+def measure(function, seconds):
+    """
+    Calls function in batches until seconds have passed
+
+    :return: calls per minute
+    """
+    batch = 1000
+    calls = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while True:
+        for _ in range(batch):
+            function()
+        calls += batch
+        now = time.perf_counter()
+        if now >= deadline:
+            return calls / (now - started) * 60
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seconds', type=float, default=1.0,
+                        help='time spent on each measurement')
+    parser.add_argument('--min-rate', type=float, default=0,
+                        help='exit with an error if parse+route falls below this many updates/min')
+    args = parser.parse_args()
+
+    sandbox = harness.load_bot('telegram', {'LOG_LEVEL': 'WARNING'})
+    from tmsg import TelegramMessage
+    from settings import CONFIG
+
+    with open(os.path.join(sandbox, CONFIG['LANGUAGE_FILE'])) as lang_file:
+        texts = json.load(lang_file)
+    menu = {texts[name]['en']: name for name in texts
+            if name.startswith('MENU_') and isinstance(texts[name]['en'], str)}
+    commands = {CONFIG['TELEGRAM_START_COMMAND']: 'start',
+                CONFIG['TELEGRAM_ADMIN_COMMAND']: 'admin'}
+
+    def route(tmsg):
+        if tmsg.command:
+            return commands.get(tmsg.command)
+        return menu.get(tmsg.body)
+
+    updates = make_updates(texts['MENU_HOME_NEW_KEY']['en'])
+    slowest = None
+    print('{:<18} {:>16} {:>16}'.format('update', 'parse/min', 'parse+route/min'))
+    for (name, event) in updates.items():
+        parse_rate = measure(lambda: TelegramMessage(event, 'en'), args.seconds)
+        route_rate = measure(lambda: route(TelegramMessage(event, 'en')), args.seconds)
+        slowest = route_rate if slowest is None else min(slowest, route_rate)
+        print('{:<18} {:>16,.0f} {:>16,.0f}'.format(name, parse_rate, route_rate))
+
+    if args.min_rate and slowest < args.min_rate:
+        print('slowest update type is below {:,.0f} updates/min'.format(args.min_rate))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,9 @@ PROJECT_ROOT=`pwd`
 DIST_DIR_NAME="dist"
 DEPLOY_DIR_NAME="deploy"
 LAMBDA_CODE_FILE=lambda.zip
+# Python used for slim builds, must match the Lambda runtime
+PYTHON=${PYTHON:-python3.8}
+SLIM=0
 
 build() {
   echo "---------------------------"
@@ -56,12 +59,50 @@ build() {
   mkdir ${dist_path}/google
   touch ${dist_path}/google/__init__.py
 
+  if [ ${SLIM} -eq 1 ]; then
+      slim ${dist_path}
+  fi
+
   cd ${dist_path}
   zip -r ${PROJECT_ROOT}/${DEPLOY_DIR_NAME}/${LAMBDA_CODE_FILE} *
 
   ls -la ${PROJECT_ROOT}/${DEPLOY_DIR_NAME}/
   echo ${PROJECT_ROOT}/${DEPLOY_DIR_NAME}/${LAMBDA_CODE_FILE}
   cd ${PROJECT_ROOT}
+
+  if [ ${SLIM} -eq 1 ]; then
+      report ${dist_path}
+  fi
+}
+
+slim() {
+  echo "Slimming the bundle with ${PYTHON} ..."
+  if [ "$(${PYTHON} -c 'import sys; print(sys.version_info[:2] == (3, 8))')" != "True" ]; then
+      echo "Warning: ${PYTHON} is not Python 3.8, the Lambda runtime will ignore the .pyc files"
+  fi
+  ${PYTHON} ${PROJECT_ROOT}/tools/slim.py $1 ${HANDLER_MODULE} ${PROJECT_ROOT}/src/common
+}
+
+report() {
+  echo "-----------------"
+  echo "Slim build report"
+  echo "-----------------"
+  echo "Artifact size: $(du -h ${PROJECT_ROOT}/${DEPLOY_DIR_NAME}/${LAMBDA_CODE_FILE} | cut -f1)"
+  echo "Unpacked size: $(du -sh $1 | cut -f1)"
+  # Import the handler in fresh interpreters like a Lambda cold start
+  cd $1
+  ${PYTHON} - ${HANDLER_MODULE} <<'EOF_PYTHON'
+import statistics, subprocess, sys, time
+runs = []
+for _ in range(5):
+    started = time.perf_counter()
+    if subprocess.run([sys.executable, '-c', 'import ' + sys.argv[1]]).returncode:
+        sys.exit('Cold start not measured, the handler needs boto3 installed locally')
+    runs.append((time.perf_counter() - started) * 1000)
+print('Cold start (interpreter + import {}): {:.0f} ms median of 5'.format(
+    sys.argv[1], statistics.median(runs)))
+EOF_PYTHON
+  cd ${PROJECT_ROOT}
 }
 
 options() {
@@ -74,6 +115,10 @@ options() {
   echo "-e | --email  : Build email responder code"
   echo "-t | --telegram : Build telegram bot code"
   echo ""
+  echo "Add --slim after the option to drop unused modules and package"
+  echo "metadata, precompile the bundle and report its size and cold-start time."
+  echo "PYTHON selects the interpreter for slim builds (default python3.8)."
+  echo ""
 }
 
 echo "---------------------------------------"
@@ -87,16 +132,21 @@ then
   exit 1
 else
   key="$1"
+  if [ "$2" == "--slim" ]; then
+      SLIM=1
+  fi
   case $key in
       -t|--telegram)
       source ./env_telegram.sh
       SCRIPT_DIR_NAME="telegram"
+      HANDLER_MODULE="outlinebot"
       build
       exit 0
       ;;
       -e|--email)
       source ./env_email.sh
       SCRIPT_DIR_NAME="email"
+      HANDLER_MODULE="responder"
       build
       exit 0
       ;;
@@ -8,6 +8,8 @@ export AWS_ACCESS_USER_NAME=
 export AWS_POLICY_NAME=
 export AWS_LAMBDA_ROLE=
 export AWS_LAMBDA_FUNCTION=
+# Table remembering handled SES message ids, leave empty to disable
+export AWS_DEDUPE_DYNAMODB_TABLE=
 
 ### Build phase env vars
 # Example: API_URL=https://URL/api/v1
@@ -16,6 +18,9 @@ export API_KEY=
 # Example: EMAIL_DOMAIN=mydomain.com
 export EMAIL_DOMAIN=
 
+# DO NOT CHANGE:
+export AWS_DEDUPE_DYNAMO_TABLE=${AWS_DEDUPE_DYNAMODB_TABLE}
+
 ### Install phase env vars
 # DO NOT CHANGE:
 export LAMBDA_FUNCTION_NAME=${AWS_LAMBDA_FUNCTION}
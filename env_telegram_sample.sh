@@ -12,6 +12,8 @@ export AWS_REGION=
 export AWS_ACCESS_USER_NAME=
 export AWS_DYNAMODB_TABLE=
 export AWS_INFO_DYNAMODB_TABLE=
+# URL of the SQS FIFO queue used when INGESTION_MODE is 'queue', optional
+export AWS_SQS_QUEUE_URL=
 export AWS_POLICY_NAME=
 export AWS_LAMBDA_ROLE=
 export AWS_LAMBDA_FUNCTION=
@@ -36,6 +38,14 @@ export API_KEY=
 # should have access to the /admin command within the Telegram bot.
 # Example: ADMIN_LIST="['$TELEGRAM_ID_OF_USER1', '$TELEGRAM_ID_OF_USER2']"
 export ADMIN_LIST=
+# Shared secret the outline-distribution server signs server status updates
+# with, leave empty to ignore them.
+# Example: SERVER_WEBHOOK_SECRET=$(openssl rand -hex 32)
+export SERVER_WEBHOOK_SECRET=
+# Secret used to name the chat state items. Set it once and never change it,
+# a new secret loses the state of every chat.
+# Example: CHAT_KEY_SECRET=$(openssl rand -hex 32)
+export CHAT_KEY_SECRET=
 
 # DO NOT CHANGE:
 export AWS_DYNAMO_TABLE=${AWS_DYNAMODB_TABLE}
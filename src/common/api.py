@@ -14,12 +14,61 @@
 
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
 import requests
+from breaker import CircuitBreaker
 from settings import CONFIG
+import tracing
 
 logger = logging.getLogger()
 USER_AGENT = 'Outline Telegram Bot'
 AUTHORIZATION_HEADER = 'Token {}'
+# API calls in flight at once for bulk operations
+BULK_WORKERS = 8
+# Seconds to wait for a connection, the read timeout is CONFIG['API_TIMEOUT']
+CONNECT_TIMEOUT = 3.05
+
+breaker = CircuitBreaker(
+    'API server',
+    failure_threshold=CONFIG.get('API_BREAKER_FAILURES', 5),
+    reset_timeout=CONFIG.get('API_BREAKER_RESET', 30),
+    slow_call=CONFIG.get('API_SLOW_CALL', 5))
+
+
+def _request(operation, method, url, **kwargs):
+    """
+    Call the API server, timed as one operation of the update trace
+
+    Connection errors, timeouts, 5xx responses and slow calls count as
+    failures of the circuit breaker.
+
+    :param operation: name of the calling function
+    :param method: HTTP method
+    :param url: API url
+    :param kwargs: arguments for requests.request
+    :return: requests Response
+    :raise: CircuitOpenError: the API server is failing, nothing was sent
+    """
+    breaker.before_call()
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, CONFIG.get('API_TIMEOUT', 10)))
+    started = time.monotonic()
+    try:
+        with tracing.span('api.' + operation) as span:
+            response = requests.request(method, url, **kwargs)
+            span.response(response)
+    except Exception:
+        breaker.record(False)
+        raise
+    breaker.record(response.status_code < 500, time.monotonic() - started)
+    return response
+
+
+def available():
+    """
+    :return: False while the circuit breaker refuses API calls
+    """
+    return not breaker.is_open()
 
 
 def get_enrolled_users(blocked=False):
@@ -39,9 +88,9 @@ def get_enrolled_users(blocked=False):
         'Authorization': AUTHORIZATION_HEADER.format(CONFIG['API_KEY'])}
     
     try:
-        req = requests.get(url, headers=headers)
+        req = _request('get_enrolled_users', 'get', url, headers=headers)
     except Exception as error:
-        logger.error('get_enrolled_users error: {}'.format(error))
+        logger.error('get_enrolled_users error: %s', error)
         raise error
     if req.status_code == requests.codes['ok']:
         return req.text
@@ -67,9 +116,9 @@ def get_banned_users():
         'Authorization': AUTHORIZATION_HEADER.format(CONFIG['API_KEY'])}
     
     try:
-        req = requests.get(url, headers=headers)
+        req = _request('get_banned_users', 'get', url, headers=headers)
     except Exception as error:
-        logger.error('get_enrolled_users error: {}'.format(error))
+        logger.error('get_enrolled_users error: %s', error)
         raise error
     if req.status_code == requests.codes['ok']:
         return req.text
@@ -87,7 +136,7 @@ def ban_user(username):
     :param username: Telegram username
     :return: User's json object or None in case of success and raise error otherwise
     """
-    logger.info("banning user from api server: {}".format(username))
+    logger.info("banning user from api server: %s", username)
     url = '{}/distribution/user'.format(CONFIG['API_URL'])
     headers = {
         'User-Agent': USER_AGENT,
@@ -97,9 +146,9 @@ def ban_user(username):
         'banned': True
     }
     try:
-        req = requests.patch(url, json=data, headers=headers)
+        req = _request('ban_user', 'patch', url, json=data, headers=headers)
     except Exception as error:
-        logger.error('ban_user error: {}'.format(error))
+        logger.error('ban_user error: %s', error)
         raise error
     if req.status_code == requests.codes['ok']:
         json_data = json.loads(req.text)
@@ -114,6 +163,31 @@ def ban_user(username):
         req.raise_for_status()
 
 
+def ban_users(usernames, workers=BULK_WORKERS, progress=None):
+    """
+    Bans many users with a bounded number of concurrent API calls
+
+    :param usernames: List of Telegram usernames
+    :param workers: Maximum number of API calls in flight
+    :param progress: Called with (done, total) each time a call finishes
+    :return: List of (username, status) in the order of usernames, status
+        is 'banned', 'not_found' or 'error'
+    """
+    statuses = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(ban_user, username): username
+            for username in usernames}
+        for future in as_completed(futures):
+            try:
+                statuses[futures[future]] = 'banned' if future.result() else 'not_found'
+            except Exception:
+                statuses[futures[future]] = 'error'
+            if progress is not None:
+                progress(len(statuses), len(futures))
+    return [(username, statuses[username]) for username in usernames]
+
+
 def get_user(user_id):
     """
     Getting user information from server
@@ -121,16 +195,16 @@ def get_user(user_id):
     :param user_id: Telegram User ID
     :return: User's json object or None in case of success and raise error otherwise
     """
-    logger.info("getting user info from api server: {}".format(user_id))
+    logger.info("getting user info from api server: %s", user_id)
     url = '{}/distribution/user/{}'.format(CONFIG['API_URL'], str(user_id))
     headers = {
         'User-Agent': USER_AGENT,
         'Authorization': AUTHORIZATION_HEADER.format(CONFIG['API_KEY'])}
     
     try:
-        req = requests.get(url, headers=headers)
+        req = _request('get_user', 'get', url, headers=headers)
     except Exception as error:
-        logger.error('get_user error: {}'.format(error))
+        logger.error('get_user error: %s', error)
         raise error
     if req.status_code == requests.codes['ok']:
         json_data = json.loads(req.text)
@@ -153,7 +227,7 @@ def create_user(user_id, channel='TG'):
     :param channel: What platform user is using to get a key, default Telegram
     :return: User's json object in case of success and None otherwise
     """
-    logger.info("Creating new user: {}".format(user_id))
+    logger.info("Creating new user: %s", user_id)
     url = '{}/distribution/user'.format(CONFIG['API_URL'])
     headers = {
         'User-Agent': USER_AGENT,
@@ -164,9 +238,9 @@ def create_user(user_id, channel='TG'):
     }
 
     try:
-        req = requests.put(url, json=data, headers=headers)
+        req = _request('create_user', 'put', url, json=data, headers=headers)
     except Exception as error:
-        logger.error('create_user error: {}'.format(error))
+        logger.error('create_user error: %s', error)
         raise error
     if req.status_code == requests.codes['ok']:
         json_data = json.loads(req.text)
@@ -176,7 +250,7 @@ def create_user(user_id, channel='TG'):
         return None
     elif req.status_code == requests.codes['conflict']:
         logger.error(
-            'Bad request, Username already exists: {}'.format(user_id))
+            'Bad request, Username already exists: %s', user_id)
         return None
     else:
         logger.error(
@@ -192,16 +266,15 @@ def get_outline_server_info(server_id):
     :param user_id: VPN Server ID
     :return: User's json object in case of success and None otherwise
     """
-    logger.info("Get outline server info {}".format(str(server_id)))
+    logger.info("Get outline server info %s", server_id)
     url = '{}/server/outlineserver/{}'.format(CONFIG['API_URL'], server_id)
-    print(url)
     headers = {
         'User-Agent': USER_AGENT,
         'Authorization': AUTHORIZATION_HEADER.format(CONFIG['API_KEY'])}
     try:
-        req = requests.get(url, headers=headers)
+        req = _request('get_outline_server_info', 'get', url, headers=headers)
     except Exception as error:
-        logger.error('get_outline_server_info error: {}'.format(error))
+        logger.error('get_outline_server_info error: %s', error)
         raise error
 
     if req.status_code == requests.codes['ok']:
@@ -224,15 +297,15 @@ def get_outline_user(user_id):
     :param user_id: Telegram User ID
     :return: User's json object in case of success and None otherwise
     """
-    logger.info("Get/update outline user info {}".format(user_id))
+    logger.info("Get/update outline user info %s", user_id)
     url = '{}/distribution/outline/{}'.format(CONFIG['API_URL'], user_id)
     headers = {
         'User-Agent': USER_AGENT,
         'Authorization': AUTHORIZATION_HEADER.format(CONFIG['API_KEY'])}
     try:
-        req = requests.get(url, headers=headers)
+        req = _request('get_outline_user', 'get', url, headers=headers)
     except Exception as error:
-        logger.error('get_outline_user error: {}'.format(error))
+        logger.error('get_outline_user error: %s', error)
         raise error
     if req.status_code == requests.codes['ok']:
         json_data = json.loads(req.text)
@@ -255,9 +328,8 @@ def get_new_key(user_id, user_issue=None):
     :param user_issue: Issue ID
     :return: User's json object in case of success and None otherwise
     """
-    logger.info("Get a new key for {}".format(user_id))
+    logger.info("Get a new key for %s", user_id)
     url = '{}/distribution/outline'.format(CONFIG['API_URL'])
-    print(url)
     headers = {
         'User-Agent': USER_AGENT,
         'Authorization': AUTHORIZATION_HEADER.format(CONFIG['API_KEY'])}
@@ -268,9 +340,9 @@ def get_new_key(user_id, user_issue=None):
         data['user_issue'] = int(user_issue)
 
     try:
-        req = requests.put(url, json=data, headers=headers)
+        req = _request('get_new_key', 'put', url, json=data, headers=headers)
     except Exception as error:
-        logger.error('get_new_key error: {}'.format(error))
+        logger.error('get_new_key error: %s', error)
         raise error
 
     if req.status_code == requests.codes['ok']:
@@ -293,7 +365,7 @@ def get_outline_sever_id(user_id):
     :param user_id: Telegram User ID
     :return: User's json object in case of success and None otherwise
     """
-    logger.info("Get outline server id for user: {}".format(user_id))
+    logger.info("Get outline server id for user: %s", user_id)
     user = get_outline_user(user_id)
     if user is not None:
         return user['server']
@@ -307,7 +379,7 @@ def get_key(user_id, user_issue=None):
     :param user_issue: Issue ID
     :return: User's json object in case of success and None otherwise
     """
-    logger.info("Get new Outline key for user: {}".format(user_id))
+    logger.info("Get new Outline key for user: %s", user_id)
     user = get_outline_user(user_id, user_issue)
     if user is not None:
         return user['outline_key']
@@ -331,9 +403,9 @@ def delete_user(user_id):
     }
 
     try:
-        req = requests.delete(url, json=data, headers=headers)
+        req = _request('delete_user', 'delete', url, json=data, headers=headers)
     except Exception as error:
-        logger.error('delete_user error: {}'.format(error))
+        logger.error('delete_user error: %s', error)
         raise error
     if req.status_code == requests.codes['no_content']:
         return True
@@ -360,9 +432,9 @@ def get_issues(lang):
         'User-Agent': USER_AGENT,
         'Authorization': AUTHORIZATION_HEADER.format(CONFIG['API_KEY'])}
     try:
-        req = requests.get(url, headers=headers)
+        req = _request('get_issues', 'get', url, headers=headers)
     except Exception as error:
-        logger.error('get_user error: {}'.format(error))
+        logger.error('get_user error: %s', error)
         raise error
 
     lang_pattern = '_{}'.format(lang)
@@ -404,9 +476,9 @@ def users(banned=False):
         'User-Agent': USER_AGENT,
         'Authorization': API_PREFIX.format(CONFIG['API_KEY'])}
     try:
-        req = requests.get(url, headers=headers)
+        req = _request('users', 'get', url, headers=headers)
     except Exception as error:
-        logger.error('all_users error: {}'.format(error))
+        logger.error('all_users error: %s', error)
         raise
 
     if req.status_code == requests.codes['ok']:
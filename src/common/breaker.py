@@ -0,0 +1,127 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Circuit Breaker Module
+Fails calls to an unhealthy server fast instead of waiting on it
+
+The breaker opens after a number of consecutive failures, a call slower
+than the slow call limit counts as a failure. While open every call is
+refused with CircuitOpenError. Once the reset timeout has passed one
+probe call is let through (half-open), it closes the breaker when it
+succeeds and opens it again when it fails.
+
+The state lives in the process, so each warm Lambda container learns
+about an outage on its own after a few failed calls.
+"""
+
+import threading
+import time
+from errors import CircuitOpenError
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the health of one server
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30,
+                 slow_call=None, clock=time.monotonic):
+        """
+        :param name: server name used in error messages
+        :param failure_threshold: consecutive failures that open the breaker
+        :param reset_timeout: seconds the breaker stays open before a probe
+        :param slow_call: seconds after which a successful call counts
+            as a failure, None to ignore latency
+        :param clock: function returning seconds, for tests
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call = slow_call
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        """
+        :return: CLOSED, OPEN or HALF_OPEN
+        """
+        with self._lock:
+            if (self._state == OPEN
+                    and self._clock() - self._opened_at >= self.reset_timeout):
+                return HALF_OPEN
+            return self._state
+
+    def is_open(self):
+        """
+        :return: True if calls are currently refused
+        """
+        return self.state == OPEN
+
+    def before_call(self):
+        """
+        Checks a call may go ahead, call it right before the request
+
+        :raise: CircuitOpenError: the breaker is open or a probe is running
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return
+            if (self._state == OPEN
+                    and self._clock() - self._opened_at >= self.reset_timeout):
+                self._state = HALF_OPEN
+            if self._state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+        raise CircuitOpenError('{} is unavailable'.format(self.name))
+
+    def record(self, success, elapsed=None):
+        """
+        Records the result of a call let through by before_call
+
+        :param success: False if the call failed
+        :param elapsed: seconds the call took
+        """
+        if (success and elapsed is not None and self.slow_call is not None
+                and elapsed > self.slow_call):
+            success = False
+        with self._lock:
+            self._probing = False
+            if success:
+                self._state = CLOSED
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = OPEN
+                self._opened_at = self._clock()
+
+    def reset(self):
+        """
+        Closes the breaker and forgets past failures
+        """
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
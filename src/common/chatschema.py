@@ -0,0 +1,123 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Chat Item Schema
+Layout of the chat state items, shared by dynamodb.py and the
+migration tool, so it does not read the settings
+
+v1: chat_id is the 128 character SHA-512 hex of the Telegram chat id,
+    'status' a string, 'language' a string, 'captcha' a list of two
+    number strings.
+v2: chat_id is the HMAC-SHA256 of the v1 key with a secret, cut to 16
+    bytes and base64url encoded in 22 characters. 's' is the status as
+    a number, 'l' the language, 'c' the two captcha numbers packed in
+    one number, 'w' the version of the last write and 'expires_at' the
+    TTL of unfinished onboarding.
+
+The v2 key is derived from the v1 key so stored v1 items can be
+migrated without knowing any chat id.
+"""
+
+import base64
+import hashlib
+import hmac
+
+V1_KEY_LENGTH = 128
+V2_KEY_BYTES = 16
+# Captcha numbers are below this, the first one is stored times it
+CAPTCHA_BASE = 100
+
+STATUS = 's'
+LANGUAGE = 'l'
+CAPTCHA = 'c'
+VERSION = 'w'
+
+
+def v1_key(chat_id):
+    """
+    :param chat_id: Telegram Chat ID
+    :return: v1 partition key
+    """
+    return hashlib.sha512(str(chat_id).encode('utf-8')).hexdigest()
+
+
+def v2_key(key, secret):
+    """
+    :param key: v1 partition key
+    :param secret: secret of the keyed hash, must never change
+    :return: v2 partition key
+    """
+    digest = hmac.new(
+        secret.encode('utf-8'), key.encode('utf-8'), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:V2_KEY_BYTES]).decode('ascii').rstrip('=')
+
+
+def is_v1_key(key):
+    """
+    :param key: partition key of a chat item
+    :return: True for a v1 key
+    """
+    return len(key) == V1_KEY_LENGTH
+
+
+def pack_captcha(choices):
+    """
+    :param choices: the two captcha numbers, as numbers or strings
+    :return: both numbers in one
+    """
+    return int(choices[0]) * CAPTCHA_BASE + int(choices[1])
+
+
+def unpack_captcha(value):
+    """
+    :param value: number from pack_captcha()
+    :return: the two captcha numbers as strings, the v1 format
+    """
+    (first, second) = divmod(int(value), CAPTCHA_BASE)
+    return [str(first), str(second)]
+
+
+def from_v1(item):
+    """
+    Converts the attributes of a v1 item, the key is left out
+
+    :param item: v1 item
+    :return: Dictionary of v2 attributes
+    """
+    attributes = {}
+    if 'status' in item:
+        attributes[STATUS] = int(item['status'])
+    if 'language' in item:
+        attributes[LANGUAGE] = str(item['language'])
+    if item.get('captcha'):
+        attributes[CAPTCHA] = pack_captcha(item['captcha'])
+    return attributes
+
+
+def decode(item):
+    """
+    Reads the chat state of a v2 item
+
+    :param item: v2 item
+    :return: Dictionary with status (int), language, captcha (list of
+        two strings) and version (int), None for attributes the item
+        does not have
+    """
+    return {
+        'status': int(item[STATUS]) if STATUS in item else None,
+        'language': item.get(LANGUAGE),
+        'captcha': unpack_captcha(item[CAPTCHA]) if CAPTCHA in item else None,
+        'version': int(item[VERSION]) if VERSION in item else None
+    }
@@ -13,12 +13,33 @@
 # limitations under the License.
 
 import logging
-import boto3
-import hashlib
-from botocore.exceptions import ClientError
+import time
+import chatschema
+from errors import DBError, StateConflict
+from settings import CONFIG
+from statestore import TTL_ATTRIBUTE, get_store
 
 logger = logging.getLogger()
 
+# Chat ids whose item key and last write version are remembered, a warm
+# container serves few chats
+CHAT_KEY_CACHE_SIZE = 1024
+
+# Info table partition holding the Telegram file_ids of S3 files
+FILE_ID_PARTITION = '_file_id'
+# Info table partition holding the usage counters, one item per time bucket
+STATS_PARTITION = '_stats'
+# Info table partition caching the blocked flag of the Outline servers
+SERVER_PARTITION = '_server'
+
+_chat_keys = {}
+# Version of the last write of this process to each chat item, STALE
+# after a write of another process was detected
+_chat_versions = {}
+STALE = float('inf')
+_last_version = 0
+
+
 def save_info_link(
         table,
         link,
@@ -33,21 +54,16 @@ def save_info_link(
     :param linktype: What is the nature of link to save
     :return: True in case of success and False otherwise
     """
-    resource = boto3.resource('dynamodb')
-    ddtable = resource.Table(table)
     try:
-        ddtable.update_item(
-            Key={
+        get_store().update_item(
+            table,
+            {
                 'language': language,
                 'linktype': linktype
             },
-            UpdateExpression='SET link = :element',
-            ExpressionAttributeValues={
-                ':element': link
-            })
-    except ClientError as error:
-        logger.error(
-            '[save_info_link] Unable to write to {}: {}'.format(table, str(error)))
+            {'link': link})
+    except DBError as error:
+        logger.error('[save_info_link] %s', error)
         return False
 
     return True
@@ -56,7 +72,8 @@ def save_info_link(
 def get_info_link(
     table,
     language,
-    linktype):
+    linktype,
+    consistent=False):
     """
     Retrieves the status of chat that is saved in the
     DB.
@@ -64,189 +81,252 @@ def get_info_link(
     :param table: DynamoDB Table Name
     :param language: User's preferred language
     :param linktype: What is the nature of link to return
+    :param consistent: Use a strongly consistent read
     :return: Link or None in case of error
     """
-    resource = boto3.resource('dynamodb')
-    ddtable = resource.Table(table)
     try:
-        result = ddtable.get_item(
-            ConsistentRead=True,
-            Key={
+        item = get_store().get_item(
+            table,
+            {
                 'language': language,
                 'linktype': linktype
-            })
-    except ClientError as error:
-        logger.error(
-            '[get_info_link] Unable to read from {}: {}'.format(table, str(error)))
+            },
+            consistent=consistent)
+    except DBError as error:
+        logger.error('[get_info_link] %s', error)
         return None
 
-    logger.info('Result from Query is {}'.format(str(result)))
+    logger.debug('Result from Query is %s', item)
 
-    if 'Item' not in result:
+    if item is None:
         return None
 
-    if len(result['Item']) == 0:
-        return None
+    return item['link']
 
-    return result['Item']['link']
 
+def _chat_key(chat_id):
+    """
+    :param chat_id: Telegram Chat ID
+    :return: Key of the chat item in the schema items are written in
+    """
+    key = _chat_keys.get(chat_id)
+    if key is None:
+        secret = CONFIG.get('CHAT_KEY_SECRET', '')
+        # An unset variable is left as '$CHAT_KEY_SECRET' by envsubst
+        if secret.startswith('$'):
+            secret = ''
+        key = chatschema.v2_key(chatschema.v1_key(chat_id), secret)
+        if len(_chat_keys) >= CHAT_KEY_CACHE_SIZE:
+            _chat_keys.clear()
+        _chat_keys[chat_id] = key
+    return {'chat_id': key}
+
+
+def _next_version():
+    """
+    :return: Version of a write to a chat item, microseconds since epoch
+        and increasing within the process
+    """
+    global _last_version
+    _last_version = max(int(time.time() * 1000000), _last_version + 1)
+    return _last_version
 
-def save_user_lang(
-        table,
-        chat_id,
-        language):
+
+def _written(key, version):
     """
-    Save the users' preferred language to the DB
+    Remembers the version of a successful write to a chat item, later
+    reads of this process must not return anything older
 
-    :param table: DynamoDB Table Name
-    :param user_id: Telegram User ID
-    :param chat_id: Telegram Chat ID
-    :param language: User's preferred language
-    :return: True in case of success and False otherwise
+    :param key: Key of the chat item
+    :param version: Version from _next_version()
     """
-    chat_hash = hashlib.sha512(str(chat_id).encode('utf-8')).hexdigest()
+    if len(_chat_versions) >= CHAT_KEY_CACHE_SIZE:
+        _chat_versions.clear()
+    _chat_versions[key['chat_id']] = version
 
-    resource = boto3.resource('dynamodb')
-    ddtable = resource.Table(table)
-    try:
-        ddtable.update_item(
-            Key={
-                'chat_id': str(chat_hash)
-            },
-            UpdateExpression='SET #lang = :element',
-            ExpressionAttributeValues={
-                ':element': str(language)},
-            ExpressionAttributeNames={
-                "#lang": "language"
-            })
-    except ClientError as error:
-        logger.error(
-            '[save_user_lang] Unable to read from {}: {}'.format(table, str(error)))
-        return False
 
-    return True
+def _read_chat(table, chat_id, consistent=False):
+    """
+    Reads the state of a chat from a v2 item, or from its v1 item which
+    is then copied to a v2 item so later writes find it
+
+    Eventually consistent reads cost half the capacity. When such a read
+    returns an item older than the last write of this process to it,
+    the item is read again with a strongly consistent read.
+
+    :param table: DynamoDB Table Name
+    :param chat_id: Telegram Chat ID
+    :param consistent: Always use a strongly consistent read
+    :return: Dictionary from chatschema.decode() or None if the chat is unknown
+    :raise: DBError: read failed
+    """
+    key = _chat_key(chat_id)
+    item = get_store().get_item(table, key, consistent=consistent)
+    written = _chat_versions.get(key['chat_id'])
+    if (not consistent and written is not None
+            and (item is None or int(item.get(chatschema.VERSION, 0)) < written)):
+        logger.debug('Stale read of chat %s, reading it again', chat_id)
+        item = get_store().get_item(table, key, consistent=True)
+        if written == STALE:
+            _chat_versions.pop(key['chat_id'], None)
+    if item is None and CONFIG.get('CHAT_SCHEMA_V1_READS', True):
+        old = get_store().get_item(table, {'chat_id': chatschema.v1_key(chat_id)})
+        if old is not None:
+            item = chatschema.from_v1(old)
+            get_store().put_item(table, key, item, if_absent=True)
+    if item is None:
+        return None
+    return chatschema.decode(item)
 
 
 def create_chat_status(
         table,
         chat_id,
-        status):
+        status,
+        ttl=None):
     """
-    Save the users' preferred language to the DB
+    Creates the state of a new chat
 
     :param table: DynamoDB Table Name
-    :param user_id: Telegram User ID
     :param chat_id: Telegram Chat ID
     :param status: chat status
-    :return: True in case of success and False otherwise
+    :param ttl: Number of seconds the chat is kept unless its status
+        is saved with ttl=0
+    :return: Version of the new item or None in case of failure
+    :raise: StateConflict: another update created the chat first
     """
-    chat_hash = hashlib.sha512(str(chat_id).encode('utf-8')).hexdigest()
-
-    resource = boto3.resource('dynamodb')
-    ddtable = resource.Table(table)
-
+    values = {
+        chatschema.STATUS: int(status),
+        chatschema.LANGUAGE: 'en',
+        chatschema.CAPTCHA: chatschema.pack_captcha([1, 2])
+    }
+    if ttl:
+        values[TTL_ATTRIBUTE] = int(time.time()) + int(ttl)
+    values[chatschema.VERSION] = _next_version()
+    key = _chat_key(chat_id)
     try:
-        result = ddtable.get_item(
-            ConsistentRead=True,
-            Key={
-                'chat_id': str(chat_hash)
-            })
-    except ClientError as error:
-        logger.error(
-            '[get_chat_status] Unable to read from {}: {}'.format(table, str(error)))
+        created = get_store().put_item(
+            table,
+            key,
+            values,
+            if_absent=True)
+    except DBError as error:
+        logger.error('[create_chat_status] %s', error)
         return None
 
-    if 'Item' not in result:
-        try:
-            ddtable.put_item(
-                Item={
-                    'chat_id': str(chat_hash),
-                    'status': str(status),
-                    'language': 'en',
-                    'captcha': ['1', '2']})
-        except ClientError as error:
-            logger.error(
-                '[create_chat_status] Unable to write to {}: {}'.format(table, str(error)))
-            return False
-        return True
-
-    saved = save_chat_status(table, chat_id, status)
-    if saved:
-        return True
-    return False
+    if not created:
+        _chat_versions[key['chat_id']] = STALE
+        raise StateConflict('Chat was created before it was set to {}'.format(status))
+    _written(key, values[chatschema.VERSION])
+    return values[chatschema.VERSION]
 
 
 def save_chat_status(
         table,
         chat_id,
-        status):
+        status,
+        ttl=None):
     """
-    Retrieves the status of chat that is saved in the
-    DB and add a list of captcha choices.
+    Saves the status of a chat
 
     :param table: DynamoDB Table Name
     :param chat_id: Telegram Chat ID
     :param status: chat status
+    :param ttl: Number of seconds the chat is kept from now on, 0 to
+        keep it forever, None to leave its expiry as it is
     :return: True or False in case of failure
     """
-    chat_hash = hashlib.sha512(str(chat_id).encode('utf-8')).hexdigest()
-
-    resource = boto3.resource('dynamodb')
-    ddtable = resource.Table(table)
     try:
-        ddtable.update_item(
-            Key={
-                'chat_id': str(chat_hash)
-            },
-            UpdateExpression='SET #st = :val',
-            ExpressionAttributeValues={
-                ':val': str(status)
-            },
-            ExpressionAttributeNames={
-                "#st": "status"
-            })
-    except ClientError as error:
-        logger.error(
-            '[save_chat_status] Unable to read from {}: {}'.format(table, str(error)))
+        _save_status(table, chat_id, status, ttl)
+    except DBError as error:
+        logger.error('[save_chat_status] %s', error)
         return False
 
     return True
 
 
-def get_chat_status(
+def transition_chat_status(
         table,
-        chat_id):
+        chat_id,
+        version,
+        status,
+        ttl=None):
     """
-    Retrieves the status of chat that is saved in the
-    DB.
+    Moves a chat to a new status, unless another update wrote to the
+    chat since it was read
 
     :param table: DynamoDB Table Name
-    :param user_id: Telegram User ID
     :param chat_id: Telegram Chat ID
-    :return: chat status or None in case of error
+    :param version: version the chat item was read in, None for an
+        item without one
+    :param status: chat status
+    :param ttl: Number of seconds the chat is kept from now on, 0 to
+        keep it forever, None to leave its expiry as it is
+    :return: Version of the write or None in case of failure
+    :raise: StateConflict: the chat item is no longer in that version
     """
-    chat_hash = hashlib.sha512(str(chat_id).encode('utf-8')).hexdigest()
-
-    resource = boto3.resource('dynamodb')
-    ddtable = resource.Table(table)
+    condition = {chatschema.VERSION: None if version is None else int(version)}
     try:
-        result = ddtable.get_item(
-            ConsistentRead=True,
-            Key={
-                'chat_id': str(chat_hash)
-            })
-    except ClientError as error:
-        logger.error(
-            '[get_chat_status] Unable to read from {}: {}'.format(table, str(error)))
+        written = _save_status(table, chat_id, status, ttl, condition)
+    except DBError as error:
+        logger.error('[transition_chat_status] %s', error)
         return None
 
-    if 'Item' not in result:
-        return None
+    if written is None:
+        # The next read has to see the write of the other update
+        _chat_versions[_chat_key(chat_id)['chat_id']] = STALE
+        raise StateConflict('Chat changed after version {} before it was set to {}'.format(
+            version, status))
+    return written
+
 
-    if len(result['Item']) == 0:
+def _save_status(table, chat_id, status, ttl, condition=None):
+    """
+    Writes the status of a chat
+
+    :param condition: Attribute values the item must have, if any
+    :return: Version of the write, None if the condition failed
+    :raise: DBError: write failed
+    """
+    values = {chatschema.STATUS: int(status)}
+    remove = ()
+    if ttl:
+        values[TTL_ATTRIBUTE] = int(time.time()) + int(ttl)
+    elif ttl is not None:
+        remove = (TTL_ATTRIBUTE,)
+    values[chatschema.VERSION] = _next_version()
+    key = _chat_key(chat_id)
+    if not get_store().update_item(table, key, values, remove, condition):
         return None
 
-    return result['Item']['status']
+    _written(key, values[chatschema.VERSION])
+    return values[chatschema.VERSION]
+
+
+def get_chat_status(
+        table,
+        chat_id,
+        consistent=False):
+    """
+    Retrieves the status of chat that is saved in the
+    DB, with the version of the item to make transitions from
+
+    :param table: DynamoDB Table Name
+    :param chat_id: Telegram Chat ID
+    :param consistent: Use a strongly consistent read
+    :return: (chat status, version), None for either if unknown or in
+        case of error
+    """
+    try:
+        chat = _read_chat(table, chat_id, consistent)
+    except DBError as error:
+        logger.error('[get_chat_status] %s', error)
+        return (None, None)
+
+    if chat is None:
+        return (None, None)
+
+    return (chat['status'], chat['version'])
 
 
 def save_user_lang(
@@ -257,69 +337,49 @@ def save_user_lang(
     Save the users' preferred language to the DB
 
     :param table: DynamoDB Table Name
-    :param user_id: Telegram User ID
     :param chat_id: Telegram Chat ID
     :param language: User's preferred language
     :return: True in case of success and False otherwise
     """
-    chat_hash = hashlib.sha512(str(chat_id).encode('utf-8')).hexdigest()
-
-    resource = boto3.resource('dynamodb')
-    ddtable = resource.Table(table)
+    values = {
+        chatschema.LANGUAGE: str(language),
+        chatschema.VERSION: _next_version()
+    }
+    key = _chat_key(chat_id)
     try:
-        ddtable.update_item(
-            Key={
-                'chat_id': str(chat_hash)
-            },
-            UpdateExpression='SET #lang = :element',
-            ExpressionAttributeValues={
-                ':element': str(language)},
-            ExpressionAttributeNames={
-                "#lang": "language"
-            })
-    except ClientError as error:
-        logger.error(
-            '[save_user_lang] Unable to read from {}: {}'.format(table, str(error)))
+        get_store().update_item(table, key, values)
+    except DBError as error:
+        logger.error('[save_user_lang] %s', error)
         return False
 
+    _written(key, values[chatschema.VERSION])
     return True
 
 
 def get_user_lang(
         table,
-        chat_id):
+        chat_id,
+        consistent=False):
     """
-    Retrieves the status of chat that is saved in the DB.
+    Retrieves the preferred language of a chat
 
     :param table: DynamoDB Table Name
-    :param user_id: Telegram User ID
     :param chat_id: Telegram Chat ID
+    :param consistent: Use a strongly consistent read
     :return: Language or None in case of error
     """
-    chat_hash = hashlib.sha512(str(chat_id).encode('utf-8')).hexdigest()
-
-    resource = boto3.resource('dynamodb')
-    ddtable = resource.Table(table)
     try:
-        result = ddtable.get_item(
-            ConsistentRead=True,
-            Key={
-                'chat_id': str(chat_hash)
-            })
-    except ClientError as error:
-        logger.error(
-            '[get_user_lang] Unable to read from {}: {}'.format(table, str(error)))
+        chat = _read_chat(table, chat_id, consistent)
+    except DBError as error:
+        logger.error('[get_user_lang] %s', error)
         return None
 
-    logger.info('Result from Query is {}'.format(str(result)))
-
-    if 'Item' not in result:
-        return None
+    logger.debug('Chat state is %s', chat)
 
-    if len(result['Item']) == 0:
+    if chat is None:
         return None
 
-    return result['Item']['language']
+    return chat['language']
 
 
 def save_captcha(
@@ -327,69 +387,268 @@ def save_captcha(
         chat_id,
         choices):
     """
-    Retrieves the status of chat that is saved in the
-    DB and add a list of captcha choices.
+    Saves the two numbers of the captcha a chat was asked
 
     :param table: DynamoDB Table Name
     :param chat_id: Telegram Chat ID
     :param choices: Captcha numbers
     :return: True or False in case of failure
     """
-    chat_hash = hashlib.sha512(str(chat_id).encode('utf-8')).hexdigest()
-
-    resource = boto3.resource('dynamodb')
-    ddtable = resource.Table(table)
+    values = {
+        chatschema.CAPTCHA: chatschema.pack_captcha(choices),
+        chatschema.VERSION: _next_version()
+    }
+    key = _chat_key(chat_id)
     try:
-        ddtable.update_item(
-            Key={
-                'chat_id': str(chat_hash)
-            },
-            UpdateExpression='SET #cpt = :element',
-            ExpressionAttributeValues={
-                ':element': choices},
-            ExpressionAttributeNames={
-                "#cpt": "captcha"
-            })
-    except ClientError as error:
-        logger.error(
-            '[save_captcha] Unable to read from {}: {}'.format(table, str(error)))
+        get_store().update_item(table, key, values)
+    except DBError as error:
+        logger.error('[save_captcha] %s', error)
         return False
 
+    _written(key, values[chatschema.VERSION])
     return True
 
 
 def get_captcha(
         table,
-        chat_id):
+        chat_id,
+        consistent=False):
     """
-    Retrieves the status of chat that is saved in the DB.
+    Retrieves the two numbers of the captcha a chat was asked
 
     :param table: DynamoDB Table Name
-    :param user_id: Telegram User ID
     :param chat_id: Telegram Chat ID
-    :return: Captcha choices or None in case of error
+    :param consistent: Use a strongly consistent read
+    :return: Captcha numbers as strings or None in case of error
     """
-    chat_hash = hashlib.sha512(str(chat_id).encode('utf-8')).hexdigest()
+    try:
+        chat = _read_chat(table, chat_id, consistent)
+    except DBError as error:
+        logger.error('[get_captcha] %s', error)
+        return None
+
+    logger.debug('Chat state is %s', chat)
 
-    resource = boto3.resource('dynamodb')
-    ddtable = resource.Table(table)
+    if chat is None:
+        return None
+
+    return chat['captcha']
+
+
+def claim_message(
+        table,
+        message_id,
+        ttl):
+    """
+    Records the id of an incoming message so repeated deliveries
+    of the same message can be detected and ignored.
+
+    :param table: DynamoDB Table Name
+    :param message_id: Unique ID of the incoming message
+    :param ttl: Number of seconds the message ID is remembered
+    :return: True if the message is seen for the first time, False otherwise
+    """
+    try:
+        return get_store().put_item(
+            table,
+            {
+                'message_id': str(message_id)
+            },
+            {
+                TTL_ATTRIBUTE: int(time.time()) + int(ttl)
+            },
+            if_absent=True)
+    except DBError as error:
+        # Failing open: a lost reply is worse than a rare duplicate
+        logger.error('[claim_message] %s', error)
+        return True
+
+
+def save_file_id(
+        table,
+        name,
+        file_id,
+        etag=None,
+        ttl=None):
+    """
+    Saves the Telegram file_id of a file uploaded from S3
+
+    The ids share the info table with the links, under the
+    FILE_ID_PARTITION language.
+
+    :param table: DynamoDB Table Name
+    :param name: name from fileids.s3_name() or fileids.asset_name()
+    :param file_id: Telegram file_id
+    :param etag: ETag of the S3 object that was uploaded
+    :param ttl: Number of seconds the file_id is trusted, forever if None
+    :return: True in case of success and False otherwise
+    """
+    values = {'file_id': file_id}
+    if etag:
+        values['etag'] = etag
+    if ttl:
+        values[TTL_ATTRIBUTE] = int(time.time()) + int(ttl)
+    try:
+        get_store().update_item(
+            table,
+            {
+                'language': FILE_ID_PARTITION,
+                'linktype': name
+            },
+            values)
+    except DBError as error:
+        logger.error('[save_file_id] %s', error)
+        return False
+
+    return True
+
+
+def get_file_id(
+        table,
+        name):
+    """
+    Retrieves the Telegram file_id of a file uploaded from S3
+
+    :param table: DynamoDB Table Name
+    :param name: name from fileids.s3_name() or fileids.asset_name()
+    :return: file_id or None if unknown or in case of error
+    """
     try:
-        result = ddtable.get_item(
-            ConsistentRead=True,
-            Key={
-                'chat_id': str(chat_hash)
-            })
-    except ClientError as error:
-        logger.error(
-            '[get_captcha] Unable to read from {}: {}'.format(table, str(error)))
+        item = get_store().get_item(
+            table,
+            {
+                'language': FILE_ID_PARTITION,
+                'linktype': name
+            },
+            consistent=False)
+    except DBError as error:
+        logger.error('[get_file_id] %s', error)
         return None
 
-    logger.info('Result from Query is {}'.format(str(result)))
+    if item is None:
+        return None
+
+    return item['file_id']
+
+
+def save_server_info(
+        table,
+        server_id,
+        is_blocked,
+        ttl):
+    """
+    Caches the blocked flag of an Outline server
+
+    :param table: DynamoDB Table Name
+    :param server_id: ID of the Outline server
+    :param is_blocked: Blocked flag, None if the server is unknown
+    :param ttl: Number of seconds the entry is trusted, 0 to expire it
+    :return: True in case of success and False otherwise
+    """
+    now = int(time.time())
+    # An entry that expired a second ago is ignored by every store
+    values = {TTL_ATTRIBUTE: now + int(ttl) if ttl else now - 1}
+    if is_blocked is not None:
+        values['is_blocked'] = bool(is_blocked)
+    try:
+        get_store().put_item(
+            table,
+            {
+                'language': SERVER_PARTITION,
+                'linktype': str(server_id)
+            },
+            values)
+    except DBError as error:
+        logger.error('[save_server_info] %s', error)
+        return False
+
+    return True
+
+
+def get_server_info(
+        table,
+        server_id):
+    """
+    Retrieves the cached blocked flag of an Outline server
+
+    :param table: DynamoDB Table Name
+    :param server_id: ID of the Outline server
+    :return: {'is_blocked': flag}, {} if the server is cached as unknown,
+        or None if nothing is cached or in case of error
+    """
+    try:
+        item = get_store().get_item(
+            table,
+            {
+                'language': SERVER_PARTITION,
+                'linktype': str(server_id)
+            },
+            consistent=False)
+    except DBError as error:
+        logger.error('[get_server_info] %s', error)
+        return None
 
-    if 'Item' not in result:
+    if item is None:
         return None
+    if 'is_blocked' not in item:
+        return {}
+    return {'is_blocked': bool(item['is_blocked'])}
 
-    if len(result['Item']) == 0:
+
+def add_counters(
+        table,
+        bucket,
+        counters,
+        ttl=None):
+    """
+    Atomically adds to the usage counters of a time bucket
+
+    :param table: DynamoDB Table Name
+    :param bucket: Name of the time bucket
+    :param counters: Dictionary of counter name to amount
+    :param ttl: Number of seconds the bucket is kept, forever if None
+    :return: True in case of success and False otherwise
+    """
+    try:
+        get_store().add(
+            table,
+            {
+                'language': STATS_PARTITION,
+                'linktype': bucket
+            },
+            counters,
+            int(time.time()) + int(ttl) if ttl else None)
+    except DBError as error:
+        logger.error('[add_counters] %s', error)
+        return False
+
+    return True
+
+
+def get_counters(
+        table,
+        buckets):
+    """
+    Retrieves the usage counters of several time buckets at once
+
+    :param table: DynamoDB Table Name
+    :param buckets: List of time bucket names
+    :return: List of dictionaries of counter name to value in the order
+        of buckets, or None in case of error
+    """
+    try:
+        items = get_store().batch_get(
+            table,
+            [{'language': STATS_PARTITION, 'linktype': bucket}
+             for bucket in buckets])
+    except DBError as error:
+        logger.error('[get_counters] %s', error)
         return None
 
-    return result['Item']['captcha']
+    counters = []
+    for item in items:
+        counters.append({
+            name: int(value) for (name, value) in (item or {}).items()
+            if name not in ('language', 'linktype', TTL_ATTRIBUTE)
+        })
+    return counters
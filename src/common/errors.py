@@ -43,3 +43,9 @@ class HTTPError(PyskoochehException):
 
 class DBError(PyskoochehException):
     """ DB Errors """
+
+class CircuitOpenError(PyskoochehException):
+    """ Server is failing and calls to it are refused """
+
+class StateConflict(PyskoochehException):
+    """ State changed since it was read """
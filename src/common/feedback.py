@@ -2,52 +2,173 @@
 
     Holds functions for working with Telegram API
 """
+import csv
+import gzip
+import html
+import io
+import json
+import tempfile
 import time as systime
-from datetime import datetime, time, timedelta, tzinfo
+from bisect import bisect_right
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta
+from functools import lru_cache
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import boto3
 from botocore.exceptions import ClientError
 from errors import AWSError, ValidationError, FeedbackError
+from lazy import lazy_module
+import tracing
 
-def get_feedback_digest(table_name, days=1):
-    """ Get website feedback and return records timezones are shifted to account for EST
+# Only digests too large to attach are uploaded to S3
+storage = lazy_module('storage')
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    # Python 3.8 runtime
+    from backports.zoneinfo import ZoneInfo
+
+# SES rejects raw messages over 10MB, attachments grow by a third in base64
+MAX_ATTACHMENT_SIZE = 7 * 1024 * 1024
+DIGEST_TIMEZONE = 'America/New_York'
+DIGEST_FIELDS = ('feedback_time', 'user_name', 'subject', 'message')
+DIGEST_ATTACHMENT_HTML = '<p><a href="{{link}}">Download the full feedback digest</a></p>'
+# Links signed with an API key pair stay valid for the longest time S3 allows
+DIGEST_LINK_EXPIRY = 7 * 24 * 3600
+
+def get_feedback_digest(table_name, days=1, index_name=None, segments=4,
+                        tz_name=DIGEST_TIMEZONE):
+    """ Get website feedback and yield records between local midnights of tz_name
+
+    Feedback written by send_feedback carries a feedback_day partition
+    (UTC date) so when the table has a GSI on feedback_day/feedback_time
+    the digest is a Query over the days in the window. Without an index
+    the whole table is read with a paginated parallel scan. Feedback
+    written before feedback_day existed is only in the index once
+    tools/backfill_feedback_day.py gave it the attribute.
 
     Args:
         table_name: name of dynamodb table to pull feedback from
         days: optional number of days (starting from yesterday) to return feedback for (default 1)
+        index_name: optional name of the feedback_day/feedback_time GSI
+        segments: number of parallel segments used when scanning (default 4)
+        tz_name: IANA timezone the days are counted in (default US Eastern)
+    Yields:
+        feedback objects in DynamoDB attribute value format
+    Raises:
+        AWSError: dynamodb query or scan failed
+    """
+    (yesterday, today) = digest_windows([tz_name], days)[tz_name]
+
+    dynamodb = boto3.client('dynamodb')
+    if index_name:
+        pages = _query_feedback_days(dynamodb, table_name, index_name, yesterday, today)
+    else:
+        pages = _scan_feedback_segments(dynamodb, table_name, segments, yesterday, today)
+
+    for page in pages:
+        for item in page['Items']:
+            yield item
+
+def feedback_day(timestamp):
+    """ Partition value of the feedback_day attribute for a timestamp
+
+    Args:
+        timestamp: seconds since epoch
     Returns:
-        set of feedback objects or false if empty
+        UTC date of the timestamp as YYYY-MM-DD
+    """
+    return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+def _query_feedback_days(dynamodb, table_name, index_name, start, end):
+    """ Query the feedback_day index one day partition at a time
+
+    Args:
+        dynamodb: boto3 dynamodb client
+        table_name: name of dynamodb table to pull feedback from
+        index_name: name of the feedback_day/feedback_time GSI
+        start: window start in seconds since epoch
+        end: window end in seconds since epoch
+    Yields:
+        Query response pages
     Raises:
-        AWSError: dynamodb scan failed
+        AWSError: dynamodb query failed
     """
-    utc_timezone = UTC()
-    eastern_timezone = USTimeZone(-5, "Eastern", "EST", "EDT")
+    day = datetime.utcfromtimestamp(start).date()
+    last_day = datetime.utcfromtimestamp(end).date()
+    while day <= last_day:
+        kwargs = {
+            'TableName': table_name,
+            'IndexName': index_name,
+            'KeyConditionExpression':
+                'feedback_day = :day AND feedback_time BETWEEN :yesterday AND :today',
+            'ExpressionAttributeValues': {
+                ':day': {'S': day.strftime('%Y-%m-%d')},
+                ':yesterday': {'N': str(start)},
+                ':today': {'N': str(end)},
+            }
+        }
+        while True:
+            try:
+                with tracing.span('dynamodb.query'):
+                    page = dynamodb.query(**kwargs)
+            except ClientError as error:
+                raise AWSError('DynamoDB Error: {}'.format(str(error)))
+            yield page
+            if 'LastEvaluatedKey' not in page:
+                break
+            kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+        day += timedelta(1)
 
-    epoch = datetime(1970, 1, 1, tzinfo=utc_timezone)
-    zero_time = time(0, 0, 0, 0, eastern_timezone)
-    today = datetime.now(eastern_timezone)
-    yesterday = today - timedelta(days)
-    today = (datetime.combine(today, zero_time) - epoch).total_seconds()
-    yesterday = (datetime.combine(yesterday, zero_time) - epoch).total_seconds()
+def _scan_feedback_segments(dynamodb, table_name, segments, start, end):
+    """ Scan the table in parallel segments following LastEvaluatedKey
 
-    dynamodb = boto3.client('dynamodb')
-    try:
-        feedback = dynamodb.scan(
-            TableName=table_name,
-            FilterExpression='feedback_time BETWEEN :yesterday AND :today',
-            ExpressionAttributeValues={
-                ':yesterday': {'N': str(yesterday)},
-                ':today': {'N': str(today)},
-            })
-    except ClientError as error:
-        raise AWSError('DynamoDB Error: {}'.format(str(error)))
+    Only one page per segment is in flight so memory stays bounded by
+    segments * 1MB no matter how large the table is.
 
-    if feedback['Count'] > 0:
-        return feedback['Items']
-    else:
-        return False
+    Args:
+        dynamodb: boto3 dynamodb client
+        table_name: name of dynamodb table to pull feedback from
+        segments: number of parallel segments
+        start: window start in seconds since epoch
+        end: window end in seconds since epoch
+    Yields:
+        Scan response pages, in completion order
+    Raises:
+        AWSError: dynamodb scan failed
+    """
+    def scan_page(segment, start_key):
+        kwargs = {
+            'TableName': table_name,
+            'Segment': segment,
+            'TotalSegments': segments,
+            'FilterExpression': 'feedback_time BETWEEN :yesterday AND :today',
+            'ExpressionAttributeValues': {
+                ':yesterday': {'N': str(start)},
+                ':today': {'N': str(end)},
+            }
+        }
+        if start_key:
+            kwargs['ExclusiveStartKey'] = start_key
+        with tracing.span('dynamodb.scan'):
+            return segment, dynamodb.scan(**kwargs)
+
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        pending = {executor.submit(scan_page, segment, None)
+                   for segment in range(segments)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    segment, page = future.result()
+                except ClientError as error:
+                    raise AWSError('DynamoDB Error: {}'.format(str(error)))
+                if 'LastEvaluatedKey' in page:
+                    pending.add(executor.submit(
+                        scan_page, segment, page['LastEvaluatedKey']))
+                yield page
 
 def send_email(email_from, email_to, subject, text_body, html_body, file_name, file_data, src_email=None):
     """ Send email with text, html and attachment sections
@@ -88,11 +209,14 @@ def send_email(email_from, email_to, subject, text_body, html_body, file_name, f
         msg.attach(part)
 
     try:
-        if src_email == None:
-            response = sesclient.send_raw_email(RawMessage={'Data': msg.as_string()})
-        else:
-            response = sesclient.send_raw_email(Source=src_email,
-                                                RawMessage={'Data': msg.as_string()})
+        with tracing.span('ses.send_raw_email') as span:
+            raw_message = msg.as_string()
+            span.bytes = len(raw_message)
+            if src_email == None:
+                response = sesclient.send_raw_email(RawMessage={'Data': raw_message})
+            else:
+                response = sesclient.send_raw_email(Source=src_email,
+                                                    RawMessage={'Data': raw_message})
     except ClientError as error:
         raise AWSError('SendMail UnknownError: {}'.format(str(error)))
 
@@ -101,6 +225,7 @@ def send_email(email_from, email_to, subject, text_body, html_body, file_name, f
 
     return response
 
+@tracing.traced('dynamodb.put_item')
 def send_feedback(table_name, user_name, subject, message):
     """ Log feedback to website_feedback table
 
@@ -114,12 +239,14 @@ def send_feedback(table_name, user_name, subject, message):
     Raises:
         AWSError: Could not write to database
     """
+    now = systime.time()
     dynamodb = boto3.client('dynamodb')
     try:
         dynamodb.put_item(
             TableName=table_name,
             Item={
-                'feedback_time': {'N': str(systime.time())},
+                'feedback_time': {'N': str(now)},
+                'feedback_day': {'S': feedback_day(now)},
                 'user_name': {'S': user_name},
                 'subject': {'S': subject},
                 'message': {'S': message},
@@ -145,99 +272,206 @@ def template_email_link(text_body, html_body, attachment_html, link):
         html_body += attachment_html.replace('{{link}}', link)
     return (text_body, html_body)
 
-# Time zone definitions
-# US DST Rules
-class UTC(tzinfo):
-    """UTC"""
-    def utcoffset(self, _):
-        return timedelta(0)
-
-    def tzname(self, _):
-        return "UTC"
-
-    def dst(self, _):
-        return timedelta(0)
-
-class USTimeZone(tzinfo):
-    """ USTimeZone """
-    def __init__(self, hours, reprname, stdname, dstname):
-        super(USTimeZone, self).__init__()
-        self.stdoffset = timedelta(hours=hours)
-        self.reprname = reprname
-        self.stdname = stdname
-        self.dstname = dstname
-
-    def __repr__(self):
-        return self.reprname
-
-    @staticmethod
-    def first_sunday_on_or_after(after_date):
-        """ Return first sunday after after_date """
-        days_to_go = 6 - after_date.weekday()
-        if days_to_go:
-            after_date += timedelta(days_to_go)
-        return after_date
-
-    def tzname(self, dt):
-        if self.dst(dt):
-            return self.dstname
-        else:
-            return self.stdname
-
-    def utcoffset(self, dt):
-        return self.stdoffset + self.dst(dt)
-
-    def dst(self, dt):
-        zero = timedelta(0)
-        hour = timedelta(hours=1)
-        # This is a simplified (i.e., wrong for a few cases) set of rules for US
-        # DST start and end times. For a complete and up-to-date set of DST rules
-        # and timezone definitions, visit the Olson Database (or try pytz):
-        # http://www.twinsun.com/tz/tz-link.htm
-        # http://sourceforge.net/projects/pytz/ (might not be up-to-date)
-        #
-        # In the US, since 2007, DST starts at 2am (standard time) on the second
-        # Sunday in March, which is the first Sunday on or after Mar 8.
-        dststart_2007 = datetime(1, 3, 8, 2)
-        # and ends at 2am (DST time; 1am standard time) on the first Sunday of Nov.
-        dstend_2007 = datetime(1, 11, 1, 1)
-        # From 1987 to 2006, DST used to start at 2am (standard time) on the first
-        # Sunday in April and to end at 2am (DST time; 1am standard time) on the last
-        # Sunday of October, which is the first Sunday on or after Oct 25.
-        dststart_1987_2006 = datetime(1, 4, 1, 2)
-        dstend_1987_2006 = datetime(1, 10, 25, 1)
-        # From 1967 to 1986, DST used to start at 2am (standard time) on the last
-        # Sunday in April (the one on or after April 24) and to end at 2am (DST time;
-        # 1am standard time) on the last Sunday of October, which is the first Sunday
-        # on or after Oct 25.
-        dststart_1967_1986 = datetime(1, 4, 24, 2)
-        dstend_1967_1986 = dstend_1987_2006
-
-        if dt is None or dt.tzinfo is None:
-            # An exception may be sensible here, in one or both cases.
-            # It depends on how you want to treat them.  The default
-            # fromutc() implementation (called by the default astimezone()
-            # implementation) passes a datetime with dt.tzinfo is self.
-            return zero
-        assert dt.tzinfo is self
-
-        # Find start and end times for US DST. For years before 1967, return
-        # ZERO for no DST.
-        if dt.year > 2006:
-            dststart, dstend = dststart_2007, dstend_2007
-        elif 1986 < dt.year < 2007:
-            dststart, dstend = dststart_1987_2006, dstend_1987_2006
-        elif 1966 < dt.year < 1987:
-            dststart, dstend = dststart_1967_1986, dstend_1967_1986
+def build_digest_attachment(items, file_format='csv', memory_limit=1024 * 1024,
+                            preview_bytes=16 * 1024):
+    """ Stream feedback items into a gzip compressed CSV or JSONL file
+
+    The file is kept in memory up to memory_limit bytes and spills to a
+    temporary file after that, so the number of items has no effect on
+    memory use. A plain text preview of the first items is collected on
+    the way for the email body.
+
+    Args:
+        items: iterable of feedback objects in DynamoDB attribute value format
+        file_format: 'csv' or 'jsonl'
+        memory_limit: bytes of compressed data held in memory before spilling to disk
+        preview_bytes: maximum size of the text preview
+    Returns:
+        (attachment, size, count, preview) tuple, attachment is a binary
+        file object positioned at its start
+    Raises:
+        ValidationError: unknown file format
+    """
+    if file_format not in ('csv', 'jsonl'):
+        raise ValidationError('Unknown digest format: {}'.format(file_format))
+
+    attachment = tempfile.SpooledTemporaryFile(max_size=memory_limit)
+    compressed = gzip.GzipFile(fileobj=attachment, mode='wb')
+    text = io.TextIOWrapper(compressed, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    if file_format == 'csv':
+        writer.writerow(DIGEST_FIELDS)
+
+    count = 0
+    preview = []
+    preview_size = 0
+    for item in items:
+        row = [_attribute_value(item.get(field)) for field in DIGEST_FIELDS]
+        if file_format == 'csv':
+            writer.writerow(row)
         else:
-            return zero
+            text.write(json.dumps(dict(zip(DIGEST_FIELDS, row)), ensure_ascii=False))
+            text.write('\n')
+        count += 1
+
+        if preview_size < preview_bytes:
+            line = ' | '.join(row)
+            preview.append(line[:preview_bytes - preview_size])
+            preview_size += len(line) + 1
+
+    text.flush()
+    text.detach()
+    compressed.close()
+    size = attachment.tell()
+    attachment.seek(0)
+    return (attachment, size, count, '\n'.join(preview))
+
+def send_feedback_digest(table_name, email_from, email_to, subject, days=1,
+                         file_format='csv', bucket=None, index_name=None,
+                         key_id=None, secret_key=None):
+    """ Email a feedback digest with the feedback attached as a compressed file
 
-        start = self.first_sunday_on_or_after(dststart.replace(year=dt.year))
-        end = self.first_sunday_on_or_after(dstend.replace(year=dt.year))
+    Attachments too large for SES are uploaded to S3 and linked in the
+    email body instead. The link is valid for 7 days when signed with an
+    API key pair, otherwise it is signed with the temporary credentials
+    of the function's role and only works for an hour at most.
 
-        # Can't compare naive to aware objects, so strip the timezone from
-        # dt first.
-        if start <= dt.replace(tzinfo=None) < end:
-            return hour
+    Args:
+        table_name: name of dynamodb table to pull feedback from
+        email_from: address to send from
+        email_to: address to send to
+        subject: email subject line
+        days: optional number of days (starting from yesterday) to send feedback for (default 1)
+        file_format: 'csv' or 'jsonl'
+        bucket: S3 bucket for attachments over the SES size limit
+        index_name: optional name of the feedback_day/feedback_time GSI
+        key_id: optional Amazon AWS API key id to sign the S3 link with
+        secret_key: optional Amazon AWS Secret API key of key_id
+    Returns:
+        SES response object from AWS API or None if there was no feedback
+    Raises:
+        AWSError: dynamodb, S3 or SES call failed
+        FeedbackError: attachment is too large and no bucket is given
+    """
+    items = get_feedback_digest(table_name, days, index_name)
+    attachment, size, count, preview = build_digest_attachment(items, file_format)
+    with attachment:
+        if count == 0:
+            return None
+
+        text_body = '{} feedback entries in the last {} day(s)\n\n{}'.format(
+            count, days, preview)
+        html_body = '<p>{} feedback entries in the last {} day(s)</p><pre>{}</pre>'.format(
+            count, days, html.escape(preview))
+        file_name = 'feedback-{}.{}.gz'.format(
+            datetime.utcnow().strftime('%Y%m%d'), file_format)
+
+        if size > MAX_ATTACHMENT_SIZE:
+            if not bucket:
+                raise FeedbackError(
+                    'Digest attachment is {} bytes and no bucket is set'.format(size))
+            key = 'feedback/{}'.format(file_name)
+            storage.put_file_object(bucket, key, attachment)
+            if key_id and secret_key:
+                link = storage.get_temp_link(
+                    bucket, key, key_id, secret_key, DIGEST_LINK_EXPIRY)
+            else:
+                link = storage.get_presigned_link(bucket, key)
+            (text_body, html_body) = template_email_link(
+                text_body, html_body, DIGEST_ATTACHMENT_HTML, link)
+            file_data = None
         else:
-            return zero
+            file_data = attachment.read()
+
+    return send_email(email_from, email_to, subject, text_body, html_body,
+                      file_name, file_data)
+
+def _attribute_value(value):
+    """ Plain string from a DynamoDB attribute value """
+    if not value:
+        return ''
+    return str(next(iter(value.values())))
+
+# Time window tables
+# Local hour boundaries are computed once per (timezone, year) from the
+# tz database and cached, so DST rules come from zoneinfo and any number
+# of windows or histogram buckets are just lookups in the table.
+@lru_cache(maxsize=32)
+def _hour_table(tz_name, year):
+    """ Epoch seconds of the start of every local hour in a year
+
+    Args:
+        tz_name: IANA timezone name
+        year: calendar year in that timezone
+    Returns:
+        (bounds, labels, end) tuple, labels[i] is the (date, hour) starting
+        at bounds[i] and end is the first local midnight of the next year
+    """
+    zone = ZoneInfo(tz_name)
+    first_day = date(year, 1, 1)
+    bounds = []
+    labels = []
+    for offset in range((date(year + 1, 1, 1) - first_day).days):
+        day = first_day + timedelta(offset)
+        for hour in range(24):
+            bounds.append(datetime(day.year, day.month, day.day, hour,
+                                   tzinfo=zone).timestamp())
+            labels.append((day, hour))
+    end = datetime(year + 1, 1, 1, tzinfo=zone).timestamp()
+    return (bounds, labels, end)
+
+def local_midnight(tz_name, day):
+    """ Epoch seconds of local midnight at the start of a day
+
+    Args:
+        tz_name: IANA timezone name
+        day: date object
+    Returns:
+        seconds since epoch
+    """
+    bounds = _hour_table(tz_name, day.year)[0]
+    return bounds[(day - date(day.year, 1, 1)).days * 24]
+
+def digest_windows(tz_names, days=1, now=None):
+    """ Digest time windows for several timezones at once
+
+    Each window starts at local midnight `days` days ago and ends at
+    the most recent local midnight.
+
+    Args:
+        tz_names: iterable of IANA timezone names
+        days: number of days covered by each window (default 1)
+        now: optional seconds since epoch to compute the windows for (default now)
+    Returns:
+        dict of timezone name to (start, end) epoch seconds
+    """
+    if now is None:
+        now = systime.time()
+    windows = {}
+    for tz_name in tz_names:
+        today = datetime.fromtimestamp(now, ZoneInfo(tz_name)).date()
+        windows[tz_name] = (local_midnight(tz_name, today - timedelta(days)),
+                            local_midnight(tz_name, today))
+    return windows
+
+def hourly_histogram(timestamps, tz_name=DIGEST_TIMEZONE):
+    """ Count timestamps per local hour
+
+    Args:
+        timestamps: iterable of seconds since epoch
+        tz_name: IANA timezone name used for the buckets
+    Returns:
+        dict of (date, hour) to number of timestamps in that local hour
+    """
+    histogram = {}
+    for timestamp in timestamps:
+        timestamp = float(timestamp)
+        year = datetime.utcfromtimestamp(timestamp).year
+        (bounds, labels, end) = _hour_table(tz_name, year)
+        if timestamp < bounds[0]:
+            (bounds, labels, end) = _hour_table(tz_name, year - 1)
+        elif timestamp >= end:
+            (bounds, labels, end) = _hour_table(tz_name, year + 1)
+        label = labels[bisect_right(bounds, timestamp) - 1]
+        histogram[label] = histogram.get(label, 0) + 1
+    return histogram
@@ -0,0 +1,46 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Lazy Import Module
+Defers loading modules that only some updates need to their first use
+
+Module level code of a lazy module runs on the first attribute access,
+so a Lambda cold start does not pay for boto3 or the admin code when the
+update never reaches them.
+"""
+
+import importlib.util
+import sys
+
+
+def lazy_module(name):
+    """
+    Returns a module that is loaded on first attribute access
+
+    :param name: Absolute module name, e.g. 'boto3'
+    :return: Module object
+    :raise: ImportError: module not found
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError('No module named {}'.format(name), name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -0,0 +1,172 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Logging Module
+Configures the root logger of the Lambda functions
+
+The output is picked with CONFIG['LOG_FORMAT']:
+    text: records go through the handler Lambda installs (default)
+    json: one JSON object per record, written by a background thread
+          fed through a queue so logging never waits on stdout; the
+          queue is drained at the end of every update by flushed
+
+Every record is redacted: Telegram bot tokens, Outline access keys and
+the API key never reach the logs. Whole request payloads are only logged
+for a sample of the updates, CONFIG['LOG_PAYLOAD_SAMPLE_RATE'].
+"""
+
+import functools
+import json
+import logging
+import random
+import re
+import sys
+from settings import CONFIG
+
+logger = logging.getLogger()
+
+SECRET_PATTERNS = [
+    # Telegram bot token, also inside /bot<token>/ API URLs
+    (re.compile(r'(?<![0-9])[0-9]{5,}:[A-Za-z0-9_-]{30,}'), '<bot-token>'),
+    # Outline access keys
+    (re.compile(r'ss://[^\s\'",]+'), 'ss://<redacted>'),
+]
+
+_queue = None
+_listener = None
+
+
+def redact(message):
+    """
+    Masks the secrets in a log message
+
+    :param message: Log message
+    :return: Message with secrets replaced
+    """
+    for (pattern, replacement) in SECRET_PATTERNS:
+        message = pattern.sub(replacement, message)
+    if CONFIG.get('API_KEY'):
+        message = message.replace(CONFIG['API_KEY'], '<api-key>')
+    return message
+
+
+class RedactFilter(logging.Filter):
+    """
+    Formats the message of a record once and redacts it
+    """
+    def filter(self, record):
+        record.msg = redact(record.getMessage())
+        record.args = None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as one JSON object
+
+    Structured values can be added with extra={'data': {...}}.
+    """
+    def format(self, record):
+        entry = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'function': record.funcName,
+            'message': record.getMessage()
+        }
+        data = getattr(record, 'data', None)
+        if data:
+            entry['data'] = data
+        request_id = getattr(record, 'aws_request_id', None)
+        if request_id:
+            entry['request_id'] = request_id
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup():
+    """
+    Configures the root logger from the settings, once per process
+
+    :return: Root logger
+    """
+    global _queue, _listener
+    logger.setLevel(CONFIG['LOG_LEVEL'])
+    if getattr(logger, '_outline_configured', False):
+        return logger
+    logger._outline_configured = True
+
+    if CONFIG.get('LOG_FORMAT', 'text') == 'json':
+        # Imported here, logging.handlers pulls in socket and pickle
+        from logging.handlers import QueueHandler, QueueListener
+        import queue
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(JsonFormatter())
+        _queue = queue.Queue(-1)
+        _listener = QueueListener(
+            _queue, stream_handler, respect_handler_level=False)
+        _listener.start()
+        queue_handler = QueueHandler(_queue)
+        queue_handler.addFilter(RedactFilter())
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.addHandler(queue_handler)
+    else:
+        if not logger.handlers:
+            logger.addHandler(logging.StreamHandler())
+        for handler in logger.handlers:
+            handler.addFilter(RedactFilter())
+    return logger
+
+
+def flush():
+    """
+    Waits until the background thread has written every queued record
+
+    Lambda freezes the process as soon as the handler returns, records
+    still in the queue would only be written on the next invocation.
+    """
+    if _queue is not None:
+        _queue.join()
+
+
+def flushed(function):
+    """
+    Decorator for Lambda entry points, flushes the logs after each call
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        finally:
+            flush()
+    return wrapper
+
+
+def log_payload(description, payload):
+    """
+    Logs a whole payload for a sample of the calls
+
+    :param description: What the payload is
+    :param payload: JSON serializable payload
+    """
+    rate = CONFIG.get('LOG_PAYLOAD_SAMPLE_RATE', 0)
+    if not rate or not logger.isEnabledFor(logging.INFO):
+        return
+    if random.random() >= rate:
+        return
+    logger.info('%s: %s', description, json.dumps(payload, default=str),
+                stacklevel=2)
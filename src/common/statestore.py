@@ -0,0 +1,537 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+State Store Module
+Holds the storage backends behind the chat state functions in dynamodb.py
+
+The backend is picked with CONFIG['STATE_BACKEND']:
+    dynamodb: Amazon DynamoDB (default)
+    memory: process local dictionary, for tests and load generation
+    sqlite: SQLite file in WAL mode at CONFIG['STATE_SQLITE_FILE'], for
+            self-hosted deployments without DynamoDB, it can be shared
+            by several worker processes
+"""
+
+import contextlib
+import json
+import threading
+import time
+from errors import DBError, ValidationError
+from lazy import lazy_module
+from settings import CONFIG
+import tracing
+
+sqlite3 = lazy_module('sqlite3')
+
+# Items holding this attribute are considered gone once it is in the past,
+# the same attribute is used as the DynamoDB TTL attribute.
+TTL_ATTRIBUTE = 'expires_at'
+
+# Keys per BatchGetItem request
+BATCH_GET_LIMIT = 100
+# Seconds a SQLite write waits for the write lock of another process
+SQLITE_BUSY_TIMEOUT = 10
+
+_store = None
+
+
+def get_store():
+    """
+    Returns the state store selected in the settings
+
+    :return: State store object
+    :raise: ValidationError: unknown backend
+    """
+    global _store
+    if _store is None:
+        backend = CONFIG.get('STATE_BACKEND', 'dynamodb')
+        if backend == 'dynamodb':
+            _store = DynamoDBStore()
+        elif backend == 'memory':
+            _store = MemoryStore()
+        elif backend == 'sqlite':
+            _store = SQLiteStore(
+                CONFIG.get('STATE_SQLITE_FILE', '/tmp/outline-state.db'))
+        else:
+            raise ValidationError('Unknown state backend: {}'.format(backend))
+    return _store
+
+
+@contextlib.contextmanager
+def immediate(db, lock):
+    """
+    Runs a read-modify-write in one SQLite transaction
+
+    BEGIN IMMEDIATE takes the write lock of the file before the read, so
+    a writer in another process waits instead of acting on the same
+    read. The connection must be opened with isolation_level=None.
+
+    :param db: sqlite3 connection
+    :param lock: lock of the threads sharing the connection
+    """
+    with lock:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            db.rollback()
+            raise
+        db.commit()
+
+
+def _expired(item, now=None):
+    """
+    Checks the TTL attribute of an item
+
+    :param item: Stored item
+    :param now: Current time in seconds since epoch
+    :return: True if the item has outlived its TTL
+    """
+    if TTL_ATTRIBUTE not in item:
+        return False
+    return int(item[TTL_ATTRIBUTE]) < (now or time.time())
+
+
+def _key_of(item, key):
+    """
+    Picks the key attributes out of an item
+
+    :param item: Stored item
+    :param key: Any key of the table, for the attribute names
+    :return: Hashable key
+    """
+    return tuple(item[name] for name in sorted(key))
+
+
+def _matches(item, expected):
+    """
+    Checks the condition of a conditional write
+
+    :param item: Live item, or only its key if there is none
+    :param expected: Dictionary of attribute name to value, None for
+        an attribute that must not exist
+    :return: True if the item meets the condition
+    """
+    return all(item.get(name) == value for (name, value) in (expected or {}).items())
+
+
+def _condition(expected, names, values):
+    """
+    Builds the DynamoDB condition expression of a conditional write to
+    a live item
+
+    :param expected: Dictionary of attribute name to value, None for
+        an attribute that must not exist
+    :param names: ExpressionAttributeNames, extended in place
+    :param values: ExpressionAttributeValues, extended in place
+    :return: ConditionExpression
+    """
+    checks = []
+    for index, (name, value) in enumerate(expected.items()):
+        names['#e{}'.format(index)] = name
+        if value is None:
+            checks.append('attribute_not_exists(#e{})'.format(index))
+        else:
+            values[':e{}'.format(index)] = value
+            checks.append('#e{0} = :e{0}'.format(index))
+    return ' AND '.join(checks)
+
+
+class DynamoDBStore(object):
+    """
+    State store on Amazon DynamoDB
+    """
+    def __init__(self):
+        self._resource = None
+        self._tables = {}
+
+    def _dynamodb(self):
+        if self._resource is None:
+            import boto3
+            self._resource = boto3.resource('dynamodb')
+        return self._resource
+
+    def _table(self, table):
+        if table not in self._tables:
+            self._tables[table] = self._dynamodb().Table(table)
+        return self._tables[table]
+
+    @tracing.traced('dynamodb.get_item')
+    def get_item(self, table, key, consistent=False):
+        """
+        Reads an item
+
+        :param table: Table name
+        :param key: Dictionary of key attributes
+        :param consistent: Use a strongly consistent read, which costs
+            twice the read capacity
+        :return: Item dictionary or None if it does not exist
+        :raise: DBError: read failed
+        """
+        from botocore.exceptions import ClientError
+        try:
+            result = self._table(table).get_item(
+                ConsistentRead=consistent,
+                Key=key)
+        except ClientError as error:
+            raise DBError('Unable to read from {}: {}'.format(table, str(error)))
+        item = result.get('Item')
+        # DynamoDB deletes expired items up to two days late
+        if not item or _expired(item):
+            return None
+        return item
+
+    @tracing.traced('dynamodb.put_item')
+    def put_item(self, table, key, attributes, if_absent=False):
+        """
+        Writes a whole item, replacing any existing one
+
+        :param table: Table name
+        :param key: Dictionary of key attributes
+        :param attributes: Dictionary of the other attributes
+        :param if_absent: Only write if no live item with the same key exists
+        :return: True if written, False if the condition failed
+        :raise: DBError: write failed
+        """
+        from botocore.exceptions import ClientError
+        item = dict(attributes)
+        item.update(key)
+        kwargs = {'Item': item}
+        if if_absent:
+            kwargs['ConditionExpression'] = (
+                'attribute_not_exists(#key) OR #ttl < :now')
+            kwargs['ExpressionAttributeNames'] = {
+                '#key': next(iter(key)),
+                '#ttl': TTL_ATTRIBUTE
+            }
+            kwargs['ExpressionAttributeValues'] = {':now': int(time.time())}
+        try:
+            self._table(table).put_item(**kwargs)
+        except ClientError as error:
+            if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise DBError('Unable to write to {}: {}'.format(table, str(error)))
+        return True
+
+    @tracing.traced('dynamodb.update_item')
+    def update_item(self, table, key, values, remove=(), expected=None):
+        """
+        Sets attributes of an item, creating it if needed
+
+        :param table: Table name
+        :param key: Dictionary of key attributes
+        :param values: Dictionary of attributes to set
+        :param remove: Names of attributes to remove
+        :param expected: Dictionary of the values attributes must have
+            for the write to happen, None for an attribute that must
+            not exist. An expired item has no attributes.
+        :return: True if written, False if the condition failed
+        :raise: DBError: write failed
+        """
+        from botocore.exceptions import ClientError
+        names = {}
+        expression_values = {}
+        assignments = []
+        for index, (name, value) in enumerate(values.items()):
+            names['#a{}'.format(index)] = name
+            expression_values[':v{}'.format(index)] = value
+            assignments.append('#a{0} = :v{0}'.format(index))
+        expression = 'SET ' + ', '.join(assignments)
+        if remove:
+            for (index, name) in enumerate(remove):
+                names['#r{}'.format(index)] = name
+            expression += ' REMOVE ' + ', '.join(
+                '#r{}'.format(index) for index in range(len(remove)))
+        # Only a live item is updated, DynamoDB would keep the attributes
+        # of an expired one it has not deleted yet
+        names['#ttl'] = TTL_ATTRIBUTE
+        expression_values[':now'] = int(time.time())
+        condition = 'attribute_not_exists(#ttl) OR #ttl >= :now'
+        if expected:
+            condition = '({}) AND {}'.format(
+                condition, _condition(expected, names, expression_values))
+        while True:
+            try:
+                self._table(table).update_item(
+                    Key=key,
+                    UpdateExpression=expression,
+                    ConditionExpression=condition,
+                    ExpressionAttributeNames=names,
+                    ExpressionAttributeValues=expression_values)
+                return True
+            except ClientError as error:
+                if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise DBError('Unable to write to {}: {}'.format(table, str(error)))
+            try:
+                result = self._table(table).get_item(ConsistentRead=True, Key=key)
+            except ClientError as error:
+                raise DBError('Unable to read from {}: {}'.format(table, str(error)))
+            old = result.get('Item')
+            if old is None:
+                # Deleted in the meantime, the update sees it as absent
+                continue
+            if not _expired(old):
+                if not _matches(old, expected):
+                    return False
+                # Changed since the update, try again
+                continue
+            if not _matches(dict(key), expected):
+                return False
+            # An expired item has no attributes, it is replaced by the
+            # values unless it changed since it was read
+            item = dict(values)
+            item.update(key)
+            try:
+                self._table(table).put_item(
+                    Item=item,
+                    ConditionExpression='#ttl = :old',
+                    ExpressionAttributeNames={'#ttl': TTL_ATTRIBUTE},
+                    ExpressionAttributeValues={':old': old[TTL_ATTRIBUTE]})
+                return True
+            except ClientError as error:
+                if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise DBError('Unable to write to {}: {}'.format(table, str(error)))
+
+    @tracing.traced('dynamodb.update_item')
+    def add(self, table, key, counters, ttl=None):
+        """
+        Atomically adds to number attributes of an item, creating it and
+        missing attributes at 0
+
+        :param table: Table name
+        :param key: Dictionary of key attributes
+        :param counters: Dictionary of attribute name to amount
+        :param ttl: Value of the TTL attribute to set, if any
+        :raise: DBError: write failed
+        """
+        from botocore.exceptions import ClientError
+        names = {}
+        expression_values = {}
+        additions = []
+        for index, (name, amount) in enumerate(counters.items()):
+            names['#a{}'.format(index)] = name
+            expression_values[':v{}'.format(index)] = amount
+            additions.append('#a{0} :v{0}'.format(index))
+        expression = 'ADD ' + ', '.join(additions)
+        if ttl is not None:
+            names['#ttl'] = TTL_ATTRIBUTE
+            expression_values[':ttl'] = int(ttl)
+            expression += ' SET #ttl = :ttl'
+        try:
+            self._table(table).update_item(
+                Key=key,
+                UpdateExpression=expression,
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=expression_values)
+        except ClientError as error:
+            raise DBError('Unable to write to {}: {}'.format(table, str(error)))
+
+    @tracing.traced('dynamodb.batch_get_item')
+    def batch_get(self, table, keys, consistent=False):
+        """
+        Reads several items of a table in as few requests as possible
+
+        :param table: Table name
+        :param keys: List of key dictionaries
+        :param consistent: Use strongly consistent reads
+        :return: List of items in the order of keys, None where an item
+            does not exist
+        :raise: DBError: read failed
+        """
+        from botocore.exceptions import ClientError
+        found = {}
+        # BatchGetItem takes at most 100 keys and may leave some unprocessed
+        for start in range(0, len(keys), BATCH_GET_LIMIT):
+            request = {table: {
+                'Keys': keys[start:start + BATCH_GET_LIMIT],
+                'ConsistentRead': consistent
+            }}
+            attempt = 0
+            while request:
+                if attempt:
+                    time.sleep(min(0.05 * 2 ** attempt, 1))
+                attempt += 1
+                try:
+                    result = self._dynamodb().batch_get_item(RequestItems=request)
+                except ClientError as error:
+                    raise DBError('Unable to read from {}: {}'.format(table, str(error)))
+                for item in result.get('Responses', {}).get(table, []):
+                    found[_key_of(item, keys[0])] = item
+                request = result.get('UnprocessedKeys')
+        items = []
+        for key in keys:
+            item = found.get(_key_of(key, key))
+            items.append(None if item is None or _expired(item) else item)
+        return items
+
+
+class MemoryStore(object):
+    """
+    State store in a process local dictionary
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables = {}
+
+    @staticmethod
+    def _key(key):
+        return tuple(sorted(key.items()))
+
+    def get_item(self, table, key, consistent=False):
+        with self._lock:
+            item = self._tables.get(table, {}).get(self._key(key))
+            if item is None or _expired(item):
+                return None
+            return dict(item)
+
+    def put_item(self, table, key, attributes, if_absent=False):
+        with self._lock:
+            rows = self._tables.setdefault(table, {})
+            row_key = self._key(key)
+            if if_absent and row_key in rows and not _expired(rows[row_key]):
+                return False
+            item = dict(attributes)
+            item.update(key)
+            rows[row_key] = item
+            return True
+
+    def update_item(self, table, key, values, remove=(), expected=None):
+        with self._lock:
+            rows = self._tables.setdefault(table, {})
+            item = rows.get(self._key(key))
+            if item is None or _expired(item):
+                item = dict(key)
+            if not _matches(item, expected):
+                return False
+            item.update(values)
+            for name in remove:
+                item.pop(name, None)
+            rows[self._key(key)] = item
+            return True
+
+    def add(self, table, key, counters, ttl=None):
+        with self._lock:
+            rows = self._tables.setdefault(table, {})
+            item = rows.get(self._key(key))
+            if item is None or _expired(item):
+                item = dict(key)
+            for (name, amount) in counters.items():
+                item[name] = item.get(name, 0) + amount
+            if ttl is not None:
+                item[TTL_ATTRIBUTE] = int(ttl)
+            rows[self._key(key)] = item
+
+    def batch_get(self, table, keys, consistent=False):
+        return [self.get_item(table, key) for key in keys]
+
+
+class SQLiteStore(object):
+    """
+    State store in a SQLite file running in WAL mode
+    """
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        try:
+            self._db = sqlite3.connect(
+                path,
+                timeout=SQLITE_BUSY_TIMEOUT,
+                isolation_level=None,
+                check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS items ('
+                'tbl TEXT NOT NULL, '
+                'pk TEXT NOT NULL, '
+                'item TEXT NOT NULL, '
+                'PRIMARY KEY (tbl, pk))')
+            self._db.commit()
+        except sqlite3.Error as error:
+            raise DBError('Unable to open {}: {}'.format(path, str(error)))
+
+    @staticmethod
+    def _key(key):
+        return json.dumps(key, sort_keys=True)
+
+    def _read(self, table, pk):
+        row = self._db.execute(
+            'SELECT item FROM items WHERE tbl = ? AND pk = ?',
+            (table, pk)).fetchone()
+        if row is None:
+            return None
+        item = json.loads(row[0])
+        if _expired(item):
+            return None
+        return item
+
+    def _write(self, table, pk, item):
+        self._db.execute(
+            'INSERT OR REPLACE INTO items (tbl, pk, item) VALUES (?, ?, ?)',
+            (table, pk, json.dumps(item)))
+
+    def get_item(self, table, key, consistent=False):
+        try:
+            with self._lock:
+                return self._read(table, self._key(key))
+        except sqlite3.Error as error:
+            raise DBError('Unable to read from {}: {}'.format(table, str(error)))
+
+    def put_item(self, table, key, attributes, if_absent=False):
+        try:
+            with immediate(self._db, self._lock):
+                pk = self._key(key)
+                if if_absent and self._read(table, pk) is not None:
+                    return False
+                item = dict(attributes)
+                item.update(key)
+                self._write(table, pk, item)
+                return True
+        except sqlite3.Error as error:
+            raise DBError('Unable to write to {}: {}'.format(table, str(error)))
+
+    def update_item(self, table, key, values, remove=(), expected=None):
+        try:
+            with immediate(self._db, self._lock):
+                pk = self._key(key)
+                item = self._read(table, pk) or dict(key)
+                if not _matches(item, expected):
+                    return False
+                item.update(values)
+                for name in remove:
+                    item.pop(name, None)
+                self._write(table, pk, item)
+                return True
+        except sqlite3.Error as error:
+            raise DBError('Unable to write to {}: {}'.format(table, str(error)))
+
+    def add(self, table, key, counters, ttl=None):
+        try:
+            with immediate(self._db, self._lock):
+                pk = self._key(key)
+                item = self._read(table, pk) or dict(key)
+                for (name, amount) in counters.items():
+                    item[name] = item.get(name, 0) + amount
+                if ttl is not None:
+                    item[TTL_ATTRIBUTE] = int(ttl)
+                self._write(table, pk, item)
+        except sqlite3.Error as error:
+            raise DBError('Unable to write to {}: {}'.format(table, str(error)))
+
+    def batch_get(self, table, keys, consistent=False):
+        try:
+            with self._lock:
+                return [self._read(table, self._key(key)) for key in keys]
+        except sqlite3.Error as error:
+            raise DBError('Unable to read from {}: {}'.format(table, str(error)))
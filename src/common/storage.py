@@ -22,11 +22,17 @@ from datetime import datetime
 import requests
 import boto3
 from boto3.session import Session
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
 from botocore.exceptions import ClientError
 from errors import AWSError, ValidationError
+import tracing
 
 S3_AMAZON_LINK = "https://s3.amazonaws.com"
+# Part size of streamed uploads, S3 needs at least 5MB per part
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+# Links signed with the temporary credentials of a role die with them
+ROLE_LINK_MAX_EXPIRY = 3600
 
 def build_key_name(app_name, os_name, file_name):
     """ 
@@ -60,7 +66,9 @@ def get_binary_contents(bucket, key, config=None):
     """
     s3_resource = boto3.resource("s3") if config is None else boto3.resource("s3", config=config)
     try:
-        response = s3_resource.Object(bucket, key).get()
+        with tracing.span("s3.get_object") as span:
+            response = s3_resource.Object(bucket, key).get()
+            span.bytes = response.get("ContentLength")
     except ClientError as error:
         raise AWSError("Error loading file from S3: {}".format(str(error)))
     return response
@@ -87,10 +95,12 @@ def put_file_with_creds(bucket, key, content, access_key, secret_key):
         aws_secret_access_key=secret_key)
 
     try:
-        s3.put_object(
-            Bucket=bucket,
-            Key=key,
-            Body=content)
+        with tracing.span("s3.put_object") as span:
+            span.bytes = len(content)
+            s3.put_object(
+                Bucket=bucket,
+                Key=key,
+                Body=content)
 
     except ClientError as error:
         raise AWSError("Problem putting {} from {} bucket ({})"
@@ -118,7 +128,9 @@ def get_file_with_creds(bucket, key, access_key, secret_key):
         aws_access_key_id=access_key,
         aws_secret_access_key=secret_key)
     try:
-        response = s3.get_object(Bucket=bucket, Key=key)
+        with tracing.span("s3.get_object") as span:
+            response = s3.get_object(Bucket=bucket, Key=key)
+            span.bytes = response.get("ContentLength")
     except ClientError as error:
         raise AWSError("Error loading file from S3: {}".format(str(error)))
     return response
@@ -134,11 +146,14 @@ def get_json_contents(bucket, key):
     """
     s3_resource = boto3.resource("s3")
     try:
-        response = s3_resource.Object(bucket, key).get()
+        with tracing.span("s3.get_object") as span:
+            response = s3_resource.Object(bucket, key).get()
+            span.bytes = response.get("ContentLength")
     except ClientError as error:
         raise AWSError("Error loading file from S3: {}".format(str(error)))
     return json.load(response["Body"])
 
+@tracing.traced("s3.head_object")
 def get_object_metadata(bucket, key):
     """
     Get file metadata from S3
@@ -157,6 +172,7 @@ def get_object_metadata(bucket, key):
         raise AWSError("Error loading metadata from S3: {}".format(str(error)))
     return obj
 
+@tracing.traced("s3.copy_object")
 def put_object_metadata(bucket, key, meta_key, meta_value):
     """
     Get file metadata from S3
@@ -219,16 +235,70 @@ def get_temp_link(bucket, key, key_id, secret_key, expiry=300):
         raise AWSError("Error generating temp link: {}".format(str(error)))
     return link
 
-def put_doc_file(bucket, key, filename, url, caption=None, thumb=None):
+@tracing.traced("s3.upload_fileobj")
+def put_file_object(bucket, key, fileobj):
+    """
+    Upload a file-like object to S3, large files go up in multipart chunks
+
+    :param bucket: file bucket name
+    :param key: file key name
+    :param fileobj: readable binary file-like object
+    :raise: AWSError: Error adding file to S3 bucket
+    """
+    if key is None or len(key) <= 0:
+        raise ValidationError("Key name cannot be empty.")
+
+    s3_client = boto3.client("s3")
+    try:
+        s3_client.upload_fileobj(fileobj, bucket, key)
+    except ClientError as error:
+        raise AWSError("Problem putting {} to {} bucket ({})"
+                       .format(key, bucket, str(error)))
+
+def get_presigned_link(bucket, key, expiry=ROLE_LINK_MAX_EXPIRY):
+    """
+    Get expiring S3 url signed with the function's own credentials
+
+    A Lambda function signs with the temporary credentials of its role,
+    the link stops working when they expire whatever its expiry says,
+    so the expiry is capped at ROLE_LINK_MAX_EXPIRY. Use get_temp_link()
+    for links that have to last longer.
+
+    :param bucket: name of bucket
+    :param key: key id in bucket
+    :param expiry: number of seconds the link is valid for (default=1 hour)
+    :return: Temporary S3 link to file
+    :raise: AWSError: error getting presigned link from S3
+    """
+    s3_client = boto3.client("s3")
+    try:
+        link = s3_client.generate_presigned_url(
+            ExpiresIn=min(expiry, ROLE_LINK_MAX_EXPIRY),
+            ClientMethod="get_object",
+            Params={
+                "Bucket": bucket,
+                "Key": key,
+            }
+        )
+    except ClientError as error:
+        raise AWSError("Error generating temp link: {}".format(str(error)))
+    return link
+
+def put_doc_file(bucket, key, filename, url, caption=None, thumb=None,
+                 chunk_size=MULTIPART_CHUNK_SIZE):
     """
     Appends to a file in S3
 
+    The download is streamed into a multipart upload, at most one
+    part of chunk_size bytes is held in memory.
+
     :param bucket: file bucket name
     :param key: key prefix
     :param filename: filename to be written
     :param url: location of filename
     :param caption: caption file contents
     :param thumb: thumbnail file contents
+    :param chunk_size: multipart upload part size in bytes
     :raise: AWSError: Error adding file to S3 bucket
     """
     if key is None or len(key) <= 0:
@@ -248,14 +318,22 @@ def put_doc_file(bucket, key, filename, url, caption=None, thumb=None):
         thumbobj = s3_resource.Object(bucket, key + "/" + timestr + filename)
 
     try:
-        file_content = requests.get(url).content
-        docobj.put(Body=file_content)
+        transfer = TransferConfig(multipart_threshold=chunk_size,
+                                  multipart_chunksize=chunk_size,
+                                  use_threads=False)
+        with tracing.span("s3.upload_fileobj") as span:
+            with requests.get(url, stream=True) as download:
+                download.raise_for_status()
+                download.raw.decode_content = True
+                if "Content-Length" in download.headers:
+                    span.bytes = int(download.headers["Content-Length"])
+                docobj.upload_fileobj(download.raw, Config=transfer)
         if caption is not None:
             capobj.put(Body=caption)
         if thumb is not None:
             thumbobj.put(Body=str(thumb))
 
-    except ClientError as error:
+    except (ClientError, requests.exceptions.RequestException) as error:
         raise AWSError("Problem getting {} from {} bucket ({})"
                        .format(key, bucket, str(error)))
     return
@@ -279,7 +357,9 @@ def put_text_file(bucket, key, text):
     s3_new_file = s3_resource.Object(bucket, key)
 
     try:
-        s3_new_file.put(Body=text)
+        with tracing.span("s3.put_object") as span:
+            span.bytes = len(text)
+            s3_new_file.put(Body=text)
     except ClientError as error:
         raise AWSError("Problem getting object {} from {} ({})"
                        .format(key, bucket, str(error)))
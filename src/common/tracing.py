@@ -0,0 +1,223 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tracing Module
+Times the external calls made while handling one update
+
+Tracing is switched on with CONFIG['TRACE_ENABLED']. Each update handled
+by a function decorated with traced_update gets a trace, every call
+wrapped with traced or span adds its operation, duration, status and
+bytes to it, and one summary line is written when the update is done.
+With CONFIG['TRACE_FORMAT'] set to 'emf' the summary is written in
+CloudWatch Embedded Metric Format so the durations become metrics.
+
+When tracing is off, or a call happens outside of a traced update,
+the wrappers only check one module variable.
+"""
+
+import functools
+import json
+import sys
+import time
+from settings import CONFIG
+
+# Spans of the update being handled, None when nothing is traced
+_spans = None
+
+
+class Span(object):
+    """
+    Times one external call and adds it to the current trace
+    """
+    __slots__ = ('operation', 'status', 'bytes', '_started')
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.status = None
+        self.bytes = None
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = (time.perf_counter() - self._started) * 1000
+        if exc_type is not None:
+            self.status = exc_type.__name__
+        spans = _spans
+        if spans is not None:
+            spans.append((self.operation, duration, self.status or 'ok', self.bytes))
+        return False
+
+    def response(self, response):
+        """
+        Records status and body size of a requests response
+
+        :param response: requests Response, not a streamed one
+        """
+        self.status = response.status_code
+        self.bytes = len(response.content)
+
+
+class _NoSpan(object):
+    """
+    Stand-in returned by span() when nothing is traced
+    """
+    __slots__ = ('status', 'bytes')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def response(self, response):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(operation):
+    """
+    Context manager timing a block as one operation of the current trace
+
+    :param operation: Operation name, e.g. 'telegram.sendMessage'
+    :return: Span, status and bytes can be set on it inside the block
+    """
+    if _spans is None:
+        return _NO_SPAN
+    return Span(operation)
+
+
+def traced(operation):
+    """
+    Decorator timing every call of a function as one operation
+
+    The status is 'ok' unless the function raises, then it is the
+    name of the exception class.
+
+    :param operation: Operation name, e.g. 'dynamodb.get_item'
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _spans is None:
+                return function(*args, **kwargs)
+            with Span(operation):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def traced_update(handler):
+    """
+    Decorator for Lambda entry points, traces one update per call
+
+    :param handler: Handler name written with the summary
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            global _spans
+            if not CONFIG.get('TRACE_ENABLED'):
+                return function(*args, **kwargs)
+            _spans = []
+            status = 'ok'
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception as error:
+                status = type(error).__name__
+                raise
+            finally:
+                duration = (time.perf_counter() - started) * 1000
+                spans, _spans = _spans, None
+                emit(handler, status, duration, spans)
+        return wrapper
+    return decorator
+
+
+def summarize(handler, status, duration, spans):
+    """
+    Builds the summary of one traced update
+
+    :param handler: Handler name
+    :param status: 'ok' or the exception class that ended the update
+    :param duration: Duration of the whole update in milliseconds
+    :param spans: List of (operation, duration, status, bytes) tuples
+    :return: Summary dictionary
+    """
+    operations = {}
+    for (operation, span_duration, _, _) in spans:
+        operations[operation] = operations.get(operation, 0.0) + span_duration
+    return {
+        'handler': handler,
+        'status': status,
+        'duration_ms': round(duration, 3),
+        'external_ms': round(sum(operations.values()), 3),
+        'calls': len(spans),
+        'operations': {
+            operation: round(total, 3)
+            for (operation, total) in operations.items()},
+        'spans': [
+            {
+                'op': operation,
+                'ms': round(span_duration, 3),
+                'status': span_status,
+                'bytes': span_bytes
+            }
+            for (operation, span_duration, span_status, span_bytes) in spans]
+    }
+
+
+def emit(handler, status, duration, spans):
+    """
+    Writes the summary line of one traced update
+
+    The line goes straight to stdout: the Lambda log handler prefixes
+    records with a timestamp and request id, which CloudWatch would not
+    parse as Embedded Metric Format.
+    """
+    summary = summarize(handler, status, duration, spans)
+    if CONFIG.get('TRACE_FORMAT', 'json') == 'emf':
+        metrics = [
+            {'Name': 'UpdateDuration', 'Unit': 'Milliseconds'},
+            {'Name': 'ExternalDuration', 'Unit': 'Milliseconds'},
+            {'Name': 'ExternalCalls', 'Unit': 'Count'}
+        ]
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': CONFIG.get('TRACE_NAMESPACE', 'OutlineDistribution'),
+                    'Dimensions': [['Handler']],
+                    'Metrics': metrics
+                }]
+            },
+            'Handler': handler,
+            'Status': status,
+            'UpdateDuration': summary['duration_ms'],
+            'ExternalDuration': summary['external_ms'],
+            'ExternalCalls': summary['calls'],
+            'spans': summary['spans']
+        }
+        for (operation, total) in summary['operations'].items():
+            metrics.append({'Name': operation, 'Unit': 'Milliseconds'})
+            record[operation] = total
+    else:
+        record = summary
+    sys.stdout.write(json.dumps(record) + '\n')
@@ -14,19 +14,23 @@
 
 """ Email Responder Lambda Function """
 
-import logging
 import api
 from botocore.exceptions import ClientError
+import dynamodb
 import feedback
-from ses import parse_ses_notification
+from ses import parse_ses_notification, get_message_id
 from settings import CONFIG
 from template import TEMPLATES
+from lazy import lazy_module
+import logconfig
+import tracing
 import urllib.parse
-import jinja2
 
+# Duplicates and ignored emails are answered without rendering
+jinja2 = lazy_module('jinja2')
 
-logger = logging.getLogger()
-logger.setLevel(CONFIG['LOG_LEVEL'])
+
+logger = logconfig.setup()
 
 
 def render_template(template, **kwargs):
@@ -123,6 +127,8 @@ def email_key(source_email, awsurl):
         return False
 
 
+@logconfig.flushed
+@tracing.traced_update('mail_responder')
 def mail_responder(event, _):
     """
     Main entry point to handle the feedback form
@@ -130,19 +136,30 @@ def mail_responder(event, _):
     :return: True when successful, False otherwise
     """
     logger.info('%s: Request received:%s', __name__,
-                str(event['Records'][0]['eventSource']))
+                event['Records'][0]['eventSource'])
+    logconfig.log_payload('Request received', event)
 
     try:
         (source_email, recipient) = parse_ses_notification(
             event['Records'][0]['ses'])
+        message_id = get_message_id(event['Records'][0]['ses'])
     except Exception:
         logger.error('Error parsing received Email')
         return False
 
+    # SES may deliver the same email more than once, make sure only
+    # the first delivery reaches the API
+    if CONFIG['DEDUPE_DYNAMO_TABLE'] and message_id:
+        if not dynamodb.claim_message(
+                table=CONFIG['DEDUPE_DYNAMO_TABLE'],
+                message_id=message_id,
+                ttl=CONFIG['DEDUPE_TTL']):
+            logger.info('Duplicate delivery of message %s ignored', message_id)
+            return True
+
     LANG = CONFIG['LANG']
 
-    logger.debug('Source Email {} recipient {}'.format(
-        source_email, recipient))
+    logger.debug('Source Email %s recipient %s', source_email, recipient)
 
     if recipient == CONFIG['TEST_EMAIL']:
         feedback.send_email(
@@ -178,7 +195,7 @@ def mail_responder(event, _):
         try:
             user_exist = api.get_user(source_email)
         except Exception:
-            logger.error('API error when checking {}'.format(source_email))
+            logger.error('API error when checking %s', source_email)
             email(source_email, 'try_again.j2')
             return False
 
@@ -186,7 +203,7 @@ def mail_responder(event, _):
             try:
                 api.create_user(source_email, 'EM')
             except Exception:
-                logger.error('API error when Creating {}'.format(source_email))
+                logger.error('API error when Creating %s', source_email)
                 email(source_email, 'try_again.j2')
                 return False
 
@@ -194,7 +211,7 @@ def mail_responder(event, _):
             new_key = api.get_new_key(user_id=source_email)
         except Exception:
             logger.error(
-                'API error when getting key fo {}'.format(source_email))
+                'API error when getting key fo %s', source_email)
             email(source_email, 'try_again.j2')
             return False
 
@@ -33,3 +33,13 @@ def parse_ses_notification(ses_notification):
     source_email = ses_notification['mail']['source']
     recipient = ses_notification['mail']['destination'][0].lower()
     return (source_email, recipient)
+
+
+def get_message_id(ses_notification):
+    """
+    Unique id SES assigned to the incoming email
+
+    :param ses_notification: ses object from Lambda event
+    :return: message id or None if it is missing
+    """
+    return ses_notification['mail'].get('messageId')
@@ -12,6 +12,10 @@ CONFIG = {
     'APP_PATH': os.path.dirname(os.path.abspath(__file__)),
     'MAX_ATTACHMENT_SIZE': 0,    # max size in bytes of attachment
     'LOG_LEVEL': logging.INFO,
+    # 'text' or 'json', JSON records are written from a background thread
+    'LOG_FORMAT': 'text',
+    # Share of updates whose whole payload is logged
+    'LOG_PAYLOAD_SAMPLE_RATE': 0.01,
 
     'TEST_EMAIL': 'test_me@$EMAIL_DOMAIN',
     'TEST_EMAIL_NEW': 'test_me_new@$EMAIL_DOMAIN',
@@ -22,8 +26,25 @@ CONFIG = {
     'SUPPORT_EMAIL': 'support@$EMAIL_DOMAIN',
     'INSTRUCTION_URL': '$INSTRUCTION_URL',
 
+    # Chat state backend: 'dynamodb', 'memory' or 'sqlite'
+    'STATE_BACKEND': 'dynamodb',
+    'STATE_SQLITE_FILE': '/tmp/outline-state.db',
+    # One summary line of external call timings per update: 'json' or 'emf'
+    'TRACE_ENABLED': False,
+    'TRACE_FORMAT': 'json',
+    'DEDUPE_DYNAMO_TABLE': '$AWS_DEDUPE_DYNAMO_TABLE',
+    'DEDUPE_TTL': 86400,    # seconds to remember a handled message id
+
     'API_KEY': '$API_KEY',
     'API_URL': '$API_URL',
+    # Read timeout of API calls in seconds
+    'API_TIMEOUT': 10,
+    # The API circuit breaker opens after this many failed calls in a row,
+    # a call slower than API_SLOW_CALL seconds counts as failed
+    'API_BREAKER_FAILURES': 5,
+    'API_SLOW_CALL': 5,
+    # Seconds the breaker refuses calls before letting one probe through
+    'API_BREAKER_RESET': 30,
     'OUTLINE_AWS_URL': 'https://s3.amazonaws.com/outline-vpn/invite.html#{}',
     'OUTLINE_GUIDELINE_PHOTO': {
         'en': '',
@@ -12,19 +12,50 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import csv
+import io
+import logging
+import time
 import dynamodb
 import api
 import telegram
-from errors import ValidationError
+import callbacks
+from composer import Reply
+from errors import TelegramError, ValidationError
 from urllib.parse import urlparse
 from settings import CONFIG, STATUSES
 from helpers import (
     make_language_keyboard,
+    language_index,
     save_chat_status,
     get_tos_link,
     get_pp_link,
     change_lang)
 import globalvars
+import ingest
+import servers
+import stats
+from keyboards import ADMIN_ACTIONS, get_keyboards, picker
+
+logger = logging.getLogger()
+
+# Documents accepted as a list of usernames to ban
+BAN_LIST_TYPES = [
+    'text/csv',
+    'text/plain',
+    'text/comma-separated-values',
+    'application/csv',
+    'application/vnd.ms-excel'
+]
+# Header cells skipped in a list of usernames
+BAN_LIST_HEADERS = ['username', 'usernames', 'user', 'telegram']
+# Seconds between edits of the bulk ban progress message
+PROGRESS_INTERVAL = 2
+# Longest ban list handled inside the webhook, API Gateway gives up
+# after 29 seconds and Telegram then sends the document again
+BULK_BAN_MAX_USERS = 200
+# Longest ban list handled by the queue consumer
+BULK_BAN_MAX_QUEUED = 5000
 
 def is_url(link):
     """
@@ -79,28 +110,151 @@ def make_admin_keyboard():
     :return: Telegram Keyboard containing admin commands
     """
 
-    return telegram.make_keyboard(
-        [
-            globalvars.lang.text('MENU_ADMIN_BAN_USER'),
-            globalvars.lang.text('MENU_ADMIN_TERMS_OF_SERVICE'),
-            globalvars.lang.text('MENU_ADMIN_PRIVACY_POLICY'),
-            globalvars.lang.text('MENU_ADMIN_ENROLLED_USERS'),
-            globalvars.lang.text('MENU_ADMIN_BANNED_USERS'),
-            globalvars.lang.text('MENU_ADMIN_BLOCKED_KEYS'),
-            globalvars.lang.text('MENU_HOME_CHANGE_LANGUAGE'),
-            globalvars.lang.text('MENU_ADMIN_EXIT')
-        ],
-        3,
-        ''
-    )        
+    return picker(get_keyboards(globalvars.lang), 'ADMIN')
+
+def admin_action(text):
+    """
+    Finds the admin menu entry of a button text
+
+    :param text: text of the pressed button
+    :return: ADMIN_ACTIONS entry or None
+    """
+    for action in ADMIN_ACTIONS:
+        if text == globalvars.lang.text(action):
+            return action
+    return None
+
+def read_usernames(content):
+    """
+    Reads the usernames of a CSV or text file, one per row
+
+    :param content: file contents in bytes
+    :return: List of unique usernames in file order
+    :raise: ValidationError: file is not UTF-8 text
+    """
+    try:
+        text = content.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise ValidationError("File is not UTF-8 text")
+    usernames = []
+    seen = set()
+    for row in csv.reader(text.splitlines()):
+        if not row:
+            continue
+        username = row[0].strip().lstrip('@')
+        if (not username or username.lower() in BAN_LIST_HEADERS
+                or username in seen):
+            continue
+        seen.add(username)
+        usernames.append(username)
+    return usernames
 
-def admin_menu(token, tmsg, chat_status):
+def bulk_ban(token, tmsg):
+    """
+    Bans the users listed in a document the admin sent
+
+    The bans run concurrently, a progress message is edited while they
+    run and the result of each username is sent back as a CSV file.
+    Longer lists are refused so the bans finish before the webhook
+    times out, queued ingestion allows longer lists.
+
+    :param token: Telegram Bot Token
+    :param tmsg: Telegram message with the document
+    :return: List of (username, status), None if the file has no usernames
+    :raise: TelegramError: Telegram API call failed
+    """
+    usernames = None
+    if tmsg.bodymime in BAN_LIST_TYPES:
+        try:
+            usernames = read_usernames(telegram.download_file(token, tmsg.body))
+        except ValidationError as error:
+            logger.warning('Bulk ban file rejected: %s', error)
+    if not usernames:
+        telegram.send_message(
+            token,
+            tmsg.chat_id,
+            globalvars.lang.text('MSG_BULK_BAN_EMPTY'))
+        return None
+    if ingest.queued():
+        limit = CONFIG.get('BULK_BAN_MAX_QUEUED', BULK_BAN_MAX_QUEUED)
+    else:
+        limit = CONFIG.get('BULK_BAN_MAX_USERS', BULK_BAN_MAX_USERS)
+    if len(usernames) > limit:
+        telegram.send_message(
+            token,
+            tmsg.chat_id,
+            globalvars.lang.text('MSG_BULK_BAN_TOO_LONG').format(len(usernames), limit))
+        return None
+
+    progress_text = globalvars.lang.text('MSG_BULK_BAN_PROGRESS')
+    response = telegram.send_message(
+        token,
+        tmsg.chat_id,
+        progress_text.format(0, len(usernames)))
+    message_id = response.json()['result']['message_id']
+    last_edit = [time.monotonic()]
+
+    def progress(done, total):
+        now = time.monotonic()
+        if done == total or now - last_edit[0] < PROGRESS_INTERVAL:
+            return
+        last_edit[0] = now
+        try:
+            telegram.edit_message_text(
+                token, tmsg.chat_id, message_id, progress_text.format(done, total))
+        except TelegramError as error:
+            logger.warning('Bulk ban progress not shown: %s', error)
+
+    results = api.ban_users(
+        usernames,
+        workers=CONFIG.get('BULK_BAN_WORKERS', api.BULK_WORKERS),
+        progress=progress)
+    telegram.edit_message_text(
+        token, tmsg.chat_id, message_id,
+        progress_text.format(len(usernames), len(usernames)))
+
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(['username', 'status'])
+    writer.writerows(results)
+    telegram.send_csv(token, tmsg.chat_id, buf.getvalue(), 'ban_results.csv')
+
+    statuses = [status for (_, status) in results]
+    telegram.send_message(
+        token,
+        tmsg.chat_id,
+        globalvars.lang.text('MSG_BULK_BAN_DONE').format(
+            statuses.count('banned'),
+            statuses.count('not_found'),
+            statuses.count('error')))
+    return results
+
+def refresh_server(token, tmsg):
+    """
+    Drops the cached blocked flag of the server given as command argument
+
+    :param token: Telegram Bot Token
+    :param tmsg: Telegram message with the command
+    """
+    server_id = tmsg.command_arg.strip()
+    if not server_id:
+        message = globalvars.lang.text('MSG_REFRESH_SERVER_USAGE').format(
+            CONFIG.get('TELEGRAM_REFRESH_SERVER_COMMAND', 'refreshserver'))
+    elif servers.invalidate(server_id):
+        message = globalvars.lang.text('MSG_SERVER_REFRESHED').format(server_id)
+    else:
+        message = globalvars.lang.text('MSG_ERROR')
+    telegram.send_message(token, tmsg.chat_id, message)
+
+def admin_menu(token, tmsg, chat_status, choice=None):
     """
     Handles admin only menu
 
     :param token: Telegram Bot Token
     :param tmsg: Telegram message from user
     :param chat_status: Representing the state of the chat with the user
+    :param choice: what the admin picked on an inline keyboard, an
+        ADMIN_ACTIONS entry in the admin home or a language index
     
     :return: False in case user should not see admin menu
     """    
@@ -111,44 +265,36 @@ def admin_menu(token, tmsg, chat_status):
     admin_keyboard = make_admin_keyboard()
 
     if chat_status < STATUSES['ADMIN_SECTION_HOME']:
+        save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_HOME'])
         telegram.send_keyboard(
             token,
             tmsg.chat_id,
             globalvars.lang.text('MSG_ADMIN_HOME'),
             admin_keyboard)
-        save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_HOME'])
     elif chat_status == STATUSES['ADMIN_SECTION_HOME']:
-        if (tmsg.body == globalvars.lang.text('MENU_ADMIN_EXIT')):
+        action = choice if choice is not None else admin_action(tmsg.body)
+        if action == 'MENU_ADMIN_EXIT':
             save_chat_status(tmsg.chat_id, STATUSES['HOME'])
             return False
-        elif (tmsg.body == globalvars.lang.text('MENU_ADMIN_BAN_USER')):
-            telegram.send_message(
-                token,
-                tmsg.chat_id,
-                globalvars.lang.text('MSG_ENTER_USER_TO_BAN'),
-                '')
+        elif action == 'MENU_ADMIN_BAN_USER':
             save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_BAN_USER'])
-        elif (tmsg.body == globalvars.lang.text('MENU_ADMIN_TERMS_OF_SERVICE')):
-            telegram.send_message(
+            callbacks.show(
                 token,
-                tmsg.chat_id,
-                globalvars.lang.text('MSG_CURRENT_LINK').format(get_tos_link()))
-            telegram.send_message(
-                token,
-                tmsg.chat_id,
-                globalvars.lang.text('MSG_ENTER_TERMS_OF_SERVICE'))
+                tmsg,
+                globalvars.lang.text('MSG_ENTER_USER_TO_BAN'))
+        elif action == 'MENU_ADMIN_TERMS_OF_SERVICE':
             save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_TERMS_OF_SERVICE'])
-        elif (tmsg.body == globalvars.lang.text('MENU_ADMIN_PRIVACY_POLICY')):
-            telegram.send_message(
-                token,
-                tmsg.chat_id,
-                globalvars.lang.text('MSG_CURRENT_LINK').format(get_pp_link()))
-            telegram.send_message(
-                token,
-                tmsg.chat_id,
-                globalvars.lang.text('MSG_ENTER_PRIVACY_POLICY'))
+            reply = Reply(token, tmsg.chat_id, callbacks.message_id(tmsg))
+            reply.add(globalvars.lang.text('MSG_CURRENT_LINK').format(get_tos_link()))
+            reply.add(globalvars.lang.text('MSG_ENTER_TERMS_OF_SERVICE'))
+            reply.send()
+        elif action == 'MENU_ADMIN_PRIVACY_POLICY':
             save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_PRIVACY_POLICY'])
-        elif (tmsg.body == globalvars.lang.text('MENU_ADMIN_ENROLLED_USERS')):
+            reply = Reply(token, tmsg.chat_id, callbacks.message_id(tmsg))
+            reply.add(globalvars.lang.text('MSG_CURRENT_LINK').format(get_pp_link()))
+            reply.add(globalvars.lang.text('MSG_ENTER_PRIVACY_POLICY'))
+            reply.send()
+        elif action == 'MENU_ADMIN_ENROLLED_USERS':
             try:
                 telegram.send_csv(token, tmsg.chat_id, api.get_enrolled_users(), 'enrolled_users.csv')
             except ValidationError:
@@ -158,12 +304,14 @@ def admin_menu(token, tmsg, chat_status):
                     globalvars.lang.text('MSG_ERROR'),
                     admin_keyboard)
                 return True
-            telegram.send_message(
-                token,
-                tmsg.chat_id,
-                globalvars.lang.text('MSG_ADMIN_HOME'),
-                admin_keyboard)
-        elif (tmsg.body == globalvars.lang.text('MENU_ADMIN_BANNED_USERS')):
+            if choice is None:
+                # A pressed inline menu stays usable, it is not sent again
+                telegram.send_message(
+                    token,
+                    tmsg.chat_id,
+                    globalvars.lang.text('MSG_ADMIN_HOME'),
+                    admin_keyboard)
+        elif action == 'MENU_ADMIN_BANNED_USERS':
             try:
                 telegram.send_csv(token, tmsg.chat_id, api.get_banned_users(), 'banned_users.csv')
             except ValidationError:
@@ -173,12 +321,13 @@ def admin_menu(token, tmsg, chat_status):
                     globalvars.lang.text('MSG_ERROR'),
                     admin_keyboard)
                 return True
-            telegram.send_message(
-                token,
-                tmsg.chat_id,
-                globalvars.lang.text('MSG_ADMIN_HOME'),
-                admin_keyboard)
-        elif (tmsg.body == globalvars.lang.text('MENU_ADMIN_BLOCKED_KEYS')):
+            if choice is None:
+                telegram.send_message(
+                    token,
+                    tmsg.chat_id,
+                    globalvars.lang.text('MSG_ADMIN_HOME'),
+                    admin_keyboard)
+        elif action == 'MENU_ADMIN_BLOCKED_KEYS':
             try:
                 telegram.send_csv(token, tmsg.chat_id, api.get_enrolled_users(blocked=True), 'blocked_keys.csv')
             except ValidationError:
@@ -188,19 +337,26 @@ def admin_menu(token, tmsg, chat_status):
                     globalvars.lang.text('MSG_ERROR'),
                     admin_keyboard)
                 return True
-            telegram.send_message(
-                token,
-                tmsg.chat_id,
-                globalvars.lang.text('MSG_ADMIN_HOME'),
-                admin_keyboard)
-        elif (tmsg.body == globalvars.lang.text('MENU_HOME_CHANGE_LANGUAGE')):
-            keyboard = make_language_keyboard()
-            telegram.send_keyboard(
+            if choice is None:
+                telegram.send_message(
+                    token,
+                    tmsg.chat_id,
+                    globalvars.lang.text('MSG_ADMIN_HOME'),
+                    admin_keyboard)
+        elif action == 'MENU_ADMIN_STATS':
+            rows = stats.report()
+            if rows is None:
+                message = globalvars.lang.text('MSG_ERROR')
+            else:
+                message = stats.render(rows, globalvars.lang.text('MSG_ADMIN_STATS'))
+            callbacks.show(token, tmsg, message, admin_keyboard)
+        elif action == 'MENU_HOME_CHANGE_LANGUAGE':
+            save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SET_LANGUAGE'])
+            callbacks.show(
                 token,
-                tmsg.chat_id,
+                tmsg,
                 globalvars.lang.text('MSG_SELECT_LANGUAGE'),
-                keyboard)
-            save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SET_LANGUAGE'])
+                make_language_keyboard())
         else:
             telegram.send_keyboard(
                 token,
@@ -208,11 +364,33 @@ def admin_menu(token, tmsg, chat_status):
                 globalvars.lang.text('MSG_ADMIN_HOME'),
                 admin_keyboard
             )
+    elif chat_status == STATUSES['ADMIN_SECTION_BAN_USER'] and tmsg.bodytype == 'DOCUMENT':
+        save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_HOME'])
+        try:
+            results = bulk_ban(token, tmsg)
+        except TelegramError:
+            telegram.send_message(
+                token,
+                tmsg.chat_id,
+                globalvars.lang.text('MSG_ERROR'),
+                admin_keyboard)
+            return True
+        if results is None:
+            # The admin can send another file or a single username
+            save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_BAN_USER'])
+            return True
+        telegram.send_keyboard(
+            token,
+            tmsg.chat_id,
+            globalvars.lang.text('MSG_ADMIN_HOME'),
+            admin_keyboard)
     elif chat_status == STATUSES['ADMIN_SECTION_BAN_USER']:
+        save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_HOME'])
         ret = None
         try:
             ret = api.ban_user(tmsg.body)
         except Exception as exc:
+            save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_BAN_USER'])
             telegram.send_message(
                 token,
                 tmsg.chat_id,
@@ -234,39 +412,34 @@ def admin_menu(token, tmsg, chat_status):
             globalvars.lang.text('MSG_ADMIN_HOME'),
             admin_keyboard
         )            
-        save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_HOME'])    
     elif chat_status == STATUSES['ADMIN_SET_LANGUAGE']:
-        if (tmsg.body is None or
-                tmsg.body not in globalvars.lang.text(
-                    'SUPPORTED_LANGUAGES')):
+        save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_HOME'])
+        index = choice if choice is not None else language_index(tmsg.body)
+        if index is None:
             message = globalvars.lang.text('MSG_LANGUAGE_CHANGE_ERROR')
         else:
-            new_lang = CONFIG['SUPPORTED_LANGUAGES'][globalvars.lang.text(
-                'SUPPORTED_LANGUAGES').index(tmsg.body)]
+            label = globalvars.lang.text('SUPPORTED_LANGUAGES')[index]
+            new_lang = CONFIG['SUPPORTED_LANGUAGES'][index]
             dynamodb.save_user_lang(
                 table=CONFIG["DYNAMO_TABLE"],
                 chat_id=tmsg.chat_id,
                 language=new_lang)
             change_lang(new_lang)
             admin_keyboard = make_admin_keyboard()
-            message = globalvars.lang.text('MSG_LANGUAGE_CHANGED').format(tmsg.body)
+            message = globalvars.lang.text('MSG_LANGUAGE_CHANGED').format(label)
             
-        telegram.send_message(
-                token,
-                tmsg.chat_id,
-                message)
+        callbacks.show(token, tmsg, message)
         telegram.send_keyboard(
                 token,
                 tmsg.chat_id,
                 globalvars.lang.text('MSG_ADMIN_HOME'),
                 admin_keyboard)
-        save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_HOME'])
     elif chat_status == STATUSES['ADMIN_SECTION_TERMS_OF_SERVICE']:
+        save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_HOME'])
         if(store_tos_link(tmsg.body)):
             message = globalvars.lang.text('MSG_LINK_SAVED')            
         else:
             message = globalvars.lang.text('MSG_LINK_ERROR')
-        save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_HOME'])
         telegram.send_message(
             token,
             tmsg.chat_id,
@@ -280,11 +453,11 @@ def admin_menu(token, tmsg, chat_status):
         )
         return True
     elif chat_status == STATUSES['ADMIN_SECTION_PRIVACY_POLICY']:
+        save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_HOME'])
         if(store_pp_link(tmsg.body)):
             message = globalvars.lang.text('MSG_LINK_SAVED')            
         else:
             message = globalvars.lang.text('MSG_LINK_ERROR')
-        save_chat_status(tmsg.chat_id, STATUSES['ADMIN_SECTION_HOME'])
         telegram.send_message(
             token,
             tmsg.chat_id,
@@ -0,0 +1,119 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Asset Module
+Sends the static images shipped with the bot
+
+An image is uploaded once per language, later sends only pass the
+file_id Telegram returned. A language can have its own copy of an image
+in a directory named after the language, e.g. fa/guide.png, otherwise
+the one next to the handler is used. The bytes are read from disk once
+per process and kept for the case Telegram no longer knows the file_id.
+The file_id is saved under the digest of the bytes, so a new version of
+an image shipped with a deploy is uploaded again.
+"""
+
+import hashlib
+import logging
+import os
+from errors import TelegramError
+import fileids
+import telegram
+from settings import CONFIG
+
+logger = logging.getLogger()
+
+_buffers = {}
+_digests = {}
+
+
+def asset_path(setting, language):
+    """
+    Finds the file of an asset
+
+    :param setting: CONFIG key holding the file name, e.g.
+        'OUTLINE_GUIDE_PHOTO_FILE'
+    :param language: language the asset is sent in
+    :return: path of the file
+    """
+    filename = CONFIG[setting]
+    localized = os.path.join(language, filename)
+    if os.path.isfile(localized):
+        return localized
+    return filename
+
+
+def asset_contents(path):
+    """
+    Reads an asset, once per process
+
+    :param path: path of the file
+    :return: file contents
+    """
+    contents = _buffers.get(path)
+    if contents is None:
+        with open(path, 'rb') as asset:
+            contents = asset.read()
+        _buffers[path] = contents
+    return contents
+
+
+def asset_digest(path):
+    """
+    Digest of an asset, computed once per process
+
+    :param path: path of the file
+    :return: hex digest of the file contents
+    """
+    digest = _digests.get(path)
+    if digest is None:
+        digest = hashlib.md5(asset_contents(path)).hexdigest()
+        _digests[path] = digest
+    return digest
+
+
+def send_photo(token, chat_id, setting, language, caption=None):
+    """
+    Sends an image asset, by file_id once it was uploaded
+
+    :param token: Telegram bot token
+    :param chat_id: ID of the chat with the user
+    :param setting: CONFIG key holding the file name
+    :param language: language the asset is sent in
+    :param caption: caption of the photo
+    :return: Telegram response object
+    :raise: TelegramError: Telegram API call failed
+    """
+    path = asset_path(setting, language)
+    name = fileids.asset_name(path, language, asset_digest(path))
+    file_id = fileids.get_file_id(name)
+    if file_id is not None:
+        try:
+            return telegram.send_photo(token, chat_id, file_id, None, caption)
+        except TelegramError as error:
+            logger.warning('Uploading %s again: %s', path, error)
+            fileids.forget_file_id(name)
+
+    contents = asset_contents(path)
+    response = telegram.send_photo(
+        token, chat_id, contents, os.path.basename(path), caption)
+    try:
+        # The last size is the original image
+        file_id = response.json()['result']['photo'][-1]['file_id']
+    except (ValueError, KeyError, IndexError):
+        logger.warning('No file_id for %s in the sendPhoto response', path)
+        return response
+    fileids.save_file_id(name, file_id, asset_digest(path))
+    return response
@@ -0,0 +1,119 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Callback Module
+Compact callback_data of the inline keyboards and helpers for answering
+button presses
+
+callback_data is '<kind>:<value>', e.g. 'i:3' for issue 3, so routing
+does not depend on the localized button texts.
+"""
+
+import logging
+from errors import TelegramError, ValidationError
+import telegram
+
+logger = logging.getLogger()
+
+ISSUE = 'i'
+DELETE_REASON = 'r'
+LANGUAGE = 'l'
+ADMIN = 'a'
+HOME = 'h'
+
+# Telegram limit for callback_data, in bytes
+MAX_DATA_LENGTH = 64
+
+
+def encode(kind, value=''):
+    """
+    Makes the callback_data of a button
+
+    :param kind: one of the kinds above
+    :param value: id of the choice
+    :return: callback_data
+    :raise: ValidationError: callback_data too long
+    """
+    data = '{}:{}'.format(kind, value)
+    if len(data.encode('utf-8')) > MAX_DATA_LENGTH:
+        raise ValidationError('callback_data too long: {}'.format(data))
+    return data
+
+
+def decode(data):
+    """
+    Splits callback_data into kind and value
+
+    :param data: callback_data of the pressed button
+    :return: (kind, value), (None, None) if data is not ours
+    """
+    (kind, separator, value) = (data or '').partition(':')
+    if not separator:
+        return (None, None)
+    return (kind, value)
+
+
+def answer(token, tmsg, text=None):
+    """
+    Answers a button press, Telegram shows a progress indicator until then
+
+    :param token: Telegram bot token
+    :param tmsg: Telegram message of type CALLBACK
+    :param text: notification shown to the user
+    """
+    try:
+        telegram.send_answer_callbackquery(token, tmsg.id, text, False)
+    except TelegramError as error:
+        logger.warning('Unable to answer callback query: %s', error)
+
+
+def message_id(tmsg):
+    """
+    Message that holds the pressed inline keyboard
+
+    :param tmsg: Telegram message
+    :return: message ID or None if tmsg is not a button press
+    """
+    if tmsg.type != 'CALLBACK' or tmsg.inline:
+        return None
+    return tmsg.msg_id
+
+
+def show(token, tmsg, text, keyboard=None, parse=None):
+    """
+    Shows a text to the user, in place of the pressed inline keyboard's
+    message for a button press and as a new message otherwise
+
+    :param token: Telegram bot token
+    :param tmsg: Telegram message
+    :param text: text to show
+    :param keyboard: inline keyboard to show with the text
+    :param parse: Format to parse message in
+    :return: Telegram response object
+    """
+    edit_id = message_id(tmsg)
+    if edit_id is not None:
+        try:
+            return telegram.edit_message_text(
+                token, tmsg.chat_id, edit_id, text, keyboard, parse)
+        except TelegramError as error:
+            # Pressing a button twice may ask for the same text again
+            if 'message is not modified' not in str(error):
+                raise
+            return None
+    if keyboard:
+        return telegram.send_keyboard(
+            token, tmsg.chat_id, text, keyboard, parse=parse)
+    return telegram.send_message(token, tmsg.chat_id, text, parse=parse)
@@ -0,0 +1,149 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Reply Composer
+Collects the messages of a reply and sends them in as few calls as
+possible
+
+Consecutive texts are joined into one message when their parse modes
+agree and the result fits in a Telegram message. Plain text joins a
+Markdown or HTML message when it has none of that mode's markup
+characters. A text added with separate=True, like an access key the
+user has to copy, is always sent on its own. A closing text, like the
+question that comes with the home keyboard, is left out when it can
+not join the message before it. The keyboard goes with the last
+message. A reply to a button press can replace the text of the
+message that holds the pressed inline keyboard with its first message.
+"""
+
+from errors import ValidationError
+import telegram
+
+MAX_MESSAGE_LENGTH = 4096
+SEPARATOR = '\n\n'
+
+# Characters plain text must not contain to be sent in a parse mode
+MARKUP_CHARACTERS = {
+    'MARKDOWN': set('_*`['),
+    'HTML': set('<>&')
+}
+
+
+def message_length(text):
+    """
+    Length of a text the way Telegram counts it, in UTF-16 code units
+
+    :param text: message text
+    :return: length
+    """
+    return len(text.encode('utf-16-le')) // 2
+
+
+def _merged_parse(first, second, first_text, second_text):
+    """
+    Parse mode two texts can share
+
+    :return: parse mode, or False if the texts can not be joined
+    """
+    if first == second:
+        return first
+    if first is None and not MARKUP_CHARACTERS[second] & set(first_text):
+        return second
+    if second is None and not MARKUP_CHARACTERS[first] & set(second_text):
+        return first
+    return False
+
+
+class Reply(object):
+    """
+    Outgoing messages to one chat, sent by send()
+    """
+    __slots__ = ('token', 'chat_id', 'message_id', '_parts')
+
+    def __init__(self, token, chat_id, message_id=None):
+        """
+        :param token: Telegram bot token
+        :param chat_id: ID of the chat with the user
+        :param message_id: message the first message is edited into
+        """
+        self.token = token
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self._parts = []
+
+    def add(self, text, parse=None, separate=False, closing=False):
+        """
+        Queues a text
+
+        :param text: message text
+        :param parse: 'MARKDOWN', 'HTML' or None for plain text
+        :param separate: send the text as a message of its own
+        :param closing: leave the text out unless it joins the message
+            before it, so it does not cost a call of its own
+        :raise: ValidationError: text is empty
+        """
+        if text is None or len(text) <= 0:
+            raise ValidationError("Text cannot be empty")
+        self._parts.append((text, parse, separate, closing))
+
+    def messages(self):
+        """
+        Joins the queued texts
+
+        :return: List of (text, parse) of the messages to send
+        """
+        messages = []
+        joinable = False
+        for (text, parse, separate, closing) in self._parts:
+            if joinable and not separate:
+                (last_text, last_parse) = messages[-1]
+                merged = _merged_parse(last_parse, parse, last_text, text)
+                joined = last_text + SEPARATOR + text
+                if (merged is not False
+                        and message_length(joined) <= MAX_MESSAGE_LENGTH):
+                    messages[-1] = (joined, merged)
+                    continue
+            if closing and messages:
+                continue
+            messages.append((text, parse))
+            joinable = not separate
+        return messages
+
+    def send(self, keyboard=None):
+        """
+        Sends the queued texts and empties the queue
+
+        :param keyboard: keyboard sent with the last message
+        :return: List of Telegram responses
+        :raise: TelegramError: Telegram API call failed
+        """
+        messages = self.messages()
+        self._parts = []
+        responses = []
+        for (index, (text, parse)) in enumerate(messages):
+            last = index == len(messages) - 1
+            # Reply keyboards can not be added to an edited message
+            if (index == 0 and self.message_id is not None
+                    and not (keyboard and last)):
+                responses.append(telegram.edit_message_text(
+                    self.token, self.chat_id, self.message_id, text,
+                    parse=parse))
+            elif keyboard and last:
+                responses.append(telegram.send_keyboard(
+                    self.token, self.chat_id, text, keyboard, parse=parse))
+            else:
+                responses.append(telegram.send_message(
+                    self.token, self.chat_id, text, parse=parse))
+        return responses
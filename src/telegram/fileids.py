@@ -0,0 +1,154 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+File ID Cache
+Remembers the Telegram file_id of files uploaded from S3 or the bundle
+
+Lookups go to a process local LRU first and to the info table after
+that. Entries are not validated up front: a file_id is only checked
+after sending it failed. Entries expire after CONFIG['FILE_ID_TTL']
+seconds.
+
+The name of an S3 file includes the ETag of the object and the name of
+an asset the digest of its contents, so a replaced file is never served
+from the file_id of its old version. The ETag of an S3 object is looked
+up with a HEAD request at most once every ETAG_TTL seconds per process.
+"""
+
+import time
+from collections import OrderedDict
+import dynamodb
+from lazy import lazy_module
+from settings import CONFIG
+
+storage = lazy_module('storage')
+
+CACHE_SIZE = 256
+# Seconds a process trusts the ETag it last saw for an S3 object
+ETAG_TTL = 300
+
+_cache = OrderedDict()
+_etags = {}
+
+
+def s3_name(bucket, key, etag):
+    """
+    Cache name of a version of an S3 file
+
+    :param bucket: bucket of the file in S3
+    :param key: key of the file in S3
+    :param etag: ETag of the object
+    :return: name for the functions below
+    """
+    return bucket + '/' + key + '/' + etag.strip('"')
+
+
+def asset_name(path, language, digest):
+    """
+    Cache name of a file shipped with the bot, ':' is not valid in S3
+    bucket names so it never matches an S3 file
+
+    :param path: path of the file in the bundle
+    :param language: language the file is sent in
+    :param digest: digest of the file contents
+    :return: name for the functions below
+    """
+    return 'asset:' + language + ':' + path + ':' + digest
+
+
+def current_etag(bucket, key, now=None):
+    """
+    Looks up the ETag of an S3 object
+
+    :param bucket: bucket of the file in S3
+    :param key: key of the file in S3
+    :param now: Current time in seconds since epoch
+    :return: ETag
+    :raise: AWSError: couldn't load metadata from S3
+    """
+    now = now or time.time()
+    entry = _etags.get((bucket, key))
+    if entry is not None and entry[0] > now:
+        return entry[1]
+    etag = storage.get_object_metadata(bucket, key).e_tag
+    remember_etag(bucket, key, etag, now)
+    return etag
+
+
+def remember_etag(bucket, key, etag, now=None):
+    """
+    Remembers the ETag of an S3 object, e.g. the one of an object that
+    was just read
+
+    :param bucket: bucket of the file in S3
+    :param key: key of the file in S3
+    :param etag: ETag of the object
+    :param now: Current time in seconds since epoch
+    """
+    if len(_etags) >= CACHE_SIZE:
+        _etags.clear()
+    _etags[(bucket, key)] = ((now or time.time()) + ETAG_TTL, etag)
+
+
+def get_file_id(name):
+    """
+    Looks up the file_id of a file
+
+    :param name: name from s3_name() or asset_name()
+    :return: file_id or None if the file was never uploaded
+    """
+    file_id = _cache.get(name)
+    if file_id is not None:
+        _cache.move_to_end(name)
+        return file_id
+
+    file_id = dynamodb.get_file_id(CONFIG['INFO_DYNAMO_TABLE'], name)
+    if file_id is not None:
+        _remember(name, file_id)
+    return file_id
+
+
+def save_file_id(name, file_id, etag=None):
+    """
+    Saves the file_id Telegram returned after uploading a file
+
+    :param name: name from s3_name() or asset_name()
+    :param file_id: Telegram file_id
+    :param etag: ETag or digest of the uploaded file
+    """
+    _remember(name, file_id)
+    dynamodb.save_file_id(
+        CONFIG['INFO_DYNAMO_TABLE'],
+        name,
+        file_id,
+        etag,
+        CONFIG.get('FILE_ID_TTL', 604800))
+
+
+def forget_file_id(name):
+    """
+    Drops a file_id Telegram no longer accepts from the local cache,
+    the next upload overwrites the stored one
+
+    :param name: name from s3_name() or asset_name()
+    """
+    _cache.pop(name, None)
+
+
+def _remember(name, file_id):
+    _cache[name] = file_id
+    _cache.move_to_end(name)
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
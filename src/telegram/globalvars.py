@@ -16,4 +16,12 @@ lang = None
 HOME_KEYBOARD = []
 BACK_TO_HOME_KEYBOARD = []
 OPT_IN_KEYBOARD = []
-OPT_IN_DECLINED_KEYBOARD = []
\ No newline at end of file
+OPT_IN_DECLINED_KEYBOARD = []
+
+# Status this update read the chat in, None if the chat has none, and
+# the version of the chat item its next transition starts from
+UNREAD = -1
+chat_status = UNREAD
+chat_version = None
+# Whether this update already moved the chat to a new status
+chat_claimed = False
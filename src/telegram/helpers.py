@@ -14,7 +14,8 @@
 
 import dynamodb
 import logging
-import telegram
+from errors import StateConflict
+from keyboards import get_keyboards, picker
 from translation import Translation
 from settings import CONFIG, STATUSES
 import globalvars
@@ -22,19 +23,107 @@ import globalvars
 logger = logging.getLogger()
 logger.setLevel(CONFIG['LOG_LEVEL'])
 
+# Chats abandoned in these states expire after CONFIG['ONBOARDING_TTL']
+ONBOARDING_STATUSES = (
+    STATUSES['START'],
+    STATUSES['FIRST_CAPTCHA'],
+    STATUSES['OPT_IN'],
+    STATUSES['OPT_IN_DECLINED'])
+
 def save_chat_status(chat_id, status):
     """
     Saves chat state
-    
+
+    Onboarding states set the expiry of the chat, SET_LANGUAGE is
+    reached both during onboarding and from the home menu so it keeps
+    the expiry as it is, every other state keeps the chat forever.
+
+    Once the update has read the status of the chat, the state is only
+    saved if no other update wrote to the chat since. The first save of
+    an update claims the chat for it, so it has to come before the
+    replies and API calls of the new state: if another update got there
+    first nothing was done yet and the update can be handled again.
+
     :param chat_id: Telegram Chat ID
     :param status: state
     :return: True if stored, False otherwise
+    :raise: StateConflict: another update claimed the chat first
     """
-    return dynamodb.save_chat_status(
+    if status in ONBOARDING_STATUSES:
+        ttl = CONFIG.get('ONBOARDING_TTL', 30 * 86400)
+    elif status == STATUSES['SET_LANGUAGE']:
+        ttl = None
+    else:
+        ttl = 0
+    if globalvars.chat_status == globalvars.UNREAD:
+        return dynamodb.save_chat_status(
+            table=CONFIG['DYNAMO_TABLE'],
+            chat_id=chat_id,
+            status=status,
+            ttl=ttl
+        )
+    try:
+        version = dynamodb.transition_chat_status(
+            table=CONFIG['DYNAMO_TABLE'],
+            chat_id=chat_id,
+            version=globalvars.chat_version,
+            status=status,
+            ttl=ttl
+        )
+    except StateConflict as conflict:
+        if not globalvars.chat_claimed:
+            raise
+        # The replies of the claimed state are out, the other update
+        # carries on from there
+        logger.warning('Chat %s was taken over by another update: %s', chat_id, conflict)
+        return False
+    if version is None:
+        return False
+    globalvars.chat_status = status
+    globalvars.chat_version = version
+    globalvars.chat_claimed = True
+    return True
+
+def start_chat(chat_id):
+    """
+    Takes a chat back to language selection, a chat without state is
+    created with the onboarding expiry
+
+    :param chat_id: Telegram Chat ID
+    :return: True if stored, False otherwise
+    :raise: StateConflict: another update claimed the chat first
+    """
+    if globalvars.chat_status is not None:
+        return save_chat_status(chat_id, STATUSES['SET_LANGUAGE'])
+    version = dynamodb.create_chat_status(
         table=CONFIG['DYNAMO_TABLE'],
         chat_id=chat_id,
-        status=status
-    )
+        status=STATUSES['SET_LANGUAGE'],
+        ttl=CONFIG.get('ONBOARDING_TTL', 30 * 86400))
+    if version is None:
+        return False
+    globalvars.chat_status = STATUSES['SET_LANGUAGE']
+    globalvars.chat_version = version
+    globalvars.chat_claimed = True
+    return True
+
+def get_chat_status(chat_id):
+    """
+    Reads chat state, the state and version the next save_chat_status()
+    expects
+
+    :param chat_id: Telegram Chat ID
+    :return: state, START for unknown or expired chats
+    """
+    (status, version) = dynamodb.get_chat_status(
+        table=CONFIG['DYNAMO_TABLE'],
+        chat_id=chat_id)
+    globalvars.chat_status = status
+    globalvars.chat_version = version
+    globalvars.chat_claimed = False
+    if status is None:
+        return STATUSES['START']
+    return int(status)
 
 def make_language_keyboard():
     """
@@ -42,10 +131,19 @@ def make_language_keyboard():
 
     :return: A telegram keyboard
     """
-    return telegram.make_keyboard(
-        globalvars.lang.text('SUPPORTED_LANGUAGES'),
-        2,
-        '')
+    return picker(get_keyboards(globalvars.lang), 'LANGUAGE')
+
+def language_index(text):
+    """
+    Finds a language by its name in the current language
+
+    :param text: language name the user picked
+    :return: index in CONFIG['SUPPORTED_LANGUAGES'] or None
+    """
+    languages = globalvars.lang.text('SUPPORTED_LANGUAGES')
+    if text is None or text not in languages:
+        return None
+    return languages.index(text)
 
 def represents_int(s):
     """
@@ -98,50 +196,8 @@ def change_lang(new_lang):
         logger.error("Error in Language file!")
         return None
         
-    globalvars.HOME_KEYBOARD = [
-        [
-            globalvars.lang.text('MENU_HOME_EXISTING_KEY'),
-            globalvars.lang.text('MENU_HOME_NEW_KEY')
-        ],
-        [
-            globalvars.lang.text('MENU_HOME_FAQ'),
-            globalvars.lang.text('MENU_HOME_INSTRUCTION')
-        ],
-        [
-            globalvars.lang.text('MENU_HOME_CHANGE_LANGUAGE'),
-            globalvars.lang.text('MENU_HOME_PRIVACY_POLICY')
-        ],
-        [
-            globalvars.lang.text('MENU_HOME_SUPPORT'),
-            globalvars.lang.text('MENU_HOME_DELETE_ACCOUNT')
-        ],
-        [
-            globalvars.lang.text('MENU_CHECK_STATUS'),
-        ]
-    ]
-
-    globalvars.BACK_TO_HOME_KEYBOARD = [
-        [globalvars.lang.text('MENU_BACK_HOME')]
-    ]
-
-    if new_lang in ['fa', 'ar']:
-        globalvars.OPT_IN_KEYBOARD = [
-            [
-                globalvars.lang.text('MENU_PRIVACY_POLICY_DECLINE'),
-                globalvars.lang.text('MENU_PRIVACY_POLICY_CONFIRM')
-            ]
-        ]
-    else:
-        globalvars.OPT_IN_KEYBOARD = [
-            [
-                globalvars.lang.text('MENU_PRIVACY_POLICY_CONFIRM'),
-                globalvars.lang.text('MENU_PRIVACY_POLICY_DECLINE')
-            ]
-        ]
-
-    globalvars.OPT_IN_DECLINED_KEYBOARD = [
-        [
-            globalvars.lang.text('MENU_BACK_PRIVACY_POLICY'),
-            globalvars.lang.text('MENU_HOME_CHANGE_LANGUAGE')
-        ]
-    ]
+    keyboards = get_keyboards(globalvars.lang)
+    globalvars.HOME_KEYBOARD = keyboards['HOME']
+    globalvars.BACK_TO_HOME_KEYBOARD = keyboards['BACK_TO_HOME']
+    globalvars.OPT_IN_KEYBOARD = keyboards['OPT_IN']
+    globalvars.OPT_IN_DECLINED_KEYBOARD = keyboards['OPT_IN_DECLINED']
@@ -0,0 +1,405 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Update Queue
+Buffers Telegram updates between the webhook and the bot
+
+With CONFIG['INGESTION_MODE'] set to 'queue' the webhook only parses an
+update and enqueues it, queue_handler in outlinebot handles the queued
+updates in batches. Updates of one chat are handled in the order they
+arrived, each chat is a message group of the queue.
+
+The queued message holds the whole webhook event, including the bot
+token of the API Gateway stage, so the queue must be encrypted at rest.
+
+Backends, picked with CONFIG['QUEUE_BACKEND']:
+    sqs: Amazon SQS FIFO queue at CONFIG['QUEUE_URL'] (default), its
+         records reach queue_handler through a Lambda event source
+         mapping with ReportBatchItemFailures
+    memory: process local list, for tests and load generation
+    sqlite: SQLite file at CONFIG['QUEUE_SQLITE_FILE'], for self-hosted
+            deployments that poll the queue with drain()
+
+A duplicate of an update that is still queued is dropped, SQS keeps
+deduplication ids for five minutes. An update that failed
+CONFIG['QUEUE_MAX_RECEIVES'] times is dropped by drain(), on SQS the
+redrive policy of the queue does the same for queue_handler. Updates
+that were skipped behind a failed update of their chat are released
+without counting the attempt, except on SQS which counts every receive.
+"""
+
+import json
+import logging
+import threading
+from collections import OrderedDict
+from errors import AWSError, DBError, ValidationError
+from lazy import lazy_module
+from settings import CONFIG
+from statestore import SQLITE_BUSY_TIMEOUT, immediate
+import tracing
+
+sqlite3 = lazy_module('sqlite3')
+
+logger = logging.getLogger()
+
+# Largest batch SQS returns from one ReceiveMessage call
+RECEIVE_LIMIT = 10
+
+_queue = None
+
+
+def get_queue():
+    """
+    Returns the queue selected in the settings
+
+    :return: Queue object
+    :raise: ValidationError: unknown backend
+    """
+    global _queue
+    if _queue is None:
+        backend = CONFIG.get('QUEUE_BACKEND', 'sqs')
+        if backend == 'sqs':
+            _queue = SQSQueue(CONFIG['QUEUE_URL'])
+        elif backend == 'memory':
+            _queue = MemoryQueue()
+        elif backend == 'sqlite':
+            _queue = SQLiteQueue(
+                CONFIG.get('QUEUE_SQLITE_FILE', '/tmp/outline-queue.db'))
+        else:
+            raise ValidationError('Unknown queue backend: {}'.format(backend))
+    return _queue
+
+
+def queued():
+    """
+    :return: True if the webhook only enqueues updates
+    """
+    return CONFIG.get('INGESTION_MODE', 'direct') == 'queue'
+
+
+def enqueue(event, chat_id):
+    """
+    Enqueues a webhook event
+
+    :param event: Lambda event of the webhook
+    :param chat_id: ID of the chat the update belongs to
+    :raise: AWSError or DBError: the queue refused the update
+    """
+    body = json.dumps({
+        'lang': event.get('lang'),
+        'token': event['token'],
+        'Input': event['Input']
+    })
+    update_id = event['Input'].get('update_id')
+    get_queue().send(
+        body,
+        str(chat_id),
+        str(update_id) if update_id is not None else None)
+
+
+def consume(records, handler):
+    """
+    Handles a batch of queued updates, chat by chat in arrival order
+
+    After a failed update the later updates of the same chat in the
+    batch are not handled, so they are retried in order. The handler
+    only fails for updates that did not change the chat status yet.
+
+    :param records: SQS records as Lambda passes them, or from receive()
+    :param handler: Called with the webhook event of each update
+    :return: List of messageIds that failed or were skipped
+    """
+    (failed, skipped) = _consume(records, handler)
+    return failed + skipped
+
+
+def _consume(records, handler):
+    """
+    :return: Lists of the messageIds that failed and of those skipped
+        after a failure
+    """
+    chats = OrderedDict()
+    for record in records:
+        group = record.get('attributes', {}).get('MessageGroupId')
+        chats.setdefault(group, []).append(record)
+
+    failed = []
+    skipped = []
+    for chat_records in chats.values():
+        for (position, record) in enumerate(chat_records):
+            event = json.loads(record['body'])
+            event['queued'] = True
+            try:
+                handler(event)
+            except Exception:
+                failed.append(record['messageId'])
+                skipped.extend(item['messageId'] for item in chat_records[position + 1:])
+                break
+    return (failed, skipped)
+
+
+def drain(handler, limit=RECEIVE_LIMIT):
+    """
+    Receives and handles one batch, for consumers polling the queue
+
+    :param handler: Called with the webhook event of each update
+    :param limit: Largest number of updates to receive
+    :return: Number of updates received
+    """
+    queue = get_queue()
+    records = queue.receive(limit)
+    if not records:
+        return 0
+    (failed, skipped) = _consume(records, handler)
+    failed = set(failed)
+    skipped = set(skipped)
+    retried = []
+    waiting = []
+    for record in records:
+        if record['messageId'] in skipped:
+            waiting.append(record['receiptHandle'])
+        elif record['messageId'] in failed:
+            receives = int(record['attributes'].get('ApproximateReceiveCount', 1))
+            if receives < CONFIG.get('QUEUE_MAX_RECEIVES', 3):
+                retried.append(record['receiptHandle'])
+                continue
+            logger.error('Dropping update after %d attempts: %s', receives, record['body'])
+    queue.delete([record['receiptHandle'] for record in records
+                  if record['receiptHandle'] not in retried
+                  and record['receiptHandle'] not in waiting])
+    queue.release(retried)
+    queue.release(waiting, attempted=False)
+    return len(records)
+
+
+def _record(message_id, body, group, receives):
+    return {
+        'messageId': message_id,
+        'receiptHandle': message_id,
+        'body': body,
+        'attributes': {
+            'MessageGroupId': group,
+            'ApproximateReceiveCount': str(receives)
+        }
+    }
+
+
+class SQSQueue(object):
+    """
+    Queue on an Amazon SQS FIFO queue
+    """
+    def __init__(self, url):
+        self._url = url
+        self._client = None
+
+    def _sqs(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('sqs')
+        return self._client
+
+    @tracing.traced('sqs.send_message')
+    def send(self, body, group, deduplication_id=None):
+        """
+        Enqueues a message
+
+        :param body: Message body
+        :param group: Message group, messages of a group stay in order
+        :param deduplication_id: Id of the message for deduplication
+        :raise: AWSError: SQS call failed
+        """
+        from botocore.exceptions import ClientError
+        kwargs = {
+            'QueueUrl': self._url,
+            'MessageBody': body,
+            'MessageGroupId': group
+        }
+        if deduplication_id is not None:
+            kwargs['MessageDeduplicationId'] = deduplication_id
+        try:
+            self._sqs().send_message(**kwargs)
+        except ClientError as error:
+            raise AWSError('Unable to enqueue: {}'.format(str(error)))
+
+    @tracing.traced('sqs.receive_message')
+    def receive(self, limit=RECEIVE_LIMIT):
+        """
+        Receives messages, they are hidden until deleted or released
+
+        :param limit: Largest number of messages
+        :return: List of records
+        :raise: AWSError: SQS call failed
+        """
+        from botocore.exceptions import ClientError
+        try:
+            result = self._sqs().receive_message(
+                QueueUrl=self._url,
+                MaxNumberOfMessages=min(limit, RECEIVE_LIMIT),
+                AttributeNames=['MessageGroupId', 'ApproximateReceiveCount'])
+        except ClientError as error:
+            raise AWSError('Unable to receive: {}'.format(str(error)))
+        return [{
+            'messageId': message['MessageId'],
+            'receiptHandle': message['ReceiptHandle'],
+            'body': message['Body'],
+            'attributes': message.get('Attributes', {})
+        } for message in result.get('Messages', [])]
+
+    @tracing.traced('sqs.delete_message_batch')
+    def delete(self, receipts):
+        """
+        Deletes handled messages
+
+        :param receipts: List of receiptHandles
+        :raise: AWSError: SQS call failed
+        """
+        from botocore.exceptions import ClientError
+        for start in range(0, len(receipts), RECEIVE_LIMIT):
+            entries = [{'Id': str(index), 'ReceiptHandle': receipt}
+                       for (index, receipt)
+                       in enumerate(receipts[start:start + RECEIVE_LIMIT])]
+            try:
+                self._sqs().delete_message_batch(QueueUrl=self._url, Entries=entries)
+            except ClientError as error:
+                raise AWSError('Unable to delete: {}'.format(str(error)))
+
+    def release(self, receipts, attempted=True):
+        """
+        Failed messages reappear once their visibility timeout is over,
+        SQS counts the receive whether or not they were attempted
+        """
+
+
+class MemoryQueue(object):
+    """
+    Queue in a process local list
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._messages = []
+        self._inflight = set()
+        self._next_id = 0
+
+    def send(self, body, group, deduplication_id=None):
+        with self._lock:
+            if deduplication_id is not None and any(
+                    message[3] == deduplication_id for message in self._messages):
+                return
+            self._next_id += 1
+            self._messages.append([str(self._next_id), body, group, deduplication_id, 0])
+
+    def receive(self, limit=RECEIVE_LIMIT):
+        with self._lock:
+            # A group with a message in flight is blocked, like in SQS FIFO
+            blocked = {message[2] for message in self._messages
+                       if message[0] in self._inflight}
+            records = []
+            for message in self._messages:
+                if len(records) == limit:
+                    break
+                if message[2] in blocked:
+                    continue
+                message[4] += 1
+                records.append(_record(message[0], message[1], message[2], message[4]))
+            self._inflight.update(record['messageId'] for record in records)
+            return records
+
+    def delete(self, receipts):
+        with self._lock:
+            receipts = set(receipts)
+            self._messages = [message for message in self._messages
+                              if message[0] not in receipts]
+            self._inflight -= receipts
+
+    def release(self, receipts, attempted=True):
+        with self._lock:
+            receipts = set(receipts)
+            if not attempted:
+                for message in self._messages:
+                    if message[0] in receipts:
+                        message[4] -= 1
+            self._inflight -= receipts
+
+    def __len__(self):
+        return len(self._messages)
+
+
+class SQLiteQueue(object):
+    """
+    Queue in a SQLite file running in WAL mode, several consumer
+    processes can poll it
+    """
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        try:
+            self._db = sqlite3.connect(
+                path,
+                timeout=SQLITE_BUSY_TIMEOUT,
+                isolation_level=None,
+                check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS messages ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'grp TEXT NOT NULL, '
+                'dedup TEXT UNIQUE, '
+                'body TEXT NOT NULL, '
+                'inflight INTEGER NOT NULL DEFAULT 0, '
+                'receives INTEGER NOT NULL DEFAULT 0)')
+            self._db.commit()
+        except sqlite3.Error as error:
+            raise DBError('Unable to open {}: {}'.format(path, str(error)))
+
+    def send(self, body, group, deduplication_id=None):
+        try:
+            with immediate(self._db, self._lock):
+                self._db.execute(
+                    'INSERT OR IGNORE INTO messages (grp, dedup, body) VALUES (?, ?, ?)',
+                    (group, deduplication_id, body))
+        except sqlite3.Error as error:
+            raise DBError('Unable to enqueue: {}'.format(str(error)))
+
+    def receive(self, limit=RECEIVE_LIMIT):
+        try:
+            with immediate(self._db, self._lock):
+                rows = self._db.execute(
+                    'SELECT id, body, grp, receives FROM messages WHERE inflight = 0 '
+                    'AND grp NOT IN (SELECT grp FROM messages WHERE inflight = 1) '
+                    'ORDER BY id LIMIT ?',
+                    (limit,)).fetchall()
+                self._db.executemany(
+                    'UPDATE messages SET inflight = 1, receives = receives + 1 WHERE id = ?',
+                    [(row[0],) for row in rows])
+        except sqlite3.Error as error:
+            raise DBError('Unable to receive: {}'.format(str(error)))
+        return [_record(str(row[0]), row[1], row[2], row[3] + 1) for row in rows]
+
+    def delete(self, receipts):
+        try:
+            with immediate(self._db, self._lock):
+                self._db.executemany(
+                    'DELETE FROM messages WHERE id = ?',
+                    [(int(receipt),) for receipt in receipts])
+        except sqlite3.Error as error:
+            raise DBError('Unable to delete: {}'.format(str(error)))
+
+    def release(self, receipts, attempted=True):
+        try:
+            with immediate(self._db, self._lock):
+                self._db.executemany(
+                    'UPDATE messages SET inflight = 0, receives = receives - ? WHERE id = ?',
+                    [(0 if attempted else 1, int(receipt)) for receipt in receipts])
+        except sqlite3.Error as error:
+            raise DBError('Unable to release: {}'.format(str(error)))
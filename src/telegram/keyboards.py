@@ -0,0 +1,186 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Keyboard Registry
+Builds the static keyboards of a language once per process
+
+The keyboards are PreparedKeyboard objects, their reply_markup JSON is
+serialized when the language is first used and the send functions in
+telegram.py post it as-is. With CONFIG['INLINE_KEYBOARDS'] the pickers
+are inline keyboards whose buttons carry callback_data ids.
+"""
+
+import callbacks
+from telegram import (
+    InlineKeyboard,
+    PreparedKeyboard,
+    make_inline_keyboard,
+    make_keyboard)
+from settings import CONFIG
+
+# Reply markup flags the send functions use: send_keyboard and send_message
+MARKUP_VARIANTS = [
+    {'one_time': True, 'resize': True},
+    {'one_time': False, 'resize': True}
+]
+
+# Admin menu entries, the index is the id in callback_data
+ADMIN_ACTIONS = [
+    'MENU_ADMIN_BAN_USER',
+    'MENU_ADMIN_TERMS_OF_SERVICE',
+    'MENU_ADMIN_PRIVACY_POLICY',
+    'MENU_ADMIN_ENROLLED_USERS',
+    'MENU_ADMIN_BANNED_USERS',
+    'MENU_ADMIN_BLOCKED_KEYS',
+    'MENU_ADMIN_STATS',
+    'MENU_HOME_CHANGE_LANGUAGE',
+    'MENU_ADMIN_EXIT'
+]
+
+_registry = {}
+
+
+def inline_mode():
+    """
+    :return: True if the pickers use inline keyboards
+    """
+    return CONFIG.get('INLINE_KEYBOARDS', False)
+
+
+def picker(keyboards, name):
+    """
+    Returns the reply or inline version of a picker keyboard
+
+    :param keyboards: Dictionary from get_keyboards()
+    :param name: 'LANGUAGE', 'DELETE_REASONS' or 'ADMIN'
+    :return: PreparedKeyboard
+    """
+    if inline_mode():
+        return keyboards[name + '_INLINE']
+    return keyboards[name]
+
+
+def make_issue_keyboard(issues):
+    """
+    Makes the issue picker
+
+    :param issues: Dictionary of issue id to issue text
+    :return: keyboard for send_keyboard
+    """
+    if inline_mode():
+        return InlineKeyboard(make_inline_keyboard(
+            [(text, callbacks.encode(callbacks.ISSUE, issue_id))
+             for (issue_id, text) in issues.items()],
+            2))
+    return make_keyboard(list(issues.values()), 2, '')
+
+
+def get_keyboards(lang):
+    """
+    Returns the static keyboards of a language
+
+    :param lang: Translation object of the language
+    :return: Dictionary of keyboard name to PreparedKeyboard
+    """
+    keyboards = _registry.get(lang.language)
+    if keyboards is None:
+        keyboards = build_keyboards(lang)
+        for keyboard in keyboards.values():
+            for variant in MARKUP_VARIANTS:
+                keyboard.markup(**variant)
+        _registry[lang.language] = keyboards
+    return keyboards
+
+
+def build_keyboards(lang):
+    """
+    Builds the static keyboards of a language
+
+    :param lang: Translation object of the language
+    :return: Dictionary of keyboard name to PreparedKeyboard
+    """
+    if lang.language in ['fa', 'ar']:
+        opt_in = [
+            lang.text('MENU_PRIVACY_POLICY_DECLINE'),
+            lang.text('MENU_PRIVACY_POLICY_CONFIRM')
+        ]
+    else:
+        opt_in = [
+            lang.text('MENU_PRIVACY_POLICY_CONFIRM'),
+            lang.text('MENU_PRIVACY_POLICY_DECLINE')
+        ]
+
+    return {
+        'HOME': PreparedKeyboard([
+            [
+                lang.text('MENU_HOME_EXISTING_KEY'),
+                lang.text('MENU_HOME_NEW_KEY')
+            ],
+            [
+                lang.text('MENU_HOME_FAQ'),
+                lang.text('MENU_HOME_INSTRUCTION')
+            ],
+            [
+                lang.text('MENU_HOME_CHANGE_LANGUAGE'),
+                lang.text('MENU_HOME_PRIVACY_POLICY')
+            ],
+            [
+                lang.text('MENU_HOME_SUPPORT'),
+                lang.text('MENU_HOME_DELETE_ACCOUNT')
+            ],
+            [
+                lang.text('MENU_CHECK_STATUS'),
+            ]
+        ]),
+        'BACK_TO_HOME': PreparedKeyboard([
+            [lang.text('MENU_BACK_HOME')]
+        ]),
+        'BACK_TO_HOME_INLINE': InlineKeyboard(make_inline_keyboard(
+            [(lang.text('MENU_BACK_HOME'), callbacks.encode(callbacks.HOME))])),
+        'OPT_IN': PreparedKeyboard([opt_in]),
+        'OPT_IN_DECLINED': PreparedKeyboard([
+            [
+                lang.text('MENU_BACK_PRIVACY_POLICY'),
+                lang.text('MENU_HOME_CHANGE_LANGUAGE')
+            ]
+        ]),
+        'LANGUAGE': PreparedKeyboard(make_keyboard(
+            lang.text('SUPPORTED_LANGUAGES'),
+            2,
+            '')),
+        'LANGUAGE_INLINE': InlineKeyboard(make_inline_keyboard(
+            [(text, callbacks.encode(callbacks.LANGUAGE, index))
+             for (index, text) in enumerate(lang.text('SUPPORTED_LANGUAGES'))],
+            2)),
+        'DELETE_REASONS': PreparedKeyboard(make_keyboard(
+            lang.text('MENU_DELETE_REASONS'),
+            2,
+            lang.text('MENU_BACK_HOME'))),
+        'DELETE_REASONS_INLINE': InlineKeyboard(
+            make_inline_keyboard(
+                [(text, callbacks.encode(callbacks.DELETE_REASON, index))
+                 for (index, text) in enumerate(lang.text('MENU_DELETE_REASONS'))],
+                2)
+            + make_inline_keyboard(
+                [(lang.text('MENU_BACK_HOME'), callbacks.encode(callbacks.HOME))])),
+        'ADMIN': PreparedKeyboard(make_keyboard(
+            [lang.text(action) for action in ADMIN_ACTIONS],
+            3,
+            '')),
+        'ADMIN_INLINE': InlineKeyboard(make_inline_keyboard(
+            [(lang.text(action), callbacks.encode(callbacks.ADMIN, index))
+             for (index, action) in enumerate(ADMIN_ACTIONS)],
+            3))
+    }
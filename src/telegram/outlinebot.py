@@ -13,72 +13,313 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import logging
-import time
 import base64
 from tmsg import TelegramMessage
 import telegram
-from errors import ValidationError
+import callbacks
+from composer import Reply
+from errors import StateConflict, ValidationError
 import dynamodb
 from captcha import get_choice, check_captcha
 import api
-from admin import admin_menu
 from helpers import (
     save_chat_status,
+    start_chat,
+    get_chat_status,
     make_language_keyboard,
+    language_index,
     represents_int,
     change_lang,
     get_pp_link,
     get_tos_link)
+from keyboards import ADMIN_ACTIONS, get_keyboards, make_issue_keyboard, picker
 import globalvars
+from lazy import lazy_module
+import logconfig
+import stats
+import tracing
 
 from settings import CONFIG, STATUSES
 import urllib.parse
 
-logger = logging.getLogger()
-logger.setLevel(CONFIG['LOG_LEVEL'])
+# Only admins reach the admin menu
+admin = lazy_module('admin')
+assets = lazy_module('assets')
+servers = lazy_module('servers')
+ingest = lazy_module('ingest')
 
-def create_new_key(tmsg, token, issue_id=None):
+logger = logconfig.setup()
+
+# Chat states in which the buttons of each callback kind are live
+CALLBACK_STATUSES = {
+    callbacks.HOME: (STATUSES['DELETE_ACCOUNT_REASON'], STATUSES['DELETE_ACCOUNT_CONFIRM']),
+    callbacks.LANGUAGE: (STATUSES['SET_LANGUAGE'], STATUSES['ADMIN_SET_LANGUAGE']),
+    callbacks.ISSUE: (STATUSES['ASK_ISSUE'],),
+    callbacks.DELETE_REASON: (STATUSES['DELETE_ACCOUNT_REASON'],),
+    callbacks.ADMIN: (STATUSES['ADMIN_SECTION_HOME'],)
+}
+
+def error_text():
+    """
+    :return: text telling the user something went wrong
     """
-    Creates and sends new key for the user and
+    if not api.available():
+        return globalvars.lang.text('MSG_API_UNAVAILABLE')
+    return globalvars.lang.text('MSG_ERROR')
+
+
+def send_error(token, tmsg, home=True):
+    """
+    Tells the user something went wrong
+
+    While the API server is unavailable the user is asked to try again
+    later and, if registered, taken back to the home menu.
 
-    :param tmsg: Telegram message
     :param token: Telegram bot token
-    :param issue_id: User's issue connecting to server
+    :param tmsg: Telegram message
+    :param home: False if the user is not registered yet
     """
-    try:
-        new_key = api.get_new_key(user_id=tmsg.user_uid, user_issue=issue_id)
-    except Exception as exc:
-        logger.error(f'Error in creating new key {exc}')
+    available = api.available()
+    if not available and home:
+        save_chat_status(tmsg.chat_id, STATUSES['HOME'])
+    stats.count('errors')
+    if available:
         telegram.send_message(
             token,
             tmsg.chat_id,
             globalvars.lang.text('MSG_ERROR'))
-        return None
-    if not new_key:
+    elif home:
+        stats.count('degraded')
+        telegram.send_keyboard(
+            token,
+            tmsg.chat_id,
+            globalvars.lang.text('MSG_API_UNAVAILABLE'),
+            globalvars.HOME_KEYBOARD)
+    else:
+        stats.count('degraded')
         telegram.send_message(
             token,
             tmsg.chat_id,
-            globalvars.lang.text('MSG_ERROR'))
+            globalvars.lang.text('MSG_API_UNAVAILABLE'))
+
+
+def create_new_key(tmsg, reply, issue_id=None):
+    """
+    Creates new key for the user and adds it to the reply
+
+    :param tmsg: Telegram message
+    :param reply: Reply to the user
+    :param issue_id: User's issue connecting to server
+    """
+    try:
+        new_key = api.get_new_key(user_id=tmsg.user_uid, user_issue=issue_id)
+    except Exception as exc:
+        logger.error(f'Error in creating new key {exc}')
+        stats.count('errors')
+        reply.add(error_text())
+        return None
+    if not new_key:
+        stats.count('errors')
+        reply.add(error_text())
     else:
+        stats.count('keys')
+        if issue_id is not None:
+            stats.count('keys_issue_{}'.format(issue_id))
 
         awsurl = (CONFIG['OUTLINE_AWS_URL'].format(
             urllib.parse.quote(new_key)))
-        telegram.send_message(
-            token,
-            tmsg.chat_id,
+        reply.add(
             globalvars.lang.text('MSG_NEW_KEY_A').format(awsurl),
             parse='MARKDOWN')
-        telegram.send_message(
-            token,
-            tmsg.chat_id,
+        reply.add(
             globalvars.lang.text('MSG_NEW_KEY_B'),
             parse='MARKDOWN')
-        telegram.send_message(
+        # The key is copied from a message of its own
+        reply.add(new_key, separate=True)
+
+def select_language(token, tmsg, index):
+    """
+    Changes the user's language and continues the registration
+
+    :param token: Telegram bot token
+    :param tmsg: Telegram message
+    :param index: index in CONFIG['SUPPORTED_LANGUAGES'], None if the
+        user picked an unknown language
+    """
+    try:
+        user_exist = api.get_user(tmsg.user_uid)
+    except Exception:
+        # The language is picked again once the API is back
+        send_error(token, tmsg, home=False)
+        return None
+    save_chat_status(
+        tmsg.chat_id,
+        STATUSES['HOME'] if user_exist else STATUSES['FIRST_CAPTCHA'])
+
+    if index is None:
+        message = globalvars.lang.text('MSG_LANGUAGE_CHANGE_ERROR')
+    else:
+        label = globalvars.lang.text('SUPPORTED_LANGUAGES')[index]
+        new_lang = CONFIG['SUPPORTED_LANGUAGES'][index]
+        dynamodb.save_user_lang(
+            table=CONFIG["DYNAMO_TABLE"],
+            chat_id=tmsg.chat_id,
+            language=new_lang)
+        change_lang(new_lang)
+        message = globalvars.lang.text('MSG_LANGUAGE_CHANGED').format(label)
+    callbacks.show(token, tmsg, message)
+
+    if not user_exist:
+        choices, a, b = get_choice(
+            table=CONFIG["DYNAMO_TABLE"],
+            chat_id=tmsg.chat_id)
+        if choices:
+            keyboard = telegram.make_keyboard(choices, 2, '')
+            telegram.send_keyboard(
+                token,
+                tmsg.chat_id,
+                "{}\n{} + {}:".format(globalvars.lang.text("MSG_ASK_CAPTCHA"), a, b),
+                keyboard)
+    else:
+        telegram.send_keyboard(
             token,
             tmsg.chat_id,
-            new_key)
+            globalvars.lang.text('MSG_HOME_ELSE'),
+            globalvars.HOME_KEYBOARD)
+
+
+def report_issue(token, tmsg, issue_id):
+    """
+    Creates a new key for a user who reported an issue with the old one
 
+    :param token: Telegram bot token
+    :param tmsg: Telegram message
+    :param issue_id: ID of the issue, None if the user picked an unknown one
+    """
+    save_chat_status(tmsg.chat_id, STATUSES['HOME'])
+    reply = Reply(token, tmsg.chat_id, callbacks.message_id(tmsg))
+    if issue_id is None:
+        reply.add(globalvars.lang.text("MSG_UNSUPPORTED_COMMAND"))
+    else:
+        create_new_key(tmsg, reply, issue_id)
+
+    reply.add(globalvars.lang.text('MSG_HOME_ELSE'), parse='MARKDOWN', closing=True)
+    reply.send(globalvars.HOME_KEYBOARD)
+
+
+def delete_account(token, tmsg, reason_id):
+    """
+    Deletes the user's account
+
+    :param token: Telegram bot token
+    :param tmsg: Telegram message
+    :param reason_id: index of the reason in MENU_DELETE_REASONS
+    """
+    logger.debug(
+        'user %s wants to delete their account because %s',
+        tmsg.user_uid,
+        globalvars.lang.text('MENU_DELETE_REASONS')[reason_id])
+    keyboards = get_keyboards(globalvars.lang)
+    inline = callbacks.message_id(tmsg) is not None
+    save_chat_status(tmsg.chat_id, STATUSES['DELETE_ACCOUNT_CONFIRM'])
+    try:
+        deleted = api.delete_user(user_id=tmsg.user_uid)
+    except Exception:
+        save_chat_status(tmsg.chat_id, STATUSES['DELETE_ACCOUNT_REASON'])
+        stats.count('errors')
+        if inline:
+            callbacks.show(
+                token, tmsg,
+                error_text(),
+                keyboards['BACK_TO_HOME_INLINE'])
+        else:
+            telegram.send_keyboard(
+                token,
+                tmsg.chat_id,
+                error_text(),
+                globalvars.HOME_KEYBOARD)
+        return None
+    if deleted:
+        stats.count('deletions_reason_{}'.format(reason_id))
+        if inline:
+            callbacks.show(
+                token, tmsg,
+                globalvars.lang.text("MSG_DELETED_ACCOUNT"),
+                keyboards['BACK_TO_HOME_INLINE'])
+        else:
+            telegram.send_keyboard(
+                token, tmsg.chat_id,
+                globalvars.lang.text("MSG_DELETED_ACCOUNT"),
+                globalvars.BACK_TO_HOME_KEYBOARD)
+    else:
+        save_chat_status(tmsg.chat_id, STATUSES['DELETE_ACCOUNT_REASON'])
+
+
+def choice_index(value, choices):
+    """
+    Reads a list index from callback_data
+
+    :param value: value part of the callback_data
+    :param choices: list the index points into
+    :return: index or None if value is not a valid index
+    """
+    if not represents_int(value) or not 0 <= int(value) < len(choices):
+        return None
+    return int(value)
+
+
+def handle_callback(token, tmsg, chat_status):
+    """
+    Handles a press of an inline keyboard button
+
+    Buttons of a keyboard the chat has moved past are ignored. The press
+    is answered once the chat is claimed, a press handled again after a
+    conflict is answered only once.
+
+    :param token: Telegram bot token
+    :param tmsg: Telegram message of type CALLBACK
+    :param chat_status: Representing the state of the chat with the user
+    """
+    (kind, value) = callbacks.decode(tmsg.body)
+    if kind is None or chat_status not in CALLBACK_STATUSES.get(kind, ()):
+        callbacks.answer(token, tmsg, globalvars.lang.text('MSG_UNSUPPORTED_COMMAND'))
+        return None
+
+    if kind == callbacks.HOME:
+        save_chat_status(tmsg.chat_id, STATUSES['HOME'])
+        telegram.send_keyboard(
+            token,
+            tmsg.chat_id,
+            globalvars.lang.text('MSG_HOME_ELSE'),
+            globalvars.HOME_KEYBOARD)
+    elif kind == callbacks.LANGUAGE:
+        index = choice_index(value, CONFIG['SUPPORTED_LANGUAGES'])
+        if chat_status == STATUSES['ADMIN_SET_LANGUAGE']:
+            admin.admin_menu(token, tmsg, chat_status, index)
+        else:
+            select_language(token, tmsg, index)
+    elif kind == callbacks.ISSUE:
+        report_issue(token, tmsg, int(value) if represents_int(value) else None)
+    elif kind == callbacks.DELETE_REASON:
+        reason_id = choice_index(value, globalvars.lang.text('MENU_DELETE_REASONS'))
+        if reason_id is not None:
+            delete_account(token, tmsg, reason_id)
+    elif kind == callbacks.ADMIN:
+        index = choice_index(value, ADMIN_ACTIONS)
+        if index is not None and not admin.admin_menu(
+                token, tmsg, chat_status, ADMIN_ACTIONS[index]):
+            telegram.send_keyboard(
+                token,
+                tmsg.chat_id,
+                globalvars.lang.text('MSG_HOME'),
+                globalvars.HOME_KEYBOARD)
+    callbacks.answer(token, tmsg)
+    return None
+
+
+@logconfig.flushed
+@tracing.traced_update('bot_handler')
+@stats.recorded
 def bot_handler(event, _):
     """
     Main entry point to handle the bot
@@ -86,11 +327,7 @@ def bot_handler(event, _):
     param event: information about the chat
     :param _: information about the telegram message (unused)
     """
-    logger.info(
-        "%s:%s Request received:%s",
-        __name__,
-        str(time.time()),
-        str(event))
+    logconfig.log_payload('Request received', event)
 
     try:
         default_language = event["lang"]
@@ -105,12 +342,23 @@ def bot_handler(event, _):
         logger.error("Token is not defined!")
         return None
 
+    server_update = (event.get('Input') or {}).get('server_update')
+    if server_update is not None:
+        servers.handle_webhook(server_update)
+        return None
+
     try:
         tmsg = TelegramMessage(event, default_language)
-        logger.info("TMSG object: {}".format(tmsg))
+        logger.debug(
+            "Message type %s command %s", tmsg.type, tmsg.command)
     except Exception as exc:
         logger.error(
-            'Error in Telegram Message parsing {} {}'.format(event, str(exc)))
+            'Error in Telegram Message parsing %s %s', event, exc)
+        return None
+
+    if ingest.queued() and not event.get('queued'):
+        # Handled by queue_handler, Telegram gets its answer right away
+        ingest.enqueue(event, tmsg.chat_id)
         return None
 
     preferred_lang = dynamodb.get_user_lang(
@@ -120,18 +368,58 @@ def bot_handler(event, _):
             preferred_lang not in CONFIG['SUPPORTED_LANGUAGES']):
         preferred_lang = default_language
     current_language = CONFIG['SUPPORTED_LANGUAGES'].index(preferred_lang)
-    logger.info('User language is {}'.format(preferred_lang))
+    logger.info('User language is %s', preferred_lang)
 
     change_lang(preferred_lang)
     tmsg.lang = preferred_lang
 
+    retries = CONFIG.get('STATE_CONFLICT_RETRIES', 2)
+    for attempt in range(retries + 1):
+        globalvars.chat_status = globalvars.UNREAD
+        globalvars.chat_claimed = False
+        try:
+            return handle_update(token, tmsg)
+        except StateConflict as conflict:
+            # Another update claimed the chat before this one did
+            # anything, handle it again in the status that update left
+            stats.count('state_conflicts')
+            logger.warning(
+                'Chat %s changed while handling an update (attempt %d): %s',
+                tmsg.chat_id, attempt + 1, conflict)
+        except Exception as exc:
+            if not globalvars.chat_claimed:
+                raise
+            # A redelivery would handle the update again in the status
+            # it already moved the chat to, so it is consumed instead
+            stats.count('errors')
+            logger.error(
+                'Update of chat %s failed after changing its status, not retried: %s',
+                tmsg.chat_id, exc)
+            return None
+    logger.error('Dropping update of chat %s after %d conflicts', tmsg.chat_id, retries + 1)
+    return None
+
+
+def handle_update(token, tmsg):
+    """
+    Handles a message in the status the chat is in
+
+    :param token: Telegram bot token
+    :param tmsg: Telegram message
+    :raise: StateConflict: another update claimed the chat first
+    """
+    if tmsg.type == 'CALLBACK':
+        chat_status = get_chat_status(tmsg.chat_id)
+        return handle_callback(token, tmsg, chat_status)
+
     if tmsg.body == globalvars.lang.text('MENU_BACK_HOME'):
+        get_chat_status(tmsg.chat_id)
+        save_chat_status(tmsg.chat_id, STATUSES['HOME'])
         telegram.send_keyboard(
             token,
             tmsg.chat_id,
             globalvars.lang.text('MSG_HOME_ELSE'),
             globalvars.HOME_KEYBOARD)
-        save_chat_status(tmsg.chat_id, STATUSES['HOME'])
         return
 
     if tmsg.command == CONFIG['TELEGRAM_START_COMMAND'] and len(tmsg.command_arg) > 0:
@@ -140,7 +428,8 @@ def bot_handler(event, _):
 
     # Check for commands (starts with /)
     if tmsg.command == CONFIG["TELEGRAM_START_COMMAND"]:
-        dynamodb.create_chat_status(CONFIG['DYNAMO_TABLE'], tmsg.chat_id, STATUSES['START'])
+        get_chat_status(tmsg.chat_id)
+        start_chat(tmsg.chat_id)
         telegram.send_message(
             token,
             tmsg.chat_id,
@@ -151,13 +440,14 @@ def bot_handler(event, _):
             tmsg.chat_id,
             globalvars.lang.text('MSG_SELECT_LANGUAGE'),
             keyboard)
-        save_chat_status(tmsg.chat_id, STATUSES['SET_LANGUAGE'])
+        return None
+    elif (tmsg.command == CONFIG.get('TELEGRAM_REFRESH_SERVER_COMMAND', 'refreshserver')
+            and tmsg.user_uid in CONFIG['ADMIN']):
+        admin.refresh_server(token, tmsg)
         return None
     elif tmsg.command == CONFIG['TELEGRAM_ADMIN_COMMAND']:
-        chat_status = int(dynamodb.get_chat_status(
-            table=CONFIG["DYNAMO_TABLE"],
-            chat_id=tmsg.chat_id))
-        if not admin_menu(token, tmsg, chat_status):
+        chat_status = get_chat_status(tmsg.chat_id)
+        if not admin.admin_menu(token, tmsg, chat_status):
             telegram.send_keyboard(
                 token,
                 tmsg.chat_id,
@@ -168,12 +458,10 @@ def bot_handler(event, _):
 
     # non-command texts
     elif tmsg.command == '':  # This is a message not started with /
-        chat_status = int(dynamodb.get_chat_status(
-            table=CONFIG["DYNAMO_TABLE"],
-            chat_id=tmsg.chat_id))
+        chat_status = get_chat_status(tmsg.chat_id)
 
         if chat_status >= STATUSES['ADMIN_SECTION_HOME']:
-            if not admin_menu(token, tmsg, chat_status):
+            if not admin.admin_menu(token, tmsg, chat_status):
                 telegram.send_keyboard(
                     token,
                     tmsg.chat_id,
@@ -183,51 +471,7 @@ def bot_handler(event, _):
             return None
 
         elif chat_status == STATUSES['SET_LANGUAGE']:
-            if (tmsg.body is None or
-                    tmsg.body not in globalvars.lang.text('SUPPORTED_LANGUAGES')):
-                message = globalvars.lang.text('MSG_LANGUAGE_CHANGE_ERROR')
-            else:
-                new_lang = CONFIG['SUPPORTED_LANGUAGES'][globalvars.lang.text(
-                    'SUPPORTED_LANGUAGES').index(tmsg.body)]
-                dynamodb.save_user_lang(
-                    table=CONFIG["DYNAMO_TABLE"],
-                    chat_id=tmsg.chat_id,
-                    language=new_lang)
-                change_lang(new_lang)
-                message = globalvars.lang.text('MSG_LANGUAGE_CHANGED').format(tmsg.body)
-            telegram.send_message(
-                token,
-                tmsg.chat_id,
-                message)
-
-            try:
-                user_exist = api.get_user(tmsg.user_uid)
-            except Exception:
-                telegram.send_message(
-                    token,
-                    tmsg.chat_id,
-                    globalvars.lang.text('MSG_ERROR'))
-                return None
-
-            if not user_exist:
-                choices, a, b = get_choice(
-                    table=CONFIG["DYNAMO_TABLE"],
-                    chat_id=tmsg.chat_id)
-                if choices:
-                    keyboard = telegram.make_keyboard(choices, 2, '')
-                    telegram.send_keyboard(
-                        token,
-                        tmsg.chat_id,
-                        "{}\n{} + {}:".format(globalvars.lang.text("MSG_ASK_CAPTCHA"), a, b),
-                        keyboard)
-                save_chat_status(tmsg.chat_id, STATUSES['FIRST_CAPTCHA'])
-            else:
-                telegram.send_keyboard(
-                    token,
-                    tmsg.chat_id,
-                    globalvars.lang.text('MSG_HOME_ELSE'),
-                    globalvars.HOME_KEYBOARD)
-                save_chat_status(tmsg.chat_id, STATUSES['HOME'])
+            select_language(token, tmsg, language_index(tmsg.body))
             return None
 
         elif chat_status == STATUSES['FIRST_CAPTCHA']:
@@ -236,6 +480,7 @@ def bot_handler(event, _):
                 chat_id=tmsg.chat_id,
                 sum=int(tmsg.body))
             if check:
+                save_chat_status(tmsg.chat_id, STATUSES['OPT_IN'])
                 tos = get_tos_link()
                 pp = get_pp_link()
                 if tos is not None:
@@ -255,8 +500,9 @@ def bot_handler(event, _):
                     tmsg.chat_id,
                     globalvars.lang.text("MSG_OPT_IN"),
                     globalvars.OPT_IN_KEYBOARD)
-                save_chat_status(tmsg.chat_id, STATUSES['OPT_IN'])
             else:
+                save_chat_status(tmsg.chat_id, STATUSES['FIRST_CAPTCHA'])
+                stats.count('captcha_failures')
                 telegram.send_message(
                     token,
                     tmsg.chat_id,
@@ -271,50 +517,48 @@ def bot_handler(event, _):
                         tmsg.chat_id,
                         "{}\n{} + {}:".format(globalvars.lang.text("MSG_ASK_CAPTCHA"), a, b),
                         keyboard)
-                save_chat_status(tmsg.chat_id, STATUSES['FIRST_CAPTCHA'])
             return None
 
         elif chat_status == STATUSES['OPT_IN']:
             if tmsg.body == globalvars.lang.text('MENU_PRIVACY_POLICY_CONFIRM'):
+                save_chat_status(tmsg.chat_id, STATUSES['HOME'])
                 try:
                     api.create_user(user_id=tmsg.user_uid)
                 except Exception:
-                    telegram.send_message(
-                        token,
-                        tmsg.chat_id,
-                        globalvars.lang.text('MSG_ERROR'))
+                    save_chat_status(tmsg.chat_id, STATUSES['OPT_IN'])
+                    send_error(token, tmsg, home=False)
                     return None
+                stats.count('new_users')
                 telegram.send_keyboard(
                     token,
                     tmsg.chat_id,
                     globalvars.lang.text('MSG_HOME'),
                     globalvars.HOME_KEYBOARD)
-                save_chat_status(tmsg.chat_id, STATUSES['HOME'])
             else:
+                save_chat_status(tmsg.chat_id, STATUSES['OPT_IN_DECLINED'])
                 telegram.send_keyboard(
                     token,
                     tmsg.chat_id,
                     globalvars.lang.text('MSG_PRIVACY_POLICY_DECLINE'),
                     globalvars.OPT_IN_DECLINED_KEYBOARD)
-                save_chat_status(tmsg.chat_id, STATUSES['OPT_IN_DECLINED'])
             return None
 
         elif chat_status == STATUSES['OPT_IN_DECLINED']:
             if tmsg.body == globalvars.lang.text('MENU_BACK_PRIVACY_POLICY'):
+                save_chat_status(tmsg.chat_id, STATUSES['OPT_IN'])
                 telegram.send_keyboard(
                     token,
                     tmsg.chat_id,
                     globalvars.lang.text("MSG_OPT_IN"),
                     globalvars.OPT_IN_KEYBOARD)
-                save_chat_status(tmsg.chat_id, STATUSES['OPT_IN'])
             elif tmsg.body == globalvars.lang.text('MENU_HOME_CHANGE_LANGUAGE'):
+                save_chat_status(tmsg.chat_id, STATUSES['SET_LANGUAGE'])
                 keyboard = make_language_keyboard()
                 telegram.send_keyboard(
                     token,
                     tmsg.chat_id,
                     globalvars.lang.text('MSG_SELECT_LANGUAGE'),
                     keyboard)
-                save_chat_status(tmsg.chat_id, STATUSES['SET_LANGUAGE'])
             return None
 
         elif chat_status == STATUSES['HOME']:
@@ -322,10 +566,7 @@ def bot_handler(event, _):
                 try:
                     user_exist = api.get_user(tmsg.user_uid)
                 except Exception:
-                    telegram.send_message(
-                        token,
-                        tmsg.chat_id,
-                        globalvars.lang.text('MSG_ERROR'))
+                    send_error(token, tmsg)
                     return None
 
                 if not user_exist:
@@ -339,48 +580,37 @@ def bot_handler(event, _):
                         tmsg.chat_id,
                         '/start')
                     return None
-                elif not user_exist['outline_key']:
-                    telegram.send_message(
-                        token,
-                        tmsg.chat_id,
-                        globalvars.lang.text('MSG_NO_EXISTING_KEY'))
+                save_chat_status(tmsg.chat_id, STATUSES['HOME'])
+                reply = Reply(token, tmsg.chat_id)
+                if not user_exist['outline_key']:
+                    reply.add(globalvars.lang.text('MSG_NO_EXISTING_KEY'))
                 else:
                     awsurl = (CONFIG['OUTLINE_AWS_URL'].format(urllib.parse.quote(user_exist['outline_key'])))
-                    telegram.send_message(
-                        token,
-                        tmsg.chat_id,
+                    reply.add(
                         globalvars.lang.text('MSG_EXISTING_KEY_A').format(awsurl),
                         parse='MARKDOWN')
-                    telegram.send_message(
-                        token,
-                        tmsg.chat_id,
+                    reply.add(
                         globalvars.lang.text('MSG_EXISTING_KEY_B'),
                         parse='MARKDOWN')
-                    telegram.send_message(
-                        token,
-                        tmsg.chat_id,
-                        user_exist['outline_key'])
+                    reply.add(user_exist['outline_key'], separate=True)
 
-                telegram.send_keyboard(
-                    token,
-                    tmsg.chat_id,
-                    globalvars.lang.text('MSG_HOME_ELSE'),
-                    globalvars.HOME_KEYBOARD)
-                save_chat_status(tmsg.chat_id, STATUSES['HOME'])
+                reply.add(globalvars.lang.text('MSG_HOME_ELSE'), parse='MARKDOWN', closing=True)
+                reply.send(globalvars.HOME_KEYBOARD)
                 return None
             elif tmsg.body == globalvars.lang.text('MENU_CHECK_STATUS'):
                 blocked = False
                 banned = False
+                serverinfo = None
                 try:
                     user_info = api.get_outline_user(tmsg.user_uid)
                     vpnuser = api.get_user(tmsg.user_uid)
+                    banned = vpnuser['banned']
+                    # Read before replying, an error takes the chat home
+                    if not banned and user_info is not None:
+                        serverinfo = servers.get_server_info(user_info['server'])
                 except Exception:
-                    telegram.send_message(
-                        token,
-                        tmsg.chat_id,
-                        globalvars.lang.text('MSG_ERROR'))
+                    send_error(token, tmsg)
                     return None
-                banned = vpnuser['banned']
                 telegram.send_message(
                     token,
                     tmsg.chat_id,
@@ -388,17 +618,6 @@ def bot_handler(event, _):
                         if banned else globalvars.lang.text('MSG_ACCOUNT_INFO_OK')
                 )
                 if not banned:
-                    if user_info is not None:
-                        try:
-                            serverinfo = api.get_outline_server_info(user_info['server'])
-
-                        except Exception:
-                            telegram.send_message(
-                                token,
-                                tmsg.chat_id,
-                                globalvars.lang.text('MSG_ERROR'))
-                            return None
-
                     if serverinfo is not None:
                         blocked = serverinfo['is_blocked']
                     telegram.send_message(
@@ -417,14 +636,11 @@ def bot_handler(event, _):
                 try:
                     user_exist = api.get_user(tmsg.user_uid)
                 except Exception:
-                    telegram.send_message(
-                        token,
-                        tmsg.chat_id,
-                        globalvars.lang.text('MSG_ERROR'))
+                    send_error(token, tmsg)
                     return None
 
                 if not user_exist:
-                    logger.info("New user: {}".format(tmsg.user_uid))
+                    logger.info("New user: %s", tmsg.user_uid)
                     telegram.send_message(
                         token,
                         tmsg.chat_id,
@@ -436,23 +652,24 @@ def bot_handler(event, _):
                         '/start')
                     return None
                 elif not user_exist['outline_key']:
-                    create_new_key(tmsg, token)
-                    telegram.send_keyboard(
-                        token,
-                        tmsg.chat_id,
-                        globalvars.lang.text('MSG_HOME_ELSE'),
-                        globalvars.HOME_KEYBOARD)
                     save_chat_status(tmsg.chat_id, STATUSES['HOME'])
+                    reply = Reply(token, tmsg.chat_id)
+                    create_new_key(tmsg, reply)
+                    reply.add(globalvars.lang.text('MSG_HOME_ELSE'), parse='MARKDOWN', closing=True)
+                    reply.send(globalvars.HOME_KEYBOARD)
                     return None
 
-                issues_dict = api.get_issues(tmsg.lang)
-                issues = list(issues_dict.values())
-                keyboard = telegram.make_keyboard(issues, 2, '')
+                try:
+                    issues_dict = api.get_issues(tmsg.lang)
+                except Exception:
+                    send_error(token, tmsg)
+                    return None
+                save_chat_status(tmsg.chat_id, STATUSES['ASK_ISSUE'])
+                keyboard = make_issue_keyboard(issues_dict)
                 telegram.send_keyboard(
                     token, tmsg.chat_id,
                     globalvars.lang.text("MSG_ASK_ISSUE"),
                     keyboard)
-                save_chat_status(tmsg.chat_id, STATUSES['ASK_ISSUE'])
                 return None
 
             elif tmsg.body == globalvars.lang.text('MENU_HOME_FAQ'):
@@ -468,13 +685,11 @@ def bot_handler(event, _):
                 return None
 
             elif tmsg.body == globalvars.lang.text('MENU_HOME_INSTRUCTION'):
-                photo_name = ""
-                with open(photo_name, 'rb') as photofile:
-                    telegram.send_photo(
-                        token,
-                        tmsg.chat_id,
-                        photofile.read(),
-                        "instructions")
+                assets.send_photo(
+                    token,
+                    tmsg.chat_id,
+                    'OUTLINE_GUIDE_PHOTO_FILE',
+                    globalvars.lang.language)
                 telegram.send_keyboard(
                     token,
                     tmsg.chat_id,
@@ -483,13 +698,13 @@ def bot_handler(event, _):
                 return None
 
             elif tmsg.body == globalvars.lang.text('MENU_HOME_CHANGE_LANGUAGE'):
+                save_chat_status(tmsg.chat_id, STATUSES['SET_LANGUAGE'])
                 keyboard = make_language_keyboard()
                 telegram.send_keyboard(
                     token,
                     tmsg.chat_id,
                     globalvars.lang.text('MSG_SELECT_LANGUAGE'),
                     keyboard)
-                save_chat_status(tmsg.chat_id, STATUSES['SET_LANGUAGE'])
                 return None
 
             elif tmsg.body == globalvars.lang.text('MENU_HOME_PRIVACY_POLICY'):
@@ -521,74 +736,50 @@ def bot_handler(event, _):
                 return None
 
             elif tmsg.body == globalvars.lang.text('MENU_HOME_DELETE_ACCOUNT'):
-                keyboard = telegram.make_keyboard(
-                    globalvars.lang.text('MENU_DELETE_REASONS'),
-                    2,
-                    globalvars.lang.text('MENU_BACK_HOME'))
+                save_chat_status(tmsg.chat_id, STATUSES['DELETE_ACCOUNT_REASON'])
+                keyboard = picker(
+                    get_keyboards(globalvars.lang), 'DELETE_REASONS')
                 telegram.send_keyboard(
                     token, tmsg.chat_id,
                     globalvars.lang.text("MSG_ASK_DELETE_REASONS"),
                     keyboard)
-                save_chat_status(tmsg.chat_id, STATUSES['DELETE_ACCOUNT_REASON'])
                 return None
 
         elif chat_status == STATUSES['ASK_ISSUE']:
-            issues_dict = api.get_issues(tmsg.lang)
+            try:
+                issues_dict = api.get_issues(tmsg.lang)
+            except Exception:
+                send_error(token, tmsg)
+                return None
             issue_ids = [key for (key, value) in issues_dict.items() if value == tmsg.body]
-            if not issue_ids:
-                telegram.send_message(
-                    token,
-                    tmsg.chat_id,
-                    globalvars.lang.text("MSG_UNSUPPORTED_COMMAND"))
-            else:
-                create_new_key(tmsg, token, issue_ids[0])
-
-            telegram.send_keyboard(
-                token,
-                tmsg.chat_id,
-                globalvars.lang.text('MSG_HOME_ELSE'),
-                globalvars.HOME_KEYBOARD)
-            save_chat_status(tmsg.chat_id, STATUSES['HOME'])
+            report_issue(token, tmsg, issue_ids[0] if issue_ids else None)
             return None
 
         elif chat_status == STATUSES['DELETE_ACCOUNT_REASON']:
             if tmsg.body in globalvars.lang.text('MENU_DELETE_REASONS'):
-                reason_id = globalvars.lang.text('MENU_DELETE_REASONS').index(tmsg.body)
-                logger.debug('user {} wants to delete her account because {}'.format(
-                    tmsg.user_uid,
-                    tmsg.body
-                ))
-                try:
-                    deleted = api.delete_user(user_id=tmsg.user_uid)
-                except Exception:
-                    telegram.send_keyboard(
-                        token,
-                        tmsg.chat_id,
-                        globalvars.lang.text('MSG_ERROR'),
-                        globalvars.HOME_KEYBOARD)
-                    return None
-                if deleted:
-                    telegram.send_keyboard(
-                        token, tmsg.chat_id,
-                        globalvars.lang.text("MSG_DELETED_ACCOUNT"),
-                        globalvars.BACK_TO_HOME_KEYBOARD)
-                    save_chat_status(tmsg.chat_id, STATUSES['DELETE_ACCOUNT_CONFIRM'])
-                return None
+                delete_account(
+                    token,
+                    tmsg,
+                    globalvars.lang.text('MENU_DELETE_REASONS').index(tmsg.body))
+            return None
 
         else:  # unsupported message from user
-            telegram.send_message(
-                token,
-                tmsg.chat_id,
-                globalvars.lang.text("MSG_UNSUPPORTED_COMMAND"))
-
             try:
                 user_exist = api.get_user(tmsg.user_uid)
             except Exception:
                 telegram.send_message(
                     token,
                     tmsg.chat_id,
-                    globalvars.lang.text('MSG_ERROR'))
+                    globalvars.lang.text("MSG_UNSUPPORTED_COMMAND"))
+                send_error(token, tmsg, home=False)
                 return None
+            save_chat_status(
+                tmsg.chat_id,
+                STATUSES['HOME'] if user_exist else STATUSES['SET_LANGUAGE'])
+            telegram.send_message(
+                token,
+                tmsg.chat_id,
+                globalvars.lang.text("MSG_UNSUPPORTED_COMMAND"))
             if not user_exist:  # start from First step
                 keyboard = make_language_keyboard()
                 telegram.send_keyboard(
@@ -596,13 +787,27 @@ def bot_handler(event, _):
                     tmsg.chat_id,
                     globalvars.lang.text('MSG_SELECT_LANGUAGE'),
                     keyboard)
-                save_chat_status(tmsg.chat_id, STATUSES['SET_LANGUAGE'])
-                return None
             else:
                 telegram.send_keyboard(
                     token,
                     tmsg.chat_id,
                     globalvars.lang.text('MSG_HOME_ELSE'),
                     globalvars.HOME_KEYBOARD)
-                save_chat_status(tmsg.chat_id, STATUSES['HOME'])
             return None
+
+
+def queue_handler(event, _):
+    """
+    Entry point of the queue consumer, handles a batch of the updates
+    the webhook enqueued with CONFIG['INGESTION_MODE'] set to 'queue'
+
+    :param event: SQS event with the queued updates in Records
+    :param _: information about the invocation (unused)
+    :return: Messages to retry, for ReportBatchItemFailures
+    """
+    failed = ingest.consume(
+        event.get('Records', []),
+        lambda update: bot_handler(update, None))
+    if failed:
+        logger.warning('%d queued updates will be retried', len(failed))
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed]}
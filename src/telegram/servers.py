@@ -0,0 +1,151 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Server Info Cache
+Remembers whether the Outline servers are blocked
+
+Lookups go to a process local cache first, then to the info table and
+only then to the API server. Entries live CONFIG['SERVER_INFO_TTL']
+seconds, unknown servers CONFIG['SERVER_INFO_NEGATIVE_TTL'] seconds, and
+the process local copy at most LOCAL_TTL seconds so an invalidation
+reaches every warm container quickly.
+
+The distribution server invalidates an entry by posting a server_update
+to the bot webhook, signed with CONFIG['SERVER_WEBHOOK_SECRET']:
+
+    {"server_update": {"server_id": 12, "is_blocked": true,
+                       "timestamp": 1600000000, "signature": "<hex>"}}
+
+The signature is the HMAC-SHA256 of "<server_id>:<0 or 1>:<timestamp>".
+Admins can drop an entry with the /refreshserver <server_id> command.
+"""
+
+import hashlib
+import hmac
+import logging
+import time
+import api
+import dynamodb
+from settings import CONFIG
+
+logger = logging.getLogger()
+
+# Seconds a container trusts its own copy of an entry
+LOCAL_TTL = 30
+# Seconds a signed server_update is accepted after it was made
+WEBHOOK_MAX_AGE = 300
+
+_cache = {}
+
+
+def get_server_info(server_id, now=None):
+    """
+    Looks up whether an Outline server is blocked
+
+    :param server_id: ID of the Outline server
+    :param now: Current time in seconds since epoch
+    :return: {'is_blocked': flag} or None if the server is unknown
+    :raise: Any error of api.get_outline_server_info
+    """
+    now = now or time.time()
+    entry = _cache.get(str(server_id))
+    if entry is not None and entry[0] > now:
+        return entry[1]
+
+    info = dynamodb.get_server_info(CONFIG['INFO_DYNAMO_TABLE'], server_id)
+    if info is None:
+        serverinfo = api.get_outline_server_info(server_id)
+        info = {'is_blocked': bool(serverinfo['is_blocked'])} if serverinfo else {}
+        _save(server_id, info.get('is_blocked'))
+    _remember(server_id, info or None, now)
+    return info or None
+
+
+def invalidate(server_id, is_blocked=None):
+    """
+    Drops the cached entry of a server, or replaces it when the new
+    blocked flag is known
+
+    :param server_id: ID of the Outline server
+    :param is_blocked: New blocked flag, None to look it up again
+    :return: True in case of success and False otherwise
+    """
+    _cache.pop(str(server_id), None)
+    if is_blocked is None:
+        return dynamodb.save_server_info(
+            CONFIG['INFO_DYNAMO_TABLE'], server_id, None, 0)
+    return _save(server_id, is_blocked)
+
+
+def signature(server_id, is_blocked, timestamp, secret):
+    """
+    Signs a server_update
+
+    :param server_id: ID of the Outline server
+    :param is_blocked: Blocked flag
+    :param timestamp: Seconds since epoch when the update was made
+    :param secret: Shared secret
+    :return: Hex digest
+    """
+    message = '{}:{}:{}'.format(server_id, int(bool(is_blocked)), int(timestamp))
+    return hmac.new(
+        secret.encode('utf-8'), message.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def handle_webhook(update, now=None):
+    """
+    Applies a server_update posted by the distribution server
+
+    :param update: server_update object of the webhook body
+    :param now: Current time in seconds since epoch
+    :return: True if the update was applied
+    """
+    secret = CONFIG.get('SERVER_WEBHOOK_SECRET')
+    # An unset variable is left as '$SERVER_WEBHOOK_SECRET' by envsubst
+    if not secret or secret.startswith('$'):
+        logger.warning('server_update ignored, no SERVER_WEBHOOK_SECRET set')
+        return False
+    try:
+        server_id = update['server_id']
+        is_blocked = bool(update['is_blocked'])
+        timestamp = int(update['timestamp'])
+        given = str(update['signature'])
+    except (KeyError, TypeError, ValueError):
+        logger.warning('Malformed server_update: %s', update)
+        return False
+
+    expected = signature(server_id, is_blocked, timestamp, secret)
+    if not hmac.compare_digest(expected, given):
+        logger.warning('server_update with a bad signature for %s', server_id)
+        return False
+    if abs((now or time.time()) - timestamp) > WEBHOOK_MAX_AGE:
+        logger.warning('Stale server_update for %s', server_id)
+        return False
+
+    logger.info('Server %s is now %s', server_id, 'blocked' if is_blocked else 'open')
+    return invalidate(server_id, is_blocked)
+
+
+def _save(server_id, is_blocked):
+    if is_blocked is None:
+        ttl = CONFIG.get('SERVER_INFO_NEGATIVE_TTL', 60)
+    else:
+        ttl = CONFIG.get('SERVER_INFO_TTL', 300)
+    return dynamodb.save_server_info(
+        CONFIG['INFO_DYNAMO_TABLE'], server_id, is_blocked, ttl)
+
+
+def _remember(server_id, info, now):
+    _cache[str(server_id)] = (now + LOCAL_TTL, info)
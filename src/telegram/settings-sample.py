@@ -17,21 +17,78 @@ import logging
 
 CONFIG = {
     'LOG_LEVEL': logging.INFO,
+    # 'text' or 'json', JSON records are written from a background thread
+    'LOG_FORMAT': 'text',
+    # Share of updates whose whole payload is logged
+    'LOG_PAYLOAD_SAMPLE_RATE': 0.01,
     'VERSION': '0.1.0',
     'BOT_ADMIN': 'OutlineAdmin',
     'SUPPORT_BOT': '',
     'ADMIN': $ADMIN_LIST,
 
+    # Chat state backend: 'dynamodb', 'memory' or 'sqlite'
+    'STATE_BACKEND': 'dynamodb',
+    'STATE_SQLITE_FILE': '/tmp/outline-state.db',
+    # 'direct' handles updates in the webhook, 'queue' only enqueues them
+    # for outlinebot.queue_handler
+    'INGESTION_MODE': 'direct',
+    # Update queue backend: 'sqs' (a FIFO queue), 'memory' or 'sqlite'
+    'QUEUE_BACKEND': 'sqs',
+    'QUEUE_URL': '$AWS_SQS_QUEUE_URL',
+    'QUEUE_SQLITE_FILE': '/tmp/outline-queue.db',
+    # Attempts before a failing queued update is dropped by the polling
+    # consumer, set maxReceiveCount of the SQS redrive policy to match
+    'QUEUE_MAX_RECEIVES': 3,
+    # One summary line of external call timings per update: 'json' or 'emf'
+    'TRACE_ENABLED': False,
+    'TRACE_FORMAT': 'json',
     'DYNAMO_TABLE': '$AWS_DYNAMO_TABLE',
+    # Secret of the keyed hash that names the chat items, changing it
+    # loses the state of every chat
+    'CHAT_KEY_SECRET': '$CHAT_KEY_SECRET',
+    # Look for chats in the v1 item layout, switch off once
+    # tools/migrate_chats.py has run
+    'CHAT_SCHEMA_V1_READS': True,
+    # Seconds a chat that never finished onboarding is kept
+    'ONBOARDING_TTL': 2592000,
+    # Times an update is handled again when another update of the same
+    # chat claimed it first
+    'STATE_CONFLICT_RETRIES': 2,
     'INFO_DYNAMO_TABLE': '$AWS_INFO_DYNAMO_TABLE',
+    # Seconds a cached Telegram file_id is trusted after the upload
+    'FILE_ID_TTL': 604800,
+    # Seconds the blocked flag of a server is cached, unknown servers
+    # are looked up again after SERVER_INFO_NEGATIVE_TTL
+    'SERVER_INFO_TTL': 300,
+    'SERVER_INFO_NEGATIVE_TTL': 60,
+    # Shared secret signing the server_update webhook of the distribution
+    # server, the webhook is ignored when empty
+    'SERVER_WEBHOOK_SECRET': '$SERVER_WEBHOOK_SECRET',
     'API_KEY': '$API_KEY',
     'API_URL': '$API_URL',
+    # Read timeout of API calls in seconds
+    'API_TIMEOUT': 10,
+    # The API circuit breaker opens after this many failed calls in a row,
+    # a call slower than API_SLOW_CALL seconds counts as failed
+    'API_BREAKER_FAILURES': 5,
+    'API_SLOW_CALL': 5,
+    # Seconds the breaker refuses calls before letting one probe through
+    'API_BREAKER_RESET': 30,
+    # Ban API calls in flight at once when an admin uploads a ban list
+    'BULK_BAN_WORKERS': 8,
+    # Longest ban list handled by the webhook and by the queue consumer
+    'BULK_BAN_MAX_USERS': 200,
+    'BULK_BAN_MAX_QUEUED': 5000,
 
     'TELEGRAM_START_COMMAND': 'start',
     'TELEGRAM_ADMIN_COMMAND': 'admin',
+    # Admin command dropping the cached status of one server
+    'TELEGRAM_REFRESH_SERVER_COMMAND': 'refreshserver',
     'LANGUAGE_FILE': 'lang.json',
     'ITEMS_PER_ROW': 3,
     'MAX_ITEMS_PER_ROW': 4,
+    # Inline keyboards for the language, issue, delete reason and admin pickers
+    'INLINE_KEYBOARDS': False,
     'MSG_TIMEOUT': 33,
     'OUTLINE_AWS_URL': 'https://s3.amazonaws.com/outline-vpn/invite.html#{}',
     'OUTLINE_GUIDE_PHOTO_FILE': 'Pask-Outline-guideline.png',
@@ -0,0 +1,124 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Usage Statistics
+Counts events in hourly and daily buckets of the info table
+
+Counts made while handling an update are collected and written when
+the update is done, with one atomic ADD per bucket. The admin report
+reads the buckets it shows with a single batch read.
+
+Counters:
+    new_users: users who accepted the privacy policy
+    keys: keys issued
+    keys_issue_<id>: keys issued for a reported issue
+    deletions_reason_<id>: deleted accounts per reason
+    captcha_failures: wrong captcha answers
+    errors: errors shown to users
+"""
+
+import functools
+import time
+from collections import Counter
+import dynamodb
+from settings import CONFIG
+
+HOUR_TTL = 3 * 24 * 3600
+DAY_TTL = 400 * 24 * 3600
+HOURS_SHOWN = 24
+DAYS_SHOWN = 7
+
+_pending = Counter()
+
+
+def hour_bucket(timestamp):
+    return time.strftime('h%Y%m%d%H', time.gmtime(timestamp))
+
+
+def day_bucket(timestamp):
+    return time.strftime('d%Y%m%d', time.gmtime(timestamp))
+
+
+def count(name, amount=1):
+    """
+    Counts an event of the current update
+
+    :param name: counter name
+    :param amount: number of events
+    """
+    _pending[name] += amount
+
+
+def flush(now=None):
+    """
+    Writes the counts of the current update
+
+    :param now: time of the events in seconds since epoch
+    """
+    if not _pending:
+        return
+    now = now or time.time()
+    counters = dict(_pending)
+    _pending.clear()
+    table = CONFIG['INFO_DYNAMO_TABLE']
+    dynamodb.add_counters(table, hour_bucket(now), counters, HOUR_TTL)
+    dynamodb.add_counters(table, day_bucket(now), counters, DAY_TTL)
+
+
+def recorded(handler):
+    """
+    Decorator writing the counts of an update once it is handled
+    """
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            flush()
+    return wrapper
+
+
+def report(now=None):
+    """
+    Sums up the counters of the last hours and days
+
+    :param now: end of the report in seconds since epoch
+    :return: List of (counter, last HOURS_SHOWN hours, last DAYS_SHOWN
+        days) sorted by counter, or None in case of error
+    """
+    now = now or time.time()
+    hours = [hour_bucket(now - 3600 * index) for index in range(HOURS_SHOWN)]
+    days = [day_bucket(now - 86400 * index) for index in range(DAYS_SHOWN)]
+    buckets = dynamodb.get_counters(CONFIG['INFO_DYNAMO_TABLE'], hours + days)
+    if buckets is None:
+        return None
+    hour_totals = sum((Counter(bucket) for bucket in buckets[:HOURS_SHOWN]), Counter())
+    day_totals = sum((Counter(bucket) for bucket in buckets[HOURS_SHOWN:]), Counter())
+    return [(name, hour_totals[name], day_totals[name])
+            for name in sorted(set(hour_totals) | set(day_totals))]
+
+
+def render(rows, header):
+    """
+    Formats a report as a message
+
+    :param rows: result of report()
+    :param header: first line of the message
+    :return: message text
+    """
+    lines = [header]
+    for (name, hours, days) in rows:
+        lines.append('{}: {} / {}'.format(name, hours, days))
+    return '\n'.join(lines)
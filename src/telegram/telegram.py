@@ -20,18 +20,41 @@ Holds functions for working with Telegram API
 import json
 import csv
 import io
+import uuid
 from datetime import datetime
-import boto3
-from botocore.exceptions import ClientError
 import requests
 from requests.exceptions import ConnectionError, HTTPError, Timeout, TooManyRedirects
 from errors import AWSError, TelegramError, ValidationError
-import storage
+from lazy import lazy_module
+import tracing
+
+# Only file transfers and save_request need AWS
+boto3 = lazy_module("boto3")
+storage = lazy_module("storage")
+fileids = lazy_module("fileids")
 
 TELEGRAM_HOSTNAME = "https://api.telegram.org"
 TELEGRAM_SEC_PORT = 443
 TELEGRAM_METHOD = "POST"
 MAX_ITEMS_PER_ROW = 4
+# Bytes read from S3 per step when streaming a file to Telegram
+STREAM_CHUNK_SIZE = 64 * 1024
+# Largest file the Bot API lets bots download
+MAX_DOWNLOAD_SIZE = 20 * 1024 * 1024
+
+
+def _post(url, **kwargs):
+    """
+    POST to the Telegram API, timed as one operation of the update trace
+
+    :param url: Telegram API method URL
+    :param kwargs: arguments for requests.post
+    :return: requests Response
+    """
+    with tracing.span('telegram.' + url.rsplit('/', 1)[-1]) as span:
+        response = requests.post(url, **kwargs)
+        span.response(response)
+    return response
 
 
 def get_file_path(token, file_id):
@@ -54,8 +77,8 @@ def get_file_path(token, file_id):
 
     url = make_getfile_url(token)
     try:
-        response = requests.post(url, headers=headers,
-                                 data=json.dumps(post_data))
+        response = _post(url, headers=headers,
+                         data=json.dumps(post_data))
     except ConnectionError as error:
         raise TelegramError(
             "Error connecting to Telegram API: {}".format(str(error)))
@@ -71,6 +94,49 @@ def get_file_path(token, file_id):
     return response
 
 
+def download_file(token, file_id, max_size=MAX_DOWNLOAD_SIZE):
+    """
+    Downloads a file a user sent to the bot
+
+    :param token: telegram api key
+    :param file_id: file_id of the document
+    :param max_size: largest accepted file in bytes
+    :return: file contents
+    :raise: TelegramError: Telegram API call failed
+    :raise: ValidationError: file is larger than max_size
+    """
+    response = get_file_path(token, file_id)
+    if response.status_code >= 400:
+        raise TelegramError("Error response from Telegram API: {} {}".format(
+            str(response), response.text))
+    try:
+        result = response.json()["result"]
+        file_path = result["file_path"]
+    except (ValueError, KeyError):
+        raise TelegramError("Error in response: {}".format(str(response.text)))
+    if result.get("file_size", 0) > max_size:
+        raise ValidationError("File is larger than {} bytes".format(max_size))
+
+    try:
+        with tracing.span("telegram.file") as span:
+            response = requests.get(make_file_url(token, file_path))
+            span.response(response)
+    except ConnectionError as error:
+        raise TelegramError(
+            "Error connecting to Telegram API: {}".format(str(error)))
+    except HTTPError as error:
+        raise TelegramError(
+            "Error in GET request to Telegram API: {}".format(str(error)))
+    except Timeout as error:
+        raise TelegramError(
+            "Timeout connecting to Telegram API: {}".format(str(error)))
+
+    if response.status_code >= 400:
+        raise TelegramError("Error response from Telegram API: {} {}".format(
+            str(response), response.text))
+    return response.content
+
+
 def hide_keyboard(token, chat_id, text):
     """
     Send a text message and hides the keyboard for the user.
@@ -94,8 +160,8 @@ def hide_keyboard(token, chat_id, text):
 
     url = TELEGRAM_HOSTNAME + "/bot" + token + "/sendMessage"
     try:
-        response = requests.post(url, headers=headers,
-                                 data=json.dumps(post_data))
+        response = _post(url, headers=headers,
+                         data=json.dumps(post_data))
     except ConnectionError as error:
         raise TelegramError(
             "Error connecting to Telegram API: {}".format(str(error)))
@@ -137,6 +203,150 @@ def make_getfile_url(token):
     return TELEGRAM_HOSTNAME + "/bot" + token + "/getFile"
 
 
+class PreparedKeyboard(list):
+    """
+    Keyboard rows with their reply_markup JSON serialized once
+
+    It is the list of rows make_keyboard returns, the send functions
+    post the cached JSON instead of serializing the rows on every call.
+    Do not modify the rows after the first markup() call.
+    """
+    __slots__ = ("_markups",)
+
+    def __init__(self, rows=()):
+        super(PreparedKeyboard, self).__init__(rows)
+        self._markups = {}
+
+    def markup(self, one_time=True, resize=True, inline=False):
+        """
+        Returns the serialized reply_markup for the given flags
+
+        :param one_time: if one_time_keyboard should be set
+        :param resize: if resize_keyboard should be set
+        :param inline: inline keyboard
+        :return: reply_markup JSON string
+        """
+        flags = (one_time, resize, inline)
+        markup = self._markups.get(flags)
+        if markup is None:
+            markup = json.dumps(make_reply_markup(self, one_time, resize, inline))
+            self._markups[flags] = markup
+        return markup
+
+
+class InlineKeyboard(PreparedKeyboard):
+    """
+    PreparedKeyboard that is always sent as an inline keyboard
+    """
+    __slots__ = ()
+
+    def markup(self, one_time=True, resize=True, inline=True):
+        return super(InlineKeyboard, self).markup(False, False, True)
+
+
+EMPTY_KEYBOARD = PreparedKeyboard()
+
+
+def make_reply_markup(keyboard, one_time=True, resize=True, inline=False):
+    """
+    Makes the reply_markup object of a keyboard
+
+    :param keyboard: a compiled keyboard
+    :param one_time: if one_time_keyboard should be set
+    :param resize: if resize_keyboard should be set
+    :param inline: inline keyboard
+    :return: reply_markup object for use in Telegram API
+    """
+    if inline:
+        return {
+            "inline_keyboard": keyboard,
+        }
+    return {
+        "keyboard": keyboard,
+        "one_time_keyboard": one_time,
+        "resize_keyboard": resize
+    }
+
+
+def serialize_reply_markup(keyboard, one_time=True, resize=True, inline=False):
+    """
+    Serializes the reply_markup of a keyboard, cached for PreparedKeyboard
+
+    :return: reply_markup JSON string
+    """
+    if not keyboard:
+        keyboard = EMPTY_KEYBOARD
+    if isinstance(keyboard, PreparedKeyboard):
+        return keyboard.markup(one_time, resize, inline)
+    return json.dumps(make_reply_markup(keyboard, one_time, resize, inline))
+
+
+def _json_body(post_data, reply_markup=None):
+    """
+    Serializes a request body once, splicing in a serialized reply_markup
+
+    :param post_data: non-empty request fields
+    :param reply_markup: reply_markup JSON string or None
+    :return: body bytes
+    """
+    body = json.dumps(post_data)
+    if reply_markup is not None:
+        body = body[:-1] + ', "reply_markup": ' + reply_markup + "}"
+    return body.encode("utf-8")
+
+
+class MultipartStream(object):
+    """
+    multipart/form-data body that streams one file part from a reader
+
+    requests sends an iterable with a length as-is with a Content-Length
+    header, so the file is never held in memory as a whole.
+    """
+    __slots__ = ("content_type", "_head", "_tail", "_body", "_length",
+                 "_chunk_size")
+
+    def __init__(self, fields, name, filename, body, length,
+                 chunk_size=STREAM_CHUNK_SIZE):
+        """
+        :param fields: dictionary of plain form fields
+        :param name: form field name of the file
+        :param filename: file name sent to Telegram
+        :param body: file-like object to read the file from
+        :param length: number of bytes body holds
+        :param chunk_size: number of bytes read from body per step
+        """
+        boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary=" + boundary
+        head = []
+        for (field, value) in fields.items():
+            head.append(
+                "--{}\r\nContent-Disposition: form-data; name=\"{}\"\r\n\r\n"
+                "{}\r\n".format(boundary, field, value))
+        head.append(
+            "--{}\r\nContent-Disposition: form-data; name=\"{}\"; "
+            "filename=\"{}\"\r\nContent-Type: application/octet-stream"
+            "\r\n\r\n".format(boundary, name, filename.replace("\"", "")))
+        self._head = "".join(head).encode("utf-8")
+        self._tail = "\r\n--{}--\r\n".format(boundary).encode("utf-8")
+        self._body = body
+        self._length = length
+        self._chunk_size = chunk_size
+
+    def __len__(self):
+        return len(self._head) + self._length + len(self._tail)
+
+    def __iter__(self):
+        yield self._head
+        remaining = self._length
+        while remaining > 0:
+            chunk = self._body.read(min(self._chunk_size, remaining))
+            if not chunk:
+                raise IOError("File ended {} bytes early".format(remaining))
+            remaining -= len(chunk)
+            yield chunk
+        yield self._tail
+
+
 def make_keyboard(items, items_per_row=0, add_home=""):
     """
     Makes a keyboard json out of items list and order them per items_per_row.
@@ -170,6 +380,19 @@ def make_keyboard(items, items_per_row=0, add_home=""):
     return keyboard
 
 
+def make_inline_keyboard(buttons, items_per_row=0):
+    """
+    Makes an inline keyboard out of (text, callback_data) pairs
+
+    :param buttons: list of (button text, callback_data) tuples
+    :param items_per_row: Number of items per row
+    :return: keyboard object for use with inline=True
+    """
+    return make_keyboard(
+        [{"text": text, "callback_data": data} for (text, data) in buttons],
+        items_per_row)
+
+
 def send_csv(token, chat_id, content, filename):
     """
     Send a CSV file to telegram user
@@ -193,7 +416,8 @@ def send_csv(token, chat_id, content, filename):
     return send_document(token, chat_id, buf, filename)
 
 
-def send_file(token, chat_id, text, file_bucket, file_key, config=None):
+def send_file(token, chat_id, text, file_bucket, file_key, config=None,
+              chunk_size=STREAM_CHUNK_SIZE, etag=None):
     """
     Returns a file to the user using the S3 link provided
 
@@ -203,8 +427,11 @@ def send_file(token, chat_id, text, file_bucket, file_key, config=None):
     :param file_bucket: bucket of the file in S3
     :param file_key: key of file to send in S3
     :param config: if we should use file_id
+    :param chunk_size: number of bytes read from S3 per step when uploading
+    :param etag: ETag of the object if the caller knows it, saves a HEAD
     :return: response from Telegram API call
     :raise: TelegramError: when Telegram API call fails
+    :raise: AWSError: couldn't load metadata from S3
     """
     if file_bucket is None or len(file_bucket) == "":
         raise ValidationError("S3 Bucket name is empty")
@@ -217,60 +444,64 @@ def send_file(token, chat_id, text, file_bucket, file_key, config=None):
 
     if config is not None:
         # Bypass file_id when we are proxying the file
-        _send_document_from_s3(token, chat_id, file_bucket, file_key, config)
-        return
-
-    metadata = storage.get_object_metadata(file_bucket, file_key).metadata
-    if "file_id" in metadata:
-        # send file_id
-        file_id = metadata["file_id"]
-        _send_document_cached(token, chat_id, file_bucket, file_key, file_id)
-    else:
-        _send_document_from_s3(token, chat_id, file_bucket, file_key, config)
+        return _send_document_from_s3(
+            token, chat_id, file_bucket, file_key, config, chunk_size)
 
+    name = fileids.s3_name(
+        file_bucket, file_key, etag or fileids.current_etag(file_bucket, file_key))
+    file_id = fileids.get_file_id(name)
+    if file_id is None:
+        return _send_document_from_s3(
+            token, chat_id, file_bucket, file_key, chunk_size=chunk_size)
 
-def _send_document_cached(token, chat_id, file_bucket, file_key, file_id):
+    try:
+        return _send_document_cached(token, chat_id, file_id)
+    except TelegramError:
+        # Only a failed send is worth the getFile round trip
+        lookup_file_id = get_file_path(token, file_id).json()
+        if lookup_file_id.get("ok") and "result" in lookup_file_id:
+            raise
+    fileids.forget_file_id(name)
+    return _send_document_from_s3(
+        token, chat_id, file_bucket, file_key, chunk_size=chunk_size)
+
+
+def _send_document_cached(token, chat_id, file_id):
     """
     Send Telegram-cached copy of file
 
     :param token: telegram api key
     :param chat_id: ID of the chat with the user
-    :param file_bucket: bucket of the file in S3
-    :param file_key: key of file to send in S3
     :param file_id: Teleram file id
     :return: response from Telegram API call
     :raise: TelegramError: when Telegram API call fails
     """
-    lookup_file_id = get_file_path(token, file_id).json()
-    if lookup_file_id["ok"] and "result" in lookup_file_id:
-        post_data = {
-            "chat_id": chat_id,
-            "document": file_id
-        }
-        url = TELEGRAM_HOSTNAME + "/bot" + token + "/sendDocument"
-
-        try:
-            response = requests.post(url, data=post_data)
-        except ConnectionError as error:
-            raise TelegramError(
-                "Error connecting to Telegram API: {}".format(str(error)))
-        except HTTPError as error:
-            raise TelegramError(
-                "Error in POST request to Telegram API: {}".format(str(error)))
-        except Timeout as error:
-            raise TelegramError(
-                "Timeout connecting to Telegram API: {}".format(str(error)))
-
-        if response.status_code >= 400:
-            raise TelegramError("Error response from Telegram API: {} {}".format(
-                str(response), response.text))
-        return response
-    else:
-        # cache miss
-        _send_document_from_s3(token, chat_id, file_bucket, file_key)
+    post_data = {
+        "chat_id": chat_id,
+        "document": file_id
+    }
+    url = TELEGRAM_HOSTNAME + "/bot" + token + "/sendDocument"
+
+    try:
+        response = _post(url, data=post_data)
+    except ConnectionError as error:
+        raise TelegramError(
+            "Error connecting to Telegram API: {}".format(str(error)))
+    except HTTPError as error:
+        raise TelegramError(
+            "Error in POST request to Telegram API: {}".format(str(error)))
+    except Timeout as error:
+        raise TelegramError(
+            "Timeout connecting to Telegram API: {}".format(str(error)))
+
+    if response.status_code >= 400:
+        raise TelegramError("Error response from Telegram API: {} {}".format(
+            str(response), response.text))
+    return response
 
 
-def _send_document_from_s3(token, chat_id, file_bucket, file_key, config=None):
+def _send_document_from_s3(token, chat_id, file_bucket, file_key, config=None,
+                           chunk_size=STREAM_CHUNK_SIZE):
     """
     Send document directly to Telegram user
 
@@ -279,6 +510,7 @@ def _send_document_from_s3(token, chat_id, file_bucket, file_key, config=None):
     :param file_bucket: bucket of the file in S3
     :param file_key: key of file to send in S3
     :param config: if we should use file_id
+    :param chunk_size: number of bytes read from S3 per step
     :return: response from Telegram API call
     :raise: TelegramError: when Telegram API call fails
     """
@@ -297,17 +529,19 @@ def _send_document_from_s3(token, chat_id, file_bucket, file_key, config=None):
     except IOError as error:
         raise TelegramError("Error reading file: {}".format(str(error)))
 
-    post_data = {
-        "chat_id": chat_id
-    }
-    filename = file_key.split("/")[-1]
-    file_data = {
-        "document": (filename, file_to_send["Body"])
-    }
+    # The S3 body goes straight into the upload
+    body = MultipartStream(
+        {"chat_id": chat_id},
+        "document",
+        file_key.split("/")[-1],
+        file_to_send["Body"],
+        file_to_send["ContentLength"],
+        chunk_size)
     url = TELEGRAM_HOSTNAME + "/bot" + token + "/sendDocument"
 
     try:
-        response = requests.post(url, files=file_data, data=post_data)
+        response = _post(url, data=body,
+                         headers={"Content-Type": body.content_type})
     except ConnectionError as error:
         raise TelegramError(
             "Error connecting to Telegram API: {}".format(str(error)))
@@ -317,6 +551,10 @@ def _send_document_from_s3(token, chat_id, file_bucket, file_key, config=None):
     except Timeout as error:
         raise TelegramError(
             "Timeout connecting to Telegram API: {}".format(str(error)))
+    except IOError as error:
+        raise TelegramError("Error reading file: {}".format(str(error)))
+    finally:
+        file_to_send["Body"].close()
 
     if response.status_code >= 400:
         raise TelegramError("Error response from Telegram API: {} {}".format(
@@ -327,13 +565,18 @@ def _send_document_from_s3(token, chat_id, file_bucket, file_key, config=None):
     except ValueError as error:
         raise TelegramError("Error in response: {}".format(str(response.text)))
 
-    if data["ok"] and "result" in data:
-        storage.put_object_metadata(file_bucket, file_key, "file_id",
-                                    data["result"]["document"]["file_id"])
+    etag = file_to_send.get("ETag")
+    if data["ok"] and "result" in data and etag:
+        # Saved under the version that was uploaded
+        fileids.remember_etag(file_bucket, file_key, etag)
+        fileids.save_file_id(fileids.s3_name(file_bucket, file_key, etag),
+                             data["result"]["document"]["file_id"],
+                             etag)
     return response
 
 
-def send_keyboard(token, chat_id, text, keyboard=[], one_time=True, resize=True, inline=False):
+def send_keyboard(token, chat_id, text, keyboard=[], one_time=True, resize=True, inline=False,
+                  parse='MARKDOWN'):
     """ Returns a message with keyboard to the user
 
     :param token: telegram api key
@@ -343,6 +586,7 @@ def send_keyboard(token, chat_id, text, keyboard=[], one_time=True, resize=True,
     :param one_time: if one_time_keyboard should be set
     :param resize: if resize_keyboard should be set
     :param inline: Send inline keyboard
+    :param parse: Format to parse message in
     :return: Telegram API post response
     :raise: TelegramError: text is empty or error calling Telegram API
     """
@@ -351,33 +595,26 @@ def send_keyboard(token, chat_id, text, keyboard=[], one_time=True, resize=True,
 
     post_data = {
         "chat_id": chat_id,
-        "text": text,
-        "parse_mode": "Markdown"
+        "text": text
     }
 
-    if len(keyboard) == 0:
-        keyboard = make_keyboard([], 1)
+    if parse == 'HTML':
+        post_data['parse_mode'] = 'HTML'
+    elif parse == 'MARKDOWN':
+        post_data['parse_mode'] = 'Markdown'
 
-    if inline:
-        post_data["reply_markup"] = {
-            "inline_keyboard": keyboard,
-        }
-    else:
-        post_data["reply_markup"] = {
-            "keyboard": keyboard,
-            "one_time_keyboard": one_time,
-            "resize_keyboard": resize
-        }
+    body = _json_body(
+        post_data,
+        serialize_reply_markup(keyboard, one_time, resize, inline))
 
     headers = {
         "Content-Type": "application/json",
-        "Content-Length": str(len(json.dumps(post_data)))
+        "Content-Length": str(len(body))
     }
 
     url = TELEGRAM_HOSTNAME + "/bot" + token + "/sendMessage"
     try:
-        response = requests.post(url, headers=headers,
-                                 data=json.dumps(post_data))
+        response = _post(url, headers=headers, data=body)
     except ConnectionError as error:
         raise TelegramError(
             "Error connecting to Telegram API: {}".format(str(error)))
@@ -420,24 +657,18 @@ def send_message(token, chat_id, text, keyboard=[], parse=None):
     elif parse == 'MARKDOWN':
         post_data['parse_mode'] = 'Markdown'
 
-    if len(keyboard) == 0:
-        keyboard = make_keyboard([], 1)
-
-    post_data["reply_markup"] = {
-        "keyboard": keyboard,
-        "one_time_keyboard": False,
-        "resize_keyboard": True
-    }
+    body = _json_body(
+        post_data,
+        serialize_reply_markup(keyboard, one_time=False, resize=True))
 
     headers = {
         "Content-Type": "application/json",
-        "Content-Length": str(len(json.dumps(post_data)))
+        "Content-Length": str(len(body))
     }
 
     url = TELEGRAM_HOSTNAME + "/bot" + token + "/sendMessage"
     try:
-        response = requests.post(url, headers=headers,
-                                 data=json.dumps(post_data))
+        response = _post(url, headers=headers, data=body)
     except ConnectionError as error:
         raise TelegramError(
             "Error connecting to Telegram API: {}".format(str(error)))
@@ -455,6 +686,7 @@ def send_message(token, chat_id, text, keyboard=[], parse=None):
     return response
 
 
+@tracing.traced('dynamodb.put_item')
 def save_request(chat_id, msg_id, user_name, event, table_name="MajlisMonitorBot"):
     """
     Save a telegram request to dynamodb
@@ -480,6 +712,7 @@ def save_request(chat_id, msg_id, user_name, event, table_name="MajlisMonitorBot
             "S": str(event)
         },
     }
+    from botocore.exceptions import ClientError
     dynamodb = boto3.client("dynamodb")
     try:
         response = dynamodb.put_item(TableName=table_name, Item=record)
@@ -495,7 +728,9 @@ def send_photo(token, chat_id, photo, photoname, caption=None, keyboard=[], inli
 
     :param token: telegram api key
     :param chat_id: ID of the chat with the user
-    :param photo: photo binary to be sent to the user
+    :param photo: photo binary to be sent to the user, or a file_id
+    :param photoname: file name of the photo binary, None for a file_id
+    :param caption: caption of the photo
     :param keyboard: a compiled keyboard to be sent to the user
     :param inline: send inline keyboard
     :return: Telegram response object
@@ -506,9 +741,10 @@ def send_photo(token, chat_id, photo, photoname, caption=None, keyboard=[], inli
 
     post_data = {
         "chat_id": chat_id,
-        "parse_mode": "Markdown",
-        "caption": caption
+        "parse_mode": "Markdown"
     }
+    if caption is not None:
+        post_data["caption"] = caption
 
     if keyboard:
         if inline:
@@ -533,14 +769,14 @@ def send_photo(token, chat_id, photo, photoname, caption=None, keyboard=[], inli
                 "Content-Length": str(len(json.dumps(post_data)))
             }
 
-            response = requests.post(
+            response = _post(
                 url, data=json.dumps(post_data), headers=headers)
 
         else:
             photo_data = {
                 "photo": (photoname, photo)
             }
-            response = requests.post(url, files=photo_data, data=post_data)
+            response = _post(url, files=photo_data, data=post_data)
 
     except ConnectionError as error:
         raise TelegramError(
@@ -552,7 +788,6 @@ def send_photo(token, chat_id, photo, photoname, caption=None, keyboard=[], inli
         raise TelegramError(
             "Timeout connecting to Telegram API: {}".format(str(error)))
 
-    data = response.json()
     if response.status_code >= 400:
         raise TelegramError("Error response from Telegram API: {} {}".format(
             str(response), response.text))
@@ -593,8 +828,8 @@ def send_inlinequery_answer(token, response):
 
     url = TELEGRAM_HOSTNAME + "/bot" + token + "/answerInlineQuery"
     try:
-        response = requests.post(url, headers=headers,
-                                 data=json.dumps(post_data))
+        response = _post(url, headers=headers,
+                         data=json.dumps(post_data))
     except ConnectionError as error:
         raise TelegramError(
             "Error connecting to Telegram API: {}".format(str(error)))
@@ -647,8 +882,64 @@ def edit_message_reply_markup(token, message_id, reply_markup, chat_id=None):
 
     url = TELEGRAM_HOSTNAME + "/bot" + token + "/editMessageReplyMarkup"
     try:
-        response = requests.post(url, headers=headers,
-                                 data=json.dumps(post_data))
+        response = _post(url, headers=headers,
+                         data=json.dumps(post_data))
+    except ConnectionError as error:
+        raise TelegramError(
+            "Error connecting to Telegram API: {}".format(str(error)))
+    except HTTPError as error:
+        raise TelegramError(
+            "Error in POST request to Telegram API: {}".format(str(error)))
+    except Timeout as error:
+        raise TelegramError(
+            "Timeout connecting to Telegram API: {}".format(str(error)))
+
+    if response.status_code >= 400:
+        raise TelegramError("Error response from Telegram API: {} {}".format(
+            str(response), response.text))
+
+    return response
+
+
+def edit_message_text(token, chat_id, message_id, text, keyboard=None, parse=None):
+    """
+    Replaces the text of a message the bot sent, and its inline keyboard
+
+    :param token: Telegram bot token
+    :param chat_id: Telegram Chat ID
+    :param message_id: ID of the message to edit
+    :param text: new text of the message
+    :param keyboard: new inline keyboard, the keyboard is removed if empty
+    :param parse: Format to parse message in
+    :return: Telegram response object
+    :raise: TelegramError: Telegram API call failed
+    """
+    if text is None or len(text) <= 0:
+        raise ValidationError("Text cannot be empty")
+
+    post_data = {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "text": text
+    }
+
+    if parse == 'HTML':
+        post_data['parse_mode'] = 'HTML'
+    elif parse == 'MARKDOWN':
+        post_data['parse_mode'] = 'Markdown'
+
+    body = _json_body(
+        post_data,
+        serialize_reply_markup(keyboard, inline=True) if keyboard else None)
+
+    headers = {
+        "Content-Type": "application/json",
+        "Content-Length": str(len(body))
+    }
+
+    url = TELEGRAM_HOSTNAME + "/bot" + token + "/editMessageText"
+    try:
+        response = _post(url, headers=headers, data=body)
     except ConnectionError as error:
         raise TelegramError(
             "Error connecting to Telegram API: {}".format(str(error)))
@@ -698,8 +989,8 @@ def send_answer_callbackquery(token, message_id, text, show_alert):
 
     url = TELEGRAM_HOSTNAME + "/bot" + token + "/answerCallbackQuery"
     try:
-        response = requests.post(url, headers=headers,
-                                 data=json.dumps(post_data))
+        response = _post(url, headers=headers,
+                         data=json.dumps(post_data))
     except ConnectionError as error:
         raise TelegramError(
             "Error connecting to Telegram API: {}".format(str(error)))
@@ -738,7 +1029,7 @@ def send_document(token, chat_id, file_to_send, filename):
     url = TELEGRAM_HOSTNAME + "/bot" + token + "/sendDocument"
 
     try:
-        response = requests.post(url, files=file_data, data=post_data)
+        response = _post(url, files=file_data, data=post_data)
     except ConnectionError as error:
         raise TelegramError(
             "Error connecting to Telegram API: {}".format(str(error)))
@@ -792,7 +1083,7 @@ def send_video(token, chat_id, video, supports_streaming=True, caption='', keybo
     url = TELEGRAM_HOSTNAME + "/bot" + token + "/sendVideo"
 
     try:
-        response = requests.post(url, files=video_data, data=post_data)
+        response = _post(url, files=video_data, data=post_data)
 
     except ConnectionError as error:
         raise TelegramError(
@@ -21,46 +21,59 @@ class ObjectCreationFailed(Exception):
 
 
 class TelegramMessage(object):
+    """
+    Parsed Telegram update
+
+    Parsing is done in one pass over the update and only keeps references
+    into it, user_info is formatted only when somebody reads it.
+    """
+    __slots__ = (
+        'lang', 'type', 'command', 'command_arg', 'msg_date', 'id',
+        'chat_id', 'user_uid', 'user_id', 'body', 'bodytype', 'bodymime',
+        'msg_id', 'inline', 'firstname', 'is_bot', '_sender')
 
     def __init__(self, event, lang):
 
         self.lang = lang
         self.command = ''
         self.command_arg = ''
+        self._sender = None
+
+        update = event['Input']
+        message = update.get('message')
+        edited = message is None and 'edited_message' in update
+        if edited:
+            message = update['edited_message']
 
-        if 'message' in event['Input']:
+        if message is not None:
             self.type = 'MESSAGE'
-            message = event['Input']['message']
-            if message['chat']['type'] == 'supergroup':
-                logger.info("Message from a Telegram Group: {}".format(
-                    message['chat']['title']))
+            chat = message['chat']
+            chat_type = chat['type']
+            if chat_type == 'supergroup':
+                logger.info("Message from a Telegram Group: %s", chat['title'])
                 raise ObjectCreationFailed
-            elif message['chat']['type'] == 'channel':
-                logger.info("Forwarded from a Telegram Channel by: {}".format(
-                    message['chat']['username']))
+            elif chat_type == 'channel':
+                logger.info("Forwarded from a Telegram Channel by: %s", chat['username'])
                 raise ObjectCreationFailed
             try:
-                self.msg_date = message['date']
+                sender = message['from']
+                self.msg_date = message['edit_date'] if edited else message['date']
                 self.id = int(message['message_id'])
-                self.chat_id = int(message['chat']['id'])
-                self.user_uid = str(message['from']['id'])
-                if 'from' in message:
-                    if 'username' in message['from']:
-                        self.user_id = str(message['from']['username'])
-                    else:
-                        self.user_id = str(message['from']['id'])
-                    self.user_info = str(message['from'])
-                else:
-                    self.user_id = u''
-                    self.user_info = u''
+                self.chat_id = int(chat['id'])
+                self.user_uid = str(sender['id'])
+                self.user_id = str(sender.get('username') or sender['id'])
+                self._sender = sender
 
                 if 'text' in message:
                     self.body = message['text']
                     self.bodytype = 'TEXT'
+                elif edited:
+                    raise KeyError('text')
                 elif 'document' in message:
-                    self.body = message['document']['file_id']
+                    document = message['document']
+                    self.body = document['file_id']
                     self.bodytype = 'DOCUMENT'
-                    self.bodymime = message['document']['mime_type']
+                    self.bodymime = document['mime_type']
                 else:
                     self.body = ''
                     self.bodytype = 'UNKNOWN'
@@ -69,67 +82,44 @@ class TelegramMessage(object):
                 logger.error(str(exc))
                 raise ObjectCreationFailed
 
-        elif 'inline_query' in event['Input']:
+        elif 'inline_query' in update:
             self.type = 'INLINE'
-            inline_query = event['Input']['inline_query']
+            inline_query = update['inline_query']
             try:
+                sender = inline_query['from']
                 self.id = inline_query['id']
-                self.chat_id = inline_query['from']['id']
-                self.user_id = inline_query['from']['username']
+                self.chat_id = sender['id']
+                self.user_id = sender['username']
                 self.body = inline_query['query']
-                self.is_bot = inline_query['from']['is_bot']
+                self.is_bot = sender['is_bot']
 
             except Exception as exc:
                 raise ObjectCreationFailed
 
-        elif 'edited_message' in event['Input']:
-            self.type = 'MESSAGE'
-            message = event['Input']['edited_message']
-            try:
-                self.msg_date = message['edit_date']
-                self.id = int(message['message_id'])
-                self.chat_id = int(message['chat']['id'])
-                self.user_uid = str(message['from']['id'])
-                if 'from' in message:
-                    if 'username' in message['from']:
-                        self.user_id = str(message['from']['username'])
-                    else:
-                        self.user_id = str(message['from']['id'])
-                    self.user_info = str(message['from'])
-                else:
-                    self.user_id = u''
-                    self.user_info = u''
-
-                self.body = message['text']
-
-            except Exception as exc:
-                logger.error(str(exc))
-                raise ObjectCreationFailed
-
-        elif 'callback_query' in event['Input']:
+        elif 'callback_query' in update:
             self.type = 'CALLBACK'
-            callback_query = event['Input']['callback_query']
+            callback_query = update['callback_query']
             try:
+                sender = callback_query['from']
                 self.id = callback_query['id']
-                if 'message' in callback_query and 'chat' in callback_query['message']:
-                    self.chat_id = callback_query['message']['chat']['id']
+                callback_message = callback_query.get('message')
+                if callback_message is not None and 'chat' in callback_message:
+                    self.chat_id = callback_message['chat']['id']
                 else:
-                    self.chat_id = callback_query['from']['id']
+                    self.chat_id = sender['id']
 
-                if 'message' in callback_query:
-                    self.msg_id = callback_query['message']['message_id']
+                if callback_message is not None:
+                    self.msg_id = callback_message['message_id']
                     self.inline = False
                 else:
                     self.msg_id = callback_query['inline_message_id']
                     self.inline = True
 
-                self.user_uid = str(message['from']['id'])
-                if 'username' in callback_query['from']:
-                    self.user_id = callback_query['from']['username']
-                else:
-                    self.user_id = callback_query['from']['id']
+                self.user_uid = str(sender['id'])
+                self.user_id = sender.get('username') or sender['id']
+                self._sender = sender
 
-                self.firstname = callback_query['from']['first_name']
+                self.firstname = sender['first_name']
                 self.body = callback_query['data']
 
             except Exception as exc:
@@ -139,10 +129,19 @@ class TelegramMessage(object):
             logger.error('Undefined message type!')
             raise ObjectCreationFailed
 
-        if self.body[0] == '/':
-            self.command = self.body[1:]
-            cmd = self.command.split(' ', 1)
-            if len(cmd) > 1:
-                self.command = str(cmd[0])
-                self.command_arg = str(cmd[1])
-            self.command = self.command.lower()
+        body = self.body
+        if not body:
+            raise ObjectCreationFailed
+        if body[0] == '/':
+            (command, _, argument) = body[1:].partition(' ')
+            self.command = command.lower()
+            self.command_arg = argument
+
+    @property
+    def user_info(self):
+        """
+        Sender of the message as formatted text
+        """
+        if self._sender is None:
+            return u''
+        return str(self._sender)
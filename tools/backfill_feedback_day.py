@@ -0,0 +1,140 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Adds the feedback_day attribute to feedback items written without it
+
+The feedback digest only finds the items that have feedback_day when it
+queries the feedback_day/feedback_time index, feedback written before
+send_feedback set it is missing from such digests until this tool ran.
+The table is read with a parallel scan, one thread per segment, and the
+attribute is only set where it is still missing, so the tool can run
+while feedback comes in.
+
+Needs boto3.
+
+Usage:
+    python tools/backfill_feedback_day.py website_feedback --segments 8 --dry-run
+"""
+
+import argparse
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+
+def feedback_day(timestamp):
+    """
+    :param timestamp: seconds since epoch
+    :return: UTC date of the timestamp as YYYY-MM-DD, like feedback.feedback_day()
+    """
+    return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+
+def backfill_item(table, item, key_names, args):
+    """
+    Backfills one item
+
+    :param table: boto3 Table
+    :param item: Scanned item
+    :param key_names: Names of the key attributes of the table
+    :param args: Parsed arguments
+    :return: Outcome to count
+    """
+    from botocore.exceptions import ClientError
+    if 'feedback_day' in item:
+        return 'present'
+    if 'feedback_time' not in item:
+        return 'no_time'
+    if args.dry_run:
+        return 'backfilled'
+
+    try:
+        table.update_item(
+            Key={name: item[name] for name in key_names},
+            UpdateExpression='SET feedback_day = :day',
+            ConditionExpression='attribute_exists(feedback_time) AND attribute_not_exists(feedback_day)',
+            ExpressionAttributeValues={':day': feedback_day(float(item['feedback_time']))})
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        # Deleted or given the attribute since the scan
+        return 'present'
+    return 'backfilled'
+
+
+def scan_segment(table, key_names, segment, args, counts, lock):
+    """
+    Backfills the items of one scan segment
+    """
+    kwargs = {
+        'Segment': segment,
+        'TotalSegments': args.segments,
+        'FilterExpression': 'attribute_not_exists(feedback_day)'
+    }
+    if args.page_size:
+        kwargs['Limit'] = args.page_size
+    while True:
+        page = table.scan(**kwargs)
+        local = Counter()
+        for item in page.get('Items', []):
+            try:
+                local[backfill_item(table, item, key_names, args)] += 1
+            except Exception as error:
+                local['failed'] += 1
+                print('Segment {}: {}'.format(segment, error), file=sys.stderr)
+        with lock:
+            counts.update(local)
+        if 'LastEvaluatedKey' not in page:
+            return
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('table', help='feedback table name')
+    parser.add_argument('--segments', type=int, default=4,
+                        help='parallel scan segments, one thread each')
+    parser.add_argument('--page-size', type=int,
+                        help='items per scan page, lowers the read rate')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only count the items to backfill')
+    args = parser.parse_args()
+
+    import boto3
+    table = boto3.resource('dynamodb').Table(args.table)
+    key_names = [key['AttributeName'] for key in table.key_schema]
+    counts = Counter()
+    lock = threading.Lock()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=scan_segment,
+                                args=(table, key_names, segment, args, counts, lock))
+               for segment in range(args.segments)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print('{} in {:.1f}s: {} backfilled, {} already set, {} without feedback_time, {} failed'.format(
+        'Dry run' if args.dry_run else 'Done',
+        time.perf_counter() - started,
+        counts['backfilled'], counts['present'], counts['no_time'], counts['failed']))
+    if counts['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
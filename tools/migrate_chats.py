@@ -0,0 +1,150 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Rewrites the v1 chat items of a DynamoDB chat table in the v2 layout
+
+The table is read with a parallel scan, one thread per segment. Each v1
+item is written as a v2 item unless the bot already copied it, then the
+v1 item is deleted. Chats in an onboarding state get the onboarding
+TTL. The bot reads both layouts, so the tool can run while it serves
+users; set CHAT_SCHEMA_V1_READS to False afterwards.
+
+Needs boto3 and the CHAT_KEY_SECRET of the bot.
+
+Usage:
+    python tools/migrate_chats.py outline-chats --segments 8 --dry-run
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'common'))
+import chatschema
+
+# START, FIRST_CAPTCHA, OPT_IN and OPT_IN_DECLINED of the telegram bot
+ONBOARDING_STATUSES = '0,3,4,5'
+ONBOARDING_TTL = 30 * 86400
+
+
+def migrate_item(table, item, args, now):
+    """
+    Migrates one item
+
+    :param table: boto3 Table
+    :param item: Scanned item
+    :param args: Parsed arguments
+    :param now: Seconds since epoch
+    :return: Outcome to count
+    """
+    from botocore.exceptions import ClientError
+    key = item['chat_id']
+    if not chatschema.is_v1_key(key):
+        return 'v2'
+
+    attributes = chatschema.from_v1(item)
+    if attributes.get(chatschema.STATUS) in args.onboarding:
+        attributes['expires_at'] = int(now) + args.ttl
+    if args.dry_run:
+        return 'migrated'
+
+    new_item = dict(attributes)
+    new_item['chat_id'] = chatschema.v2_key(key, args.secret)
+    outcome = 'migrated'
+    try:
+        table.put_item(
+            Item=new_item,
+            ConditionExpression='attribute_not_exists(chat_id)')
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        # The bot read the chat and copied it already
+        outcome = 'copied_by_bot'
+    if not args.keep_v1:
+        table.delete_item(Key={'chat_id': key})
+    return outcome
+
+
+def scan_segment(table, segment, args, counts, lock):
+    """
+    Migrates the items of one scan segment
+    """
+    kwargs = {'Segment': segment, 'TotalSegments': args.segments}
+    if args.page_size:
+        kwargs['Limit'] = args.page_size
+    while True:
+        page = table.scan(**kwargs)
+        now = time.time()
+        local = Counter()
+        for item in page.get('Items', []):
+            try:
+                local[migrate_item(table, item, args, now)] += 1
+            except Exception as error:
+                local['failed'] += 1
+                print('Segment {}: {}'.format(segment, error), file=sys.stderr)
+        with lock:
+            counts.update(local)
+        if 'LastEvaluatedKey' not in page:
+            return
+        kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('table', help='chat table name')
+    parser.add_argument('--secret', default=os.environ.get('CHAT_KEY_SECRET', ''),
+                        help='CHAT_KEY_SECRET of the bot, default from the environment')
+    parser.add_argument('--segments', type=int, default=4,
+                        help='parallel scan segments, one thread each')
+    parser.add_argument('--page-size', type=int,
+                        help='items per scan page, lowers the read rate')
+    parser.add_argument('--onboarding-statuses', default=ONBOARDING_STATUSES,
+                        help='comma separated states that get the TTL')
+    parser.add_argument('--ttl', type=int, default=ONBOARDING_TTL,
+                        help='seconds an onboarding chat is kept')
+    parser.add_argument('--keep-v1', action='store_true',
+                        help='do not delete the v1 items')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only count the items to migrate')
+    args = parser.parse_args()
+    args.onboarding = {int(status) for status in args.onboarding_statuses.split(',')}
+
+    import boto3
+    table = boto3.resource('dynamodb').Table(args.table)
+    counts = Counter()
+    lock = threading.Lock()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=scan_segment,
+                                args=(table, segment, args, counts, lock))
+               for segment in range(args.segments)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print('{} in {:.1f}s: {} migrated, {} copied by the bot, {} already v2, {} failed'.format(
+        'Dry run' if args.dry_run else 'Done',
+        time.perf_counter() - started,
+        counts['migrated'], counts['copied_by_bot'], counts['v2'], counts['failed']))
+    if counts['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+# Copyright 2020 ASL19 Organization
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Slims a dist directory built by build.sh before it is zipped
+
+    - drops the src/common modules the bot never imports, following
+      import statements and lazy_module() calls from the handler
+    - drops dist-info/egg-info metadata, test packages, caches and the
+      settings template
+    - drops botocore service models the bots do not call, in case a
+      requirement pulls botocore into the bundle
+    - precompiles every module with unchecked-hash .pyc files, so the
+      runtime neither compiles nor stats sources on a cold start
+
+Must run with the same Python version as the Lambda runtime, other
+versions write .pyc files the runtime ignores.
+
+Usage:
+    python tools/slim.py dist outlinebot src/common
+"""
+
+import argparse
+import ast
+import compileall
+import os
+import py_compile
+import shutil
+import sys
+
+# botocore/data entries the bots need, everything else is dropped
+BOTOCORE_SERVICES = {'dynamodb', 's3', 'ses', 'sqs', 'sts'}
+BOTOCORE_DATA_FILES = {'endpoints.json', 'partitions.json', '_retry.json',
+                       'sdk-default-configuration.json'}
+
+TEST_DIRECTORIES = {'test', 'tests'}
+
+
+def imported_names(path):
+    """
+    Lists the modules a source file imports
+
+    Calls like lazy_module('name') count as imports.
+
+    :param path: Python source file
+    :return: Set of top level module names
+    """
+    with open(path, 'rb') as source:
+        tree = ast.parse(source.read(), path)
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            if node.level == 0 and node.module:
+                names.add(node.module.split('.')[0])
+        elif (isinstance(node, ast.Call)
+              and isinstance(node.func, ast.Name)
+              and node.func.id == 'lazy_module'
+              and node.args
+              and isinstance(node.args[0], ast.Constant)
+              and isinstance(node.args[0].value, str)):
+            names.add(node.args[0].value.split('.')[0])
+    return names
+
+
+def import_closure(dist, entry):
+    """
+    Finds the top level modules of dist reachable from the entry module
+
+    :param dist: Directory holding the bundle
+    :param entry: Handler module name
+    :return: Set of module names
+    """
+    local = {name[:-3] for name in os.listdir(dist) if name.endswith('.py')}
+    reached = set()
+    pending = [entry]
+    while pending:
+        module = pending.pop()
+        if module in reached or module not in local:
+            continue
+        reached.add(module)
+        pending.extend(imported_names(os.path.join(dist, module + '.py')))
+    return reached
+
+
+def shake_common(dist, entry, common):
+    """
+    Removes common modules the entry module never reaches
+
+    :return: List of removed module names
+    """
+    reached = import_closure(dist, entry)
+    removed = []
+    for name in sorted(os.listdir(common)):
+        module = name[:-3]
+        if name.endswith('.py') and module not in reached:
+            os.remove(os.path.join(dist, name))
+            removed.append(module)
+    return removed
+
+
+def strip_packages(dist):
+    """
+    Removes package metadata, tests, caches and unused botocore data
+
+    :return: Number of bytes removed
+    """
+    def remove(path):
+        size = 0
+        if os.path.isdir(path):
+            for (root, _, files) in os.walk(path):
+                size += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+            shutil.rmtree(path)
+        else:
+            size = os.path.getsize(path)
+            os.remove(path)
+        return size
+
+    removed = 0
+    for name in os.listdir(dist):
+        if (name.endswith(('.dist-info', '.egg-info'))
+                or name in ('bin', '__pycache__', 'settings-sample.py')):
+            removed += remove(os.path.join(dist, name))
+
+    for (root, directories, _) in os.walk(dist):
+        for directory in list(directories):
+            if directory in TEST_DIRECTORIES or directory == '__pycache__':
+                removed += remove(os.path.join(root, directory))
+                directories.remove(directory)
+
+    botocore_data = os.path.join(dist, 'botocore', 'data')
+    if os.path.isdir(botocore_data):
+        for name in os.listdir(botocore_data):
+            path = os.path.join(botocore_data, name)
+            if os.path.isdir(path) and name not in BOTOCORE_SERVICES:
+                removed += remove(path)
+            elif os.path.isfile(path) and name not in BOTOCORE_DATA_FILES:
+                removed += remove(path)
+    return removed
+
+
+def compile_bundle(dist):
+    """
+    Precompiles all modules to unchecked-hash .pyc files
+
+    :return: True if every module compiled
+    """
+    return compileall.compile_dir(
+        dist, quiet=1, workers=0,
+        invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('dist', help='bundle directory')
+    parser.add_argument('entry', help='handler module, e.g. outlinebot')
+    parser.add_argument('common', help='src/common directory')
+    args = parser.parse_args()
+
+    removed = shake_common(args.dist, args.entry, args.common)
+    print('Dropped common modules: {}'.format(', '.join(removed) or 'none'))
+    print('Stripped {:.1f} KB of metadata, tests and data'.format(
+        strip_packages(args.dist) / 1024))
+    if not compile_bundle(args.dist):
+        print('Some modules did not compile, they are left as sources')
+    print('Compiled bundle for Python {}.{}'.format(*sys.version_info[:2]))
+
+
+if __name__ == '__main__':
+    main()